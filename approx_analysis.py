@@ -0,0 +1,119 @@
+"""
+Approximate association rule analysis for interactive use.
+
+The exact `analyse_rule_set` compares each rule against all following rules,
+which is quadratic in the number of rules and hence too slow for the
+notebooks.
+Here, the support and confidence of each rule are instead estimated from a
+random sample of the other rules, together with Wilson score bounds.
+Optionally, the top candidates are refined by an exact count afterwards.
+
+Example (notebook):
+
+    approx = approx_analyse_rule_set(neg_rules, max_depth=10,
+                                     sample_size=5000, refine_top=100)
+
+Each entry has the form
+`[cond, target, support, confidence, support_bounds, confidence_bounds]`,
+where the first four fields are compatible to the output of
+`analyse_rule_set` and the bounds are `(low, high)` tuples.
+Refined rules have bounds equal to their exact values.
+"""
+import numpy as np
+
+from condition_encoding import RuleCodes
+from intrees import rule_to_assoc_rule
+
+
+def wilson_bounds(successes, trials, z=1.96):
+    """
+    Wilson score interval for a binomial proportion.
+    Returns `(low, high)`; for zero trials, `(0, 1)` is returned.
+    """
+    if trials == 0:
+        return (0.0, 1.0)
+    p = successes / trials
+    denominator = 1 + z*z/trials
+    centre = (p + z*z/(2*trials)) / denominator
+    margin = z * np.sqrt(p*(1-p)/trials + z*z/(4*trials*trials)) / denominator
+    return (max(0.0, centre - margin), min(1.0, centre + margin))
+
+
+def superset_mask(bits, query):
+    "Boolean mask of the rows in `bits` which contain all bits of `query`."
+    return ((bits & query) == query).all(axis=1)
+
+
+def approx_analyse_rule_set(rule_set, max_depth=None, sample_size=2000, z=1.96,
+                            refine_top=0, random_state=None, progress=None):
+    """
+    Estimates support and confidence for each rule in the rule set.
+
+    As in `analyse_rule_set`, the rules are sorted longest first and each
+    rule is compared against the rules following it.
+    Only a uniform random sample of `sample_size` rules is consulted for this;
+    the support estimate is the fraction of sampled following rules whose
+    condition contains the rule's condition, scaled to the number of following
+    rules.
+    Bounds are the Wilson score intervals at the given `z` value
+    (1.96 for 95%).
+
+    If `refine_top > 0`, the `refine_top` rules with the highest estimated
+    support are recomputed exactly.
+
+    Returns a list of
+    `[cond, target, support, confidence, support_bounds, confidence_bounds]`
+    in the order of the sorted rules.
+    """
+    sorted_rules = sorted(rule_set, key=lambda r: 1/len(r[0]))
+    n = len(sorted_rules)
+    rng = np.random.default_rng(random_state)
+
+    assoc_rules = [rule_to_assoc_rule(r, max_depth) for r in sorted_rules]
+    codes = RuleCodes.from_rules(sorted_rules, max_depth)
+    all_bits = codes.bitsets()
+
+    sample_idx = np.sort(rng.choice(n, size=min(sample_size, n), replace=False))
+    sample_bits = all_bits[sample_idx]
+    sample_targets = codes.targets[sample_idx]
+    query_bits = codes.bitsets(query=True)
+
+    analysis = []
+    for i in range(n):
+        cond, target = assoc_rules[i]
+        population = n - i - 1
+        start = np.searchsorted(sample_idx, i, side='right') # Sampled rules after i.
+        trials = len(sample_idx) - start
+        hits = superset_mask(sample_bits[start:], query_bits[i])
+        n_hits = int(hits.sum())
+        n_agree = int((sample_targets[start:][hits] == target).sum())
+
+        supp_low, supp_high = wilson_bounds(n_hits, trials, z)
+        support = population * n_hits / trials if trials > 0 else 0.0
+        confidence = n_agree / n_hits if n_hits > 0 else 0
+        conf_bounds = wilson_bounds(n_agree, n_hits, z)
+        if trials == population: # Sample covers all following rules.
+            supp_low = supp_high = n_hits / trials if trials > 0 else 0.0
+            conf_bounds = (confidence, confidence)
+        analysis.append([cond, target, support, confidence,
+                         (population*supp_low, population*supp_high), conf_bounds])
+        if progress is not None:
+            progress.update()
+
+    if refine_top > 0:
+        refine_exact(analysis, codes.targets, all_bits, query_bits, refine_top)
+    return analysis
+
+
+def refine_exact(analysis, targets, all_bits, query_bits, top):
+    """
+    Replaces the estimates of the `top` rules with highest estimated support
+    by their exact values (in-place).
+    """
+    order = sorted(range(len(analysis)), key=lambda i: (-analysis[i][2], -analysis[i][3]))
+    for i in order[:top]:
+        hits = superset_mask(all_bits[i+1:], query_bits[i])
+        support = int(hits.sum())
+        agree = int((targets[i+1:][hits] == analysis[i][1]).sum())
+        confidence = agree / support if agree > 0 else 0
+        analysis[i][2:] = [support, confidence, (support, support), (confidence, confidence)]
@@ -0,0 +1,224 @@
+"""
+Runs the forest training and association rule analysis for a matrix of
+backends, feature sets, and data collections in one go,
+instead of separate notebooks which each reload, retrain and re-extract.
+
+All data sets are loaded once and cached as `.npy` files which the workers
+memory-map. Jobs are scheduled on a single process pool:
+fitting a forest occupies `job_cpus` CPUs of the budget,
+the subsequent rule analysis a single one.
+
+The consolidated results are written to the target directory:
+
+* `comparison.csv`: classification metrics and run times per job, and the
+  error of failed jobs (e.g. a missing data file), which do not stop the others,
+* `top_rules.csv`: the best ranked association rules per job,
+* `instrumentation.json`: the stage timings of the batch.
+
+Usage:
+
+    python batch_analysis.py TARGET_DIR --backends prob kodkod z3 \
+        --feature-sets f109 --dates 2020-01-23 --cpus 24 --job-cpus 6
+"""
+import argparse
+import os
+import time
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from cluster_analysis import FOREST_PARAMS
+from datasets import BACKENDS, FEATURE_SETS, cache_dataset, dataset_path, load_cached_dataset
+from instrumentation import Instrumentation
+
+BatchJob = namedtuple('BatchJob', ['backend', 'feature_set', 'date'])
+
+
+def job_name(job):
+    return "%s-%s-%s" % job
+
+
+def job_matrix(backends, feature_sets, dates):
+    "Returns all combinations of the given backends, feature sets and dates."
+    return [BatchJob(b, f, d) for d in dates for f in feature_sets for b in backends]
+
+
+def fit_job(job, x_path, y_path, n_jobs, holdout=0.2, forest_params=FOREST_PARAMS):
+    """
+    Trains the forest for a job on the memory-mapped data set
+    and extracts its rules.
+    If `holdout > 0`, this fraction of the samples is held out from training
+    and used for the reported metrics; otherwise the training metrics are
+    reported (as `run_analysis` does).
+
+    Returns a tuple `(job, metrics, rules)`.
+    """
+    from sklearn.ensemble import RandomForestClassifier
+    from sklearn.model_selection import train_test_split
+    from intrees import extract_rules
+    from printing import classifier_metrics
+
+    X, Y = load_cached_dataset(x_path, y_path)
+    if holdout > 0:
+        train_x, test_x, train_y, test_y = train_test_split(
+            X, Y, test_size=holdout, random_state=forest_params.get('random_state'), stratify=Y)
+    else:
+        train_x, test_x, train_y, test_y = X, X, Y, Y
+
+    start = time.perf_counter()
+    forest = RandomForestClassifier(n_jobs=n_jobs, **forest_params)
+    forest.fit(train_x, train_y)
+    fit_seconds = time.perf_counter() - start
+
+    pred = forest.predict(test_x) # One prediction pass for all metrics.
+    metrics = {'samples': len(Y), 'positive_rate': float(np.mean(Y))}
+    metrics.update(classifier_metrics(test_y, pred))
+    metrics['fit_seconds'] = fit_seconds
+
+    extracted_rules = extract_rules(forest)
+    rules = [rule for tree in extracted_rules for rule in extracted_rules[tree]]
+    metrics['rules'] = len(rules)
+    return job, metrics, rules
+
+
+def analyse_job(job, rules, analysis='approx', max_depth=None, sample_size=5000,
+                refine_top=100, top=10):
+    """
+    Calculates support and confidence for the rules of a job,
+    either exactly (`analysis='exact'`) or estimated (`analysis='approx'`).
+
+    Returns a tuple `(job, seconds, top_rules)` with the `top` best ranked
+    rules as list of `[cond, target, support, confidence]`.
+    """
+    from intrees import analyse_rule_set
+    from approx_analysis import approx_analyse_rule_set
+    from reporting import rank_rules
+
+    start = time.perf_counter()
+    if analysis == 'exact':
+        annotated = analyse_rule_set(rules, max_depth=max_depth)
+    else:
+        annotated = approx_analyse_rule_set(rules, max_depth=max_depth, sample_size=sample_size,
+                                            refine_top=refine_top, random_state=1234)
+    seconds = time.perf_counter() - start
+    top_rules = [annotated[i][:4] for i in rank_rules(annotated)[:top]]
+    return job, seconds, top_rules
+
+
+def run_batch(jobs, target_dir, data_dir='data', cpus=None, job_cpus=4, holdout=0.2,
+              analysis='approx', max_depth=None, sample_size=5000, refine_top=100, top=10):
+    """
+    Runs all jobs on a shared process pool limited to `cpus` CPUs.
+    A failing job is recorded in the `error` column of the comparison
+    and the other jobs continue.
+    Returns the comparison and top rule DataFrames (which are also written
+    to `target_dir`).
+    """
+    target_dir = Path(target_dir)
+    target_dir.mkdir(parents=True, exist_ok=True)
+    cpus = cpus or os.cpu_count()
+    job_cpus = min(job_cpus, cpus)
+    instr = Instrumentation("batch")
+    failed = {} # job -> error message
+
+    with instr.stage("load") as stage:
+        data_paths = {}
+        for job in jobs:
+            csv = dataset_path(job.backend, job.feature_set, job.date, data_dir)
+            n_features = FEATURE_SETS[job.feature_set].n_features
+            try:
+                # Jobs on the same file share one cached copy.
+                data_paths[job] = cache_dataset(csv, n_features, target_dir / 'cache')
+            except Exception as e:
+                failed[job] = "load: %s" % e
+                instr.log("Failed to load %s: %s" % (job_name(job), e))
+        stage.count(len(set(data_paths.values())), unit="data sets")
+
+    results = {}
+    top_rules = {}
+    with instr.stage("schedule") as stage, ProcessPoolExecutor(max_workers=cpus) as pool:
+        pending_fits = [job for job in jobs if job in data_paths]
+        pending_analyses = []
+        running = {} # future -> (stage, occupied CPUs, job)
+        free = cpus
+        while pending_fits or pending_analyses or running:
+            # Analyses first, as they free the memory held by the rules.
+            while pending_analyses and free >= 1:
+                job, rules = pending_analyses.pop(0)
+                future = pool.submit(analyse_job, job, rules, analysis, max_depth,
+                                     sample_size, refine_top, top)
+                running[future] = ('analyse', 1, job)
+                free -= 1
+            while pending_fits and free >= job_cpus:
+                job = pending_fits.pop(0)
+                future = pool.submit(fit_job, job, *data_paths[job], job_cpus, holdout)
+                running[future] = ('fit', job_cpus, job)
+                free -= job_cpus
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                kind, occupied, job = running.pop(future)
+                free += occupied
+                try:
+                    output = future.result()
+                except Exception as e: # Keep the results of the other jobs.
+                    failed[job] = "%s: %s" % (kind, e)
+                    instr.log("Failed to %s %s: %s" % (kind, job_name(job), e))
+                    continue
+                if kind == 'fit':
+                    job, metrics, rules = output
+                    results[job] = metrics
+                    pending_analyses.append((job, rules))
+                    instr.log("Fitted %s (%d rules)" % (job_name(job), len(rules)))
+                else:
+                    job, seconds, job_top = output
+                    results[job]['analyse_seconds'] = seconds
+                    top_rules[job] = job_top
+                    instr.log("Analysed %s" % job_name(job))
+        stage.count(len(jobs), unit="jobs")
+
+    with instr.stage("report"):
+        comparison = pd.DataFrame([dict(backend=j.backend, feature_set=j.feature_set,
+                                        date=j.date, **results.get(j, {}), error=failed.get(j))
+                                   for j in jobs])
+        rows = []
+        for j in jobs:
+            name = FEATURE_SETS[j.feature_set].feature_name
+            for rank, (cond, target, supp, conf) in enumerate(top_rules.get(j, [])):
+                text = ", ".join("%s (%s)" % (name(fid), "low" if leq else "high")
+                                 for (fid, leq) in sorted(cond))
+                rows.append(dict(backend=j.backend, feature_set=j.feature_set, date=j.date,
+                                 rank=rank+1, conditions=text, target=target,
+                                 support=supp, confidence=conf))
+        top_frame = pd.DataFrame(rows)
+        comparison.to_csv(target_dir / 'comparison.csv', index=False)
+        top_frame.to_csv(target_dir / 'top_rules.csv', index=False)
+
+    instr.write_summary(target_dir / 'instrumentation.json')
+    return comparison, top_frame
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Batch analysis over backends, feature sets and data collections.")
+    parser.add_argument('target_dir')
+    parser.add_argument('--backends', nargs='+', default=BACKENDS)
+    parser.add_argument('--feature-sets', nargs='+', default=['f109'])
+    parser.add_argument('--dates', nargs='+', default=['2020-01-23'])
+    parser.add_argument('--data-dir', default='data')
+    parser.add_argument('--cpus', type=int, default=None, help="Total CPU budget (default: all)")
+    parser.add_argument('--job-cpus', type=int, default=4, help="CPUs per forest fit")
+    parser.add_argument('--holdout', type=float, default=0.2)
+    parser.add_argument('--analysis', choices=['approx', 'exact'], default='approx')
+    parser.add_argument('--max-depth', type=int, default=None)
+    parser.add_argument('--sample-size', type=int, default=5000)
+    parser.add_argument('--refine-top', type=int, default=100)
+    parser.add_argument('--top', type=int, default=10)
+    args = parser.parse_args()
+
+    jobs = job_matrix(args.backends, args.feature_sets, args.dates)
+    comparison, _ = run_batch(jobs, args.target_dir, args.data_dir, args.cpus, args.job_cpus,
+                              args.holdout, args.analysis, args.max_depth, args.sample_size,
+                              args.refine_top, args.top)
+    print(comparison.to_string(index=False))
@@ -0,0 +1,134 @@
+"""
+Benchmark of the kernels in `kernels.py` against the pure Python
+implementations, on the 50 tree analysis forest of an F109 data set.
+Each kernel is run with the NumPy backend and, if installed, with Numba
+(the first Numba call, which includes compilation, is not timed).
+
+Usage:
+
+    python bench_kernels.py data/2020-01-23/prob-f109-lto_unique.csv --max-depth 10
+"""
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+import feature_stats
+import kernels
+from cluster_analysis import FOREST_PARAMS
+from datasets import load_dataset
+from intrees import analyse_rule_set, extract_rules
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def neg_ratio_python(tree_, node_id):
+    "The former per-node traversal of `feature_stats.node_neg_class_ratio`."
+    leaf_count = 0
+    neg_classifications = 0
+    stack = [node_id]
+    while stack:
+        node = stack.pop()
+        if tree_.children_left[node] != tree_.children_right[node]:
+            stack += [tree_.children_left[node], tree_.children_right[node]]
+        else:
+            nprob, pprob = tree_.value[node][0]
+            leaf_count += 1
+            neg_classifications += 1 if nprob > pprob else 0
+    return neg_classifications / leaf_count
+
+
+def split_ratios_python(forest, n_features):
+    "Unknown-ratios queried by `gather_tree_info`, one traversal per node."
+    result = []
+    for tree in forest.estimators_:
+        tree_ = tree.tree_
+        for feature in range(n_features):
+            nodes = np.flatnonzero(tree_.feature == feature)
+            if len(nodes):
+                node = nodes[0]
+                result.append([neg_ratio_python(tree_, n) for n in
+                               (node, tree_.children_left[node], tree_.children_right[node])])
+    return result
+
+
+def split_ratios_kernel(forest, n_features):
+    "Same as `split_ratios_python`, via `feature_stats.gather_tree_info`."
+    result = []
+    for tree in forest.estimators_:
+        for split in feature_stats.gather_tree_info(tree)['splits'][:n_features]:
+            if split:
+                result.append([split['unknown_rate'], split['unknown_rate_left'],
+                               split['unknown_rate_right']])
+    return result
+
+
+def bench_kernels(forest, rules, max_depth=None, analyse_python=True):
+    backends = ['numpy'] + (['numba'] if kernels.numba is not None else [])
+    rows = []
+
+    reference, seconds = timed(extract_rules, forest)
+    rows.append({'kernel': 'extract rules', 'backend': 'python', 'seconds': seconds, 'equal': True})
+    for backend in backends:
+        kernels.BACKEND = backend
+        kernels.extract_rules_fast(forest) # Warm-up / compilation.
+        result, seconds = timed(kernels.extract_rules_fast, forest)
+        equal = all(result[tree] == reference[tree] for tree in reference)
+        rows.append({'kernel': 'extract rules', 'backend': backend, 'seconds': seconds, 'equal': equal})
+
+    reference = None
+    if analyse_python:
+        reference, seconds = timed(analyse_rule_set, rules, max_depth)
+        rows.append({'kernel': 'analyse rules', 'backend': 'python', 'seconds': seconds, 'equal': True})
+    for backend in backends:
+        kernels.BACKEND = backend
+        kernels.analyse_rules(rules[:10], max_depth)
+        result, seconds = timed(kernels.analyse_rules, rules, max_depth)
+        equal = reference is None or result == reference
+        rows.append({'kernel': 'analyse rules', 'backend': backend, 'seconds': seconds, 'equal': equal})
+
+    n_features = forest.n_features_in_
+    reference, seconds = timed(split_ratios_python, forest, n_features)
+    rows.append({'kernel': 'split unknown ratios', 'backend': 'python', 'seconds': seconds,
+                 'equal': True})
+    for backend in backends:
+        kernels.BACKEND = backend
+        split_ratios_kernel(forest, n_features)
+        result, seconds = timed(split_ratios_kernel, forest, n_features)
+        rows.append({'kernel': 'split unknown ratios', 'backend': backend, 'seconds': seconds,
+                     'equal': np.allclose(result, reference)})
+    return pd.DataFrame(rows)
+
+
+def run_bench(csv_file, n_features=109, max_depth=None, analyse_python=True):
+    "Fits the forest on `csv_file` and benchmarks the kernels with speedups."
+    from sklearn.ensemble import RandomForestClassifier
+    X, Y = load_dataset(csv_file, n_features)
+    forest = RandomForestClassifier(n_jobs=6, **FOREST_PARAMS).fit(X, Y)
+    extracted = extract_rules(forest)
+    rules = sorted([rule for tree in extracted for rule in extracted[tree]], key=lambda r: len(r[0]))
+    print("Trees: %d, rules: %d, numba: %s" % (len(forest.estimators_), len(rules),
+                                                kernels.numba is not None))
+
+    frame = bench_kernels(forest, rules, max_depth, analyse_python)
+    baseline = frame.groupby('kernel')['seconds'].transform('max')
+    frame['speedup'] = baseline / frame['seconds']
+    return frame
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the analysis kernels.")
+    parser.add_argument('csv_file')
+    parser.add_argument('--n-features', type=int, default=109)
+    parser.add_argument('--max-depth', type=int, default=None)
+    parser.add_argument('--skip-python-analysis', action='store_true',
+                        help="Do not run the (quadratic) pure Python analysis")
+    args = parser.parse_args()
+
+    print(run_bench(args.csv_file, args.n_features, args.max_depth,
+                    not args.skip_python_analysis).to_string(index=False))
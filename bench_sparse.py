@@ -0,0 +1,80 @@
+"""
+Benchmark comparing the current dense float64 DataFrame input against float32
+dense and float32 CSR matrices (see `datasets.training_matrix`) for fitting,
+prediction and (optionally) permutation importance.
+
+Usage:
+
+    python bench_sparse.py data/2020-01-23/prob-f109-lto_unique.csv \
+        data/2020-01-10/prob-f275_unique.csv --permutation
+"""
+import argparse
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from cluster_analysis import FOREST_PARAMS
+from datasets import load_dataset, matrix_nbytes, training_matrix
+from importances import permutation_importances
+
+LAYOUTS = ['frame', 'dense', 'sparse']
+
+
+def bench_layout(X, Y, layout, permutation=False, n_repeats=5):
+    from sklearn.ensemble import RandomForestClassifier
+
+    start = time.perf_counter()
+    matrix = training_matrix(X, layout)
+    convert_seconds = time.perf_counter() - start
+
+    forest = RandomForestClassifier(n_jobs=6, **FOREST_PARAMS)
+    start = time.perf_counter()
+    forest.fit(matrix, Y)
+    fit_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    proba = forest.predict_proba(matrix)
+    predict_seconds = time.perf_counter() - start
+
+    row = {'layout': layout, 'megabytes': matrix_nbytes(matrix) / 2**20,
+           'convert_seconds': convert_seconds, 'fit_seconds': fit_seconds,
+           'predict_seconds': predict_seconds}
+    if permutation:
+        start = time.perf_counter()
+        permutation_importances(forest, matrix, Y, n_repeats=n_repeats)
+        row['permutation_seconds'] = time.perf_counter() - start
+    return row, proba
+
+
+def bench_file(csv_file_path, n_features, permutation=False):
+    X, Y = load_dataset(csv_file_path, n_features)
+    density = np.count_nonzero(X.to_numpy()) / X.size
+    rows = []
+    reference = None
+    for layout in LAYOUTS:
+        row, proba = bench_layout(X, Y, layout, permutation)
+        if reference is None:
+            reference = proba
+        row['max_proba_diff'] = float(np.abs(proba - reference).max())
+        row.update({'data': Path(csv_file_path).name, 'density': density})
+        rows.append(row)
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare dense and sparse training inputs.")
+    parser.add_argument('csv_files', nargs='+')
+    parser.add_argument('--n-features', type=int, default=None,
+                        help="Number of feature columns (default: guessed from the file name)")
+    parser.add_argument('--permutation', action='store_true', help="Also time permutation importances")
+    args = parser.parse_args()
+
+    rows = []
+    for path in args.csv_files:
+        n_features = args.n_features or (275 if 'f275' in path else 109)
+        rows += bench_file(path, n_features, args.permutation)
+    frame = pd.DataFrame(rows)
+    print(frame[['data', 'density'] + [c for c in frame.columns if c not in ('data', 'density')]]
+          .to_string(index=False))
@@ -0,0 +1,202 @@
+"""
+Single command line entry point for the cluster analysis.
+
+Each subcommand imports what it needs only when it runs. Scikit-Learn and
+Pandas cost about a second to import, and a short job array task or gather
+run should not pay for that. `prepare` trains the forest once and stores the
+length-sorted rules and the importances as plain Python and NumPy objects in
+`prepared.pkl`, so `shard`, `gather` and `report` never import Scikit-Learn.
+
+Usage:
+
+    python cluster.py prepare data/2020-01-23/prob-f109-lto_unique.csv results/prob-f109
+    python cluster.py shard results/prob-f109 $SLURM_ARRAY_TASK_ID  # one batch of rules
+    python cluster.py gather results/prob-f109                      # Markdown listing of the batches
+    python cluster.py report results/prob-f109/assoc_rules.dat results/prob-f109
+
+    python cluster.py analyse data/2020-01-23/prob-f109-lto_unique.csv results/prob-f109 --prune
+    python cluster.py bench data/2020-01-23/prob-f109-lto_unique.csv --max-depth 10
+
+`shard --queue` runs a `work_queue.py` worker instead of a fixed batch.
+"""
+import argparse
+import importlib.util
+import pickle
+import sys
+import time
+from pathlib import Path
+
+PREPARED = 'prepared.pkl'
+
+
+def load_script(path, name):
+    "Imports a script whose file name is not a valid module name (e.g. `gather-jobarray.py`)."
+    spec = importlib.util.spec_from_file_location(name, Path(__file__).parent / path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def load_prepared(directory):
+    "Returns the dictionary written by `prepare` (`rules`, `importances`, `source`)."
+    with open(Path(directory) / PREPARED, 'rb') as f:
+        return pickle.load(f)
+
+
+def prepare(csv_file_path, target_dir, cache_dir=None, collapse=False, layout='frame',
+            prune=False, shap=False, filter_threshold=None):
+    """
+    Runs the analysis pipeline of `cluster_analysis.py` up to the rule
+    extraction (or pruning) and writes the rules and importances to
+    `target_dir/prepared.pkl`. Returns the number of rules.
+    """
+    import numpy as np
+    from cluster_analysis import analysis_pipeline
+    from instrumentation import Instrumentation
+
+    instr = Instrumentation(Path(csv_file_path).stem)
+    pipe = analysis_pipeline(csv_file_path, target_dir, instr, cache_dir, collapse=collapse,
+                             layout=layout, prune=prune, shap=shap,
+                             filter_threshold=filter_threshold)
+    rules = pipe.stages['analyse'].inputs[-1]
+    importances = pipe.stages['report'].inputs[0]
+    outputs = pipe.run([importances, rules])
+    prepared = {'rules': outputs[rules], 'importances': np.asarray(outputs[importances]),
+                'source': str(csv_file_path)}
+    with open(Path(target_dir) / PREPARED, 'wb') as f:
+        pickle.dump(prepared, f, protocol=pickle.HIGHEST_PROTOCOL)
+    instr.write_summary(str(Path(target_dir) / 'instrumentation.json'))
+    return len(prepared['rules'])
+
+
+def shard(target_dir, num, batch_size=100, max_depth=None, processes=None):
+    """
+    Analyses batch `num` of the prepared rules as a task of
+    `cluster_analysis_jobarray.py` does, writing the rule files into
+    `target_dir/jobarray/<num>/job-parts/part` and the annotated rules into
+    `target_dir/jobarray/<num>/assoc_rules.dat`. Returns the number of rules.
+    """
+    from cluster_analysis_jobarray import analyse_rule_set_jobnum, cpu_count
+
+    prepared = load_prepared(target_dir)
+    job_dir = Path(target_dir) / 'jobarray' / str(num)
+    (job_dir / 'job-parts').mkdir(parents=True, exist_ok=True)
+    annotated_rules = analyse_rule_set_jobnum(prepared['rules'], max_depth=max_depth,
+                                              target_dir=str(job_dir / 'job-parts'),
+                                              importances=prepared['importances'], num=num,
+                                              batch_size=batch_size,
+                                              processes=processes or cpu_count)
+    with open(job_dir / 'assoc_rules.dat', 'wb') as dat:
+        pickle.dump(annotated_rules, dat)
+    return len(annotated_rules)
+
+
+def report(rules_path, target_dir, prepared_dir=None, formats=None):
+    """
+    Writes the reports of a pickled list of annotated rules.
+    The Markdown listing needs the importances of a `prepare` run.
+    Returns the number of rules in the last written report.
+    """
+    from reporting import write_report
+
+    with open(rules_path, 'rb') as dat:
+        annotated_rules = pickle.load(dat)
+    importances = None if prepared_dir is None else load_prepared(prepared_dir)['importances']
+    if formats is None:
+        formats = ['csv'] if importances is None else ['md', 'csv']
+    Path(target_dir).mkdir(parents=True, exist_ok=True)
+    names = {'md': 'assoc_rule_overview.md', 'csv': 'assoc_rules.csv', 'parquet': 'assoc_rules.parquet'}
+    written = 0
+    for fmt in formats:
+        if fmt == 'md' and importances is None:
+            raise ValueError("The Markdown report needs the importances, pass --prepared")
+        written = write_report(annotated_rules, str(Path(target_dir) / names[fmt]), importances,
+                               fmt=fmt, support_total=len(annotated_rules))
+    return written
+
+
+if __name__ == "__main__":
+    from feature_filter import FILTER_THRESHOLD
+
+    parser = argparse.ArgumentParser(description="Association rule analysis of the backend forests.")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    def analysis_options(command):
+        command.add_argument('--cache-dir', default=None)
+        command.add_argument('--collapse', action='store_true', help="Train on weighted unique rows")
+        command.add_argument('--float32', action='store_true', help="float32 dense/CSR input")
+        command.add_argument('--prune', action='store_true', help="inTrees pruning of the rules")
+        command.add_argument('--shap', action='store_true', help="Rank features by mean |SHAP|")
+        command.add_argument('--filter', type=float, nargs='?', const=FILTER_THRESHOLD, default=None,
+                             metavar='THRESHOLD', help="Drop constant and correlated features")
+
+    prep = commands.add_parser('prepare', help="Train the forest and store rules and importances")
+    prep.add_argument('csv_file')
+    prep.add_argument('target_dir')
+    analysis_options(prep)
+    analyse = commands.add_parser('analyse', help="Run the complete analysis (cluster_analysis.py)")
+    analyse.add_argument('csv_file')
+    analyse.add_argument('target_dir')
+    analysis_options(analyse)
+    analyse.add_argument('--data-support', action='store_true', help="Count support over the samples")
+    shard_cmd = commands.add_parser('shard', help="Analyse one batch of prepared rules")
+    shard_cmd.add_argument('target_dir', help="Directory of a prepare run (or a queue with --queue)")
+    shard_cmd.add_argument('num', type=int, nargs='?', default=None, help="Job array index")
+    shard_cmd.add_argument('--batch-size', type=int, default=100)
+    shard_cmd.add_argument('--max-depth', type=int, default=None)
+    shard_cmd.add_argument('--processes', type=int, default=None)
+    shard_cmd.add_argument('--queue', action='store_true',
+                           help="Process shards of a work_queue.py queue instead")
+    gather_cmd = commands.add_parser('gather', help="Gather the job array results")
+    gather_cmd.add_argument('target_dir')
+    gather_cmd.add_argument('--out', default=None,
+                            help="Listing to write (default: target_dir/assoc_rule_overview.md)")
+    report_cmd = commands.add_parser('report', help="Write the reports of pickled annotated rules")
+    report_cmd.add_argument('rules', help="Pickled annotated rules (assoc_rules.dat)")
+    report_cmd.add_argument('target_dir')
+    report_cmd.add_argument('--prepared', default=None, help="prepare directory with the importances")
+    report_cmd.add_argument('--format', action='append', choices=['md', 'csv', 'parquet'],
+                            dest='formats', default=None)
+    bench = commands.add_parser('bench', help="Benchmark the analysis kernels")
+    bench.add_argument('csv_file')
+    bench.add_argument('--n-features', type=int, default=109)
+    bench.add_argument('--max-depth', type=int, default=None)
+    bench.add_argument('--skip-python-analysis', action='store_true')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    if args.command in ('prepare', 'analyse'):
+        Path(args.target_dir).mkdir(parents=True, exist_ok=True)
+        layout = 'auto' if args.float32 else 'frame'
+        if args.command == 'prepare':
+            n = prepare(args.csv_file, args.target_dir, args.cache_dir, args.collapse, layout,
+                        args.prune, args.shap, args.filter)
+            print("Prepared %d rules in %s" % (n, args.target_dir))
+        else:
+            from cluster_analysis import run_analysis
+            run_analysis(args.csv_file, args.target_dir, cache_dir=args.cache_dir,
+                         collapse=args.collapse, layout=layout, prune=args.prune,
+                         support='data' if args.data_support else 'rules', shap=args.shap,
+                         filter_threshold=args.filter)
+    elif args.command == 'shard':
+        if args.queue:
+            from work_queue import work
+            n = work(args.target_dir)
+        elif args.num is None:
+            parser.error("shard needs the job array index (or --queue)")
+        else:
+            n = shard(args.target_dir, args.num, args.batch_size, args.max_depth, args.processes)
+        print("Analysed %d rules" % n)
+    elif args.command == 'gather':
+        gather_jobarray = load_script('gather-jobarray.py', 'gather_jobarray').gather_jobarray
+        out = args.out or str(Path(args.target_dir) / 'assoc_rule_overview.md')
+        n = gather_jobarray(Path(args.target_dir) / 'jobarray', out)
+        print("Wrote %d rules to %s" % (n, out))
+    elif args.command == 'report':
+        n = report(args.rules, args.target_dir, args.prepared, args.formats)
+        print("Wrote %d rules to %s" % (n, args.target_dir))
+    else:
+        from bench_kernels import run_bench
+        print(run_bench(args.csv_file, args.n_features, args.max_depth,
+                        not args.skip_python_analysis).to_string(index=False))
+    print("%s finished in %.2fs" % (args.command, time.perf_counter() - start), file=sys.stderr)
@@ -9,6 +9,15 @@ instead of a Jupyter Notebook.
 from f109_info import *
 from intrees import *
 from printing import *
+from instrumentation import Instrumentation
+from reporting import write_report
+from pipeline import Pipeline, file_fingerprint
+from datasets import balanced_sample_weight, load_collapsed_dataset, load_dataset, training_matrix
+from importances import permutation_importances, shap_importances
+from feature_filter import FILTER_THRESHOLD, redundancy_filter
+from rule_coverage import CoverageEngine
+from rule_trie import RuleTrie
+import kernels
 
 import pandas as pd
 import numpy as np
@@ -39,76 +48,240 @@ def pretty_print_assoc_rule(rule, importances, target_file):
 
 
 
-def run_analysis(csv_file_path, target_dir='./'):
-    data = pd.read_csv(csv_file_path)
-    n_features = 109
+FOREST_PARAMS = dict(
+    n_estimators=50, # 50 Trees.
+    criterion="gini", # Using Gini index instead of "entropy"
+    bootstrap=False,
+    max_features=0.7,
+    random_state=123,
+    class_weight="balanced")
 
-    X = data[data.columns[0:n_features]]
-    Y = data["Label0"]
 
-    print("Training forest")
-    forest = RandomForestClassifier(
-        n_estimators=50, # 50 Trees.
-        criterion="gini", # Using Gini index instead of "entropy"
-        n_jobs=6, # Number of CPUs to use.
-        bootstrap=False,
-        max_features=0.7,
-        random_state=123,
-        class_weight="balanced")
+def load_stage(csv_file_path, source=None, n_features=109, collapse=False, layout='frame'):
+    """
+    Loads the data set; `source` is the file fingerprint for the cache key.
+    Returns `(X, Y, counts)`. If `collapse` is set, duplicate rows are
+    collapsed and `counts` holds their multiplicities, otherwise it is `None`.
+    `X` is converted by `training_matrix` into the given `layout`.
+    """
+    if collapse:
+        X, Y, counts = load_collapsed_dataset(csv_file_path, n_features)
+    else:
+        X, Y = load_dataset(csv_file_path, n_features)
+        counts = None
+    return training_matrix(X, layout), Y, counts
 
-    forest.fit(X, Y)
+
+def filter_stage(data, threshold=FILTER_THRESHOLD):
+    "Finds constant and near-duplicate features, see `feature_filter.redundancy_filter`."
+    X, Y, counts = data
+    feature_filter = redundancy_filter(X, Y, threshold, sample_weight=counts)
+    print("Kept %d of %d features" % (len(feature_filter), feature_filter.n_features))
+    return feature_filter
+
+
+def filtered_stage(data, feature_filter):
+    "The data restricted to the kept features."
+    X, Y, counts = data
+    return feature_filter.select(X), Y, counts
+
+
+def restore_rules_stage(feature_filter, rule_list):
+    "Rules of the filtered forest with the original feature ids."
+    return feature_filter.restore_rules(rule_list)
+
+
+def restore_importances_stage(feature_filter, importances):
+    "Importances of the filtered forest per original feature."
+    return feature_filter.restore_importances(importances)
+
+
+def fit_stage(data, forest_params=FOREST_PARAMS, n_jobs=6):
+    X, Y, counts = data
+    sample_weight = None
+    params = dict(forest_params)
+    if counts is not None:
+        # Weighted unique rows train the same forest as the duplicated rows.
+        sample_weight = counts
+        if params.get('class_weight') == 'balanced':
+            params['class_weight'] = None
+            sample_weight = balanced_sample_weight(Y, counts)
+    forest = RandomForestClassifier(n_jobs=n_jobs, **params)
+    forest.fit(X, Y, sample_weight=sample_weight)
     print_classifier_stats(forest, X, Y)
+    return forest
 
-    print("Calculating Gini importances")
-    importances = forest.feature_importances_
-    std = np.std([tree.feature_importances_ for tree in forest.estimators_],
-                 axis=0)
-    indices = np.argsort(importances)[::-1]
 
-    print("Calculating permutation importances")
-    # perm_importances = permutation_importance(forest, X, Y, scoring='balanced_accuracy', n_repeats=5, n_jobs=1, random_state=1234)
-    # perm_indices = perm_importances.importances_mean.argsort()[::-1]
+def importances_stage(data, forest, permutation=False, shap=False):
+    """
+    Returns the Gini importances of the forest,
+    the mean permutation importances if `permutation` is set,
+    or the mean absolute TreeSHAP values if `shap` is set.
+    """
+    if shap:
+        return shap_importances(forest, data[0])
+    if not permutation:
+        return forest.feature_importances_
+    X, Y, counts = data
+    return permutation_importances(forest, X, Y, scoring='balanced_accuracy', n_repeats=5, random_state=1234, sample_weight=counts)
 
-    print("Extracting rules")
-    extracted_rules = extract_rules(forest)
 
-    rule_count = 0
-    for tree in forest.estimators_:
-        rule_set = extracted_rules[tree]
-        rule_count += len(rule_set)
-    print("Collected %d rules" % rule_count)
+def extract_stage(forest):
+    "Returns the rules of all trees, sorted by length."
+    extracted_rules = extract_rules(forest)
 
     rule_list = []
     for tree in extracted_rules:
         rule_list += [(c,o) for (c,o) in extracted_rules[tree]]
-    sorted_rule_list = sorted(rule_list, key=lambda r: len(r[0])) # Sorted rules by length
+    print("Collected %d rules" % len(rule_list))
+    return sorted(rule_list, key=lambda r: len(r[0])) # Sorted rules by length
+
+
+def prune_stage(data, rule_list, threshold=0.05):
+    "Prunes the rules on the training data, see `prune_rules`."
+    X, Y, counts = data
+    if hasattr(X, 'toarray'):
+        X = X.toarray()
+    pruned = prune_rules(rule_list, X, Y, threshold=threshold, sample_weight=counts)
+    print("Pruned rules from %d to %d conditions" % (sum(len(c) for (c, _) in rule_list),
+                                                    sum(len(c) for (c, _) in pruned)))
+    return sorted(pruned, key=lambda r: len(r[0]))
+
+
+def analyse_stage(rule_list, max_depth=None, analysis='kernels', instr=None):
+    """
+    Support and confidence as computed by `analyse_rule_set`.
+    By default (`analysis='kernels'`), `kernels.analyse_rules` is used,
+    compiled with Numba if installed and vectorized with NumPy otherwise;
+    it reports no progress.
+    With `analysis='trie'`, the prefix trie of the rules is used instead
+    (see `rule_trie.RuleTrie`), which gives the same results and
+    yields all depth cutoffs in one pass, but is slower for a single one.
+    With `analysis='python'`, `analyse_rule_set` itself is used.
+    Both report their progress to `instr`.
+    """
+    if analysis == 'kernels':
+        return kernels.analyse_rules(rule_list, max_depth)
+    progress = None if instr is None else instr.progress(len(rule_list), "analyse", unit="rules")
+    if analysis == 'trie':
+        annotated_rules = RuleTrie.from_rules(rule_list).annotate(max_depth, progress=progress)
+    else:
+        annotated_rules = analyse_rule_set(rule_list, max_depth=max_depth, progress=progress)
+    if progress is not None:
+        progress.close()
+    return annotated_rules
 
-    md = open(target_dir+'/assoc_rule_overview.md', 'w+')
-    md.write("# Listing of rules found by association rule analysis\n")
-    md.write("\n")
-    md.write("This list is sorted by descending support and confidence values.\n")
-    md.write("\n")
-    md.flush()
 
-    print("Calculate association rule analysis")
-    annotated_rules = analyse_rule_set(sorted_rule_list, max_depth=None)
+def coverage_stage(data, rule_list, max_depth=None):
+    """
+    Data-grounded alternative to `analyse_stage`: support is the fraction of
+    samples covered by a rule, confidence the fraction of them with the rule's
+    target (see `rule_coverage.CoverageEngine`).
+    Collapsed duplicate rows are counted once.
+    """
+    X, Y, _ = data
+    engine = CoverageEngine.from_rules(rule_list, X, Y)
+    annotated = engine.annotate(rule_list, max_depth=max_depth)
+    for rule in annotated:
+        rule[2] /= engine.n_samples
+    return annotated
 
-    print("Save data to file")
+
+def report_stage(importances, annotated_rules, target_dir='./'):
     dat = open(target_dir+'/assoc_rules.dat', 'wb')
     pickle.dump(annotated_rules, dat)
     dat.close()
 
-    seen = set([])
-    for (cond, out, supp, conf) in sorted(annotated_rules, key=lambda r: (1/(r[2]+1), 1/(r[3]+1))):
-        if not frozenset(cond) in seen:
-            seen.add(frozenset(cond))
-            pretty_print_assoc_rule((cond, out), permutation_importance.importances_mean, md)
-            md.write('Support: %.2f%%, Confidence: %.2f\n\n' % (supp*100, conf))
-    md.close()
+    written = write_report(annotated_rules, target_dir+'/assoc_rule_overview.md',
+                           importances, fmt='md', support_total=1)
+    write_report(annotated_rules, target_dir+'/assoc_rules.csv', fmt='csv')
+    return written
+
+
+def analysis_pipeline(csv_file_path, target_dir='./', instr=None, cache_dir=None,
+                      permutation=False, max_depth=None, collapse=False, layout='frame',
+                      prune=False, support='rules', shap=False, filter_threshold=None,
+                      analysis='kernels'):
+    """
+    Builds the stage graph of the analysis.
+    Stage outputs are memoized in `cache_dir` (default: `target_dir/cache`),
+    so a rerun only recomputes the stages whose code, parameters,
+    or inputs changed.
+    With `collapse`, duplicate samples (e.g. of an `_all` file) are trained
+    as weighted unique rows.
+    `layout` selects the training matrix (see `datasets.training_matrix`),
+    e.g. `'auto'` for float32 CSR on sparse data.
+    With `prune`, the rules are shortened by inTrees pruning before the
+    support and confidence calculation.
+    `support='data'` counts support and confidence over the samples instead
+    of over the other rules.
+    With `shap`, the report ranks the features by mean absolute TreeSHAP value.
+    With a `filter_threshold`, the forest is trained without the constant
+    features and the features correlating at least that much with a more
+    informative one (see `feature_filter`); rules and importances are mapped
+    back to the original feature ids.
+    `analysis` selects the implementation of the rule based support
+    (see `analyse_stage`).
+    """
+    pipe = Pipeline(cache_dir or target_dir+'/cache', instr)
+    pipe.add('load', load_stage, params={'csv_file_path': str(csv_file_path),
+                                         'source': file_fingerprint(csv_file_path),
+                                         'collapse': collapse, 'layout': layout},
+             count=lambda data: data[0].shape[0], unit='samples')
+    data = 'load'
+    if filter_threshold is not None:
+        pipe.add('filter', filter_stage, inputs=['load'], params={'threshold': filter_threshold},
+                 count=len, unit='features')
+        pipe.add('filtered', filtered_stage, inputs=['load', 'filter'], memoize=False)
+        data = 'filtered'
+    pipe.add('fit', fit_stage, inputs=[data], params={'forest_params': FOREST_PARAMS})
+    pipe.add('importances', importances_stage, inputs=[data, 'fit'],
+             params={'permutation': permutation, 'shap': shap})
+    pipe.add('extract', extract_stage, inputs=['fit'], count=len, unit='rules')
+    rules = 'extract'
+    importances = 'importances'
+    if filter_threshold is not None:
+        pipe.add('restore_rules', restore_rules_stage, inputs=['filter', 'extract'],
+                 count=len, unit='rules')
+        pipe.add('restore_importances', restore_importances_stage, inputs=['filter', 'importances'])
+        rules = 'restore_rules'
+        importances = 'restore_importances'
+    if prune:
+        pipe.add('prune', prune_stage, inputs=['load', rules], count=len, unit='rules')
+        rules = 'prune'
+    if support == 'data':
+        pipe.add('analyse', coverage_stage, inputs=['load', rules], params={'max_depth': max_depth},
+                 count=len, unit='rules')
+    else:
+        pipe.add('analyse', analyse_stage, inputs=[rules], params={'max_depth': max_depth},
+                 context={'analysis': analysis, 'instr': instr}, count=len, unit='rules')
+    pipe.add('report', report_stage, inputs=[importances, 'analyse'],
+             params={'target_dir': target_dir}, memoize=False, count=lambda written: written,
+             unit='rules')
+    return pipe
+
+
+def run_analysis(csv_file_path, target_dir='./', instr=None, cache_dir=None, collapse=False,
+                 layout='frame', prune=False, support='rules', shap=False, filter_threshold=None,
+                 analysis='kernels'):
+    if instr is None:
+        instr = Instrumentation(Path(csv_file_path).stem)
+    analysis_pipeline(csv_file_path, target_dir, instr, cache_dir, collapse=collapse,
+                      layout=layout, prune=prune, support=support, shap=shap,
+                      filter_threshold=filter_threshold, analysis=analysis).run()
+    instr.write_summary(target_dir+'/instrumentation.json')
 
 if __name__ == "__main__":
     source = sys.argv[1]
     tar = sys.argv[2]
+    collapse = '--collapse' in sys.argv[3:] # Train on weighted unique rows.
+    layout = 'auto' if '--float32' in sys.argv[3:] else 'frame' # float32 dense/CSR input.
+    prune = '--prune' in sys.argv[3:] # inTrees pruning before the analysis.
+    shap = '--shap' in sys.argv[3:] # Rank features by mean |SHAP| instead of Gini.
+    support = 'data' if '--data-support' in sys.argv[3:] else 'rules' # Count over samples.
+    filter_threshold = FILTER_THRESHOLD if '--filter' in sys.argv[3:] else None # Drop redundant features.
+    analysis = 'trie' if '--trie' in sys.argv[3:] else 'kernels' # Rule analysis on the prefix trie.
     Path(tar).mkdir(parents=True, exist_ok=True)
     print("Running for %s, data output to %s" % (source, tar))
-    run_analysis(source, tar)
+    run_analysis(source, tar, collapse=collapse, layout=layout, prune=prune, support=support,
+                 shap=shap, filter_threshold=filter_threshold, analysis=analysis)
@@ -0,0 +1,204 @@
+"""
+Low-latency prediction with a trained forest, e.g. to choose the backend for
+a single predicate at solve time.
+
+`export_forest` flattens all trees of a fitted `RandomForestClassifier` into a
+few NumPy arrays stored with `np.savez`:
+
+* nodes are renumbered per tree in breadth-first order, so that the children
+  of an inner node are adjacent (`right = left + 1`) and only `left` is stored,
+* leaves point to themselves and have the threshold `+inf`, so a fixed number
+  of steps `node = left[node] + (x[feature[node]] > threshold[node])`
+  advances all trees in lockstep without branching (the walk stops early
+  once all trees reached a leaf),
+* leaf values are normalised to class probabilities.
+
+`CompiledForest.load` only needs NumPy, Scikit-Learn is not imported.
+`predict_proba` walks all trees of a sample (or a small batch) at once,
+its result equals `forest.predict_proba` (see `check_compiled`).
+
+Usage:
+
+    export_forest(forest, 'prob-f109.npz')
+    model = CompiledForest.load('prob-f109.npz')
+    model.predict_proba(x)  # x: one feature vector or a batch
+
+    python compiled_forest.py data/2020-01-23/prob-f109-lto_unique.csv prob-f109.npz
+"""
+import time
+
+import numpy as np
+
+CHECK_STEPS = 4 # Steps between checks whether all trees reached a leaf.
+
+
+def flatten_tree(tree_):
+    """
+    Returns the arrays `(left, feature, threshold, value)` of a single tree
+    (a fitted `tree_` object) in breadth-first order, with adjacent siblings,
+    self-looping leaves and normalised leaf values, followed by its depth.
+    """
+    children_left = tree_.children_left
+    children_right = tree_.children_right
+    order = [0]
+    left = [0]
+    i = 0
+    while i < len(order):
+        node = order[i]
+        if children_left[node] == children_right[node]: # Leaf
+            left[i] = i
+        else:
+            left[i] = len(order)
+            order += [children_left[node], children_right[node]]
+            left += [0, 0]
+        i += 1
+
+    order = np.array(order)
+    is_leaf = children_left[order] == children_right[order]
+    feature = np.where(is_leaf, 0, tree_.feature[order]).astype(np.int32)
+    threshold = np.where(is_leaf, np.inf, tree_.threshold[order])
+    value = tree_.value[order, 0, :]
+    value = value / np.maximum(value.sum(axis=1, keepdims=True), 1e-300)
+    return np.array(left, dtype=np.int32), feature, threshold, value, int(tree_.max_depth)
+
+
+def export_forest(forest, path=None):
+    """
+    Flattens a fitted forest into the arrays of a `CompiledForest`.
+    The arrays are stored in `path` (`.npz`) if given.
+    Returns the `CompiledForest`.
+    """
+    lefts, features, thresholds, values, roots = [], [], [], [], []
+    depth = 0
+    offset = 0
+    for estimator in forest.estimators_:
+        left, feature, threshold, value, tree_depth = flatten_tree(estimator.tree_)
+        roots.append(offset)
+        lefts.append(left + offset)
+        features.append(feature)
+        thresholds.append(threshold)
+        values.append(value)
+        depth = max(depth, tree_depth)
+        offset += len(left)
+
+    arrays = dict(
+        left=np.concatenate(lefts),
+        feature=np.concatenate(features),
+        threshold=np.concatenate(thresholds),
+        value=np.concatenate(values),
+        roots=np.array(roots, dtype=np.int32),
+        classes=np.asarray(forest.classes_),
+        depth=np.array(depth),
+        n_features=np.array(forest.n_features_in_))
+    if path is not None:
+        np.savez(path, **arrays)
+    return CompiledForest(**arrays)
+
+
+class CompiledForest:
+    "Flattened forest, see `export_forest`."
+
+    def __init__(self, left, feature, threshold, value, roots, classes, depth, n_features):
+        self.left = np.ascontiguousarray(left, dtype=np.intp)
+        self.feature = np.ascontiguousarray(feature, dtype=np.intp)
+        self.threshold = np.ascontiguousarray(threshold, dtype=np.float64)
+        self.value = np.ascontiguousarray(value, dtype=np.float64)
+        self.roots = np.ascontiguousarray(roots, dtype=np.intp)
+        self.classes = np.asarray(classes)
+        self.depth = int(depth)
+        self.n_features = int(n_features)
+        self.n_trees = len(self.roots)
+
+    @staticmethod
+    def load(path):
+        with np.load(path) as arrays:
+            return CompiledForest(**{name: arrays[name] for name in arrays.files})
+
+    def leaves(self, X):
+        "Returns the leaf reached in each tree, as (samples x trees) array."
+        # Scikit-Learn compares float32 feature values against the thresholds.
+        X = np.asarray(X, dtype=np.float32).astype(np.float64)
+        nodes = np.broadcast_to(self.roots, (len(X), self.n_trees))
+        rows = np.arange(len(X))[:, None] * X.shape[1]
+        flat = X.ravel()
+        left, feature, threshold = self.left, self.feature, self.threshold
+        for step in range(1, self.depth + 1):
+            nodes = left[nodes] + (flat[rows + feature[nodes]] > threshold[nodes])
+            if step % CHECK_STEPS == 0 and (left[nodes] == nodes).all():
+                break
+        return nodes
+
+    def leaves_single(self, x):
+        "Returns the leaf reached in each tree for one feature vector."
+        x = np.asarray(x, dtype=np.float32).astype(np.float64)
+        nodes = self.roots
+        left, feature, threshold = self.left, self.feature, self.threshold
+        for step in range(1, self.depth + 1):
+            nodes = left[nodes] + (x[feature[nodes]] > threshold[nodes])
+            if step % CHECK_STEPS == 0 and (left[nodes] == nodes).all():
+                break
+        return nodes
+
+    def predict_proba(self, X):
+        """
+        Class probabilities (mean of the trees' leaf distributions), in the
+        order of `classes`. A single feature vector yields a 1D array.
+        """
+        X = np.asarray(X)
+        if X.ndim == 1:
+            return self.value[self.leaves_single(X)].mean(axis=0)
+        return self.value[self.leaves(X)].mean(axis=1)
+
+    def predict(self, X):
+        proba = self.predict_proba(X)
+        return self.classes[np.argmax(proba, axis=-1)]
+
+
+def check_compiled(forest, model, X, atol=1e-12):
+    "Verifies that `model` reproduces `forest.predict_proba` on `X`."
+    expected = forest.predict_proba(X)
+    actual = model.predict_proba(np.asarray(X))
+    single = np.array([model.predict_proba(x) for x in np.asarray(X)[:100]])
+    return bool(np.allclose(actual, expected, rtol=0, atol=atol)
+                and np.allclose(single, expected[:100], rtol=0, atol=atol))
+
+
+def time_per_call(func, x, repeat=2000):
+    "Median duration of `func(x)` in seconds."
+    durations = np.empty(repeat)
+    for i in range(repeat):
+        start = time.perf_counter()
+        func(x)
+        durations[i] = time.perf_counter() - start
+    return float(np.median(durations))
+
+
+if __name__ == "__main__":
+    import argparse
+    from sklearn.ensemble import RandomForestClassifier
+    from cluster_analysis import FOREST_PARAMS
+    from datasets import load_dataset
+
+    parser = argparse.ArgumentParser(description="Export a forest for low-latency prediction and time it.")
+    parser.add_argument('csv_file')
+    parser.add_argument('output', help="Exported model (.npz)")
+    parser.add_argument('--n-features', type=int, default=109)
+    args = parser.parse_args()
+
+    X, Y = load_dataset(args.csv_file, args.n_features)
+    X = X.to_numpy()
+    forest = RandomForestClassifier(n_jobs=6, **FOREST_PARAMS).fit(X, Y)
+    export_forest(forest, args.output)
+    model = CompiledForest.load(args.output)
+    print("Trees: %d, nodes: %d, depth: %d" % (model.n_trees, len(model.left), model.depth))
+    print("Matches predict_proba: %s" % check_compiled(forest, model, X))
+
+    forest.set_params(n_jobs=1)
+    x = X[:1]
+    print("Single sample: sklearn %.1f us, compiled %.1f us"
+          % (time_per_call(forest.predict_proba, x, 200) * 1e6,
+             time_per_call(model.predict_proba, X[0]) * 1e6))
+    batch = X[:16]
+    print("Batch of 16: sklearn %.1f us, compiled %.1f us"
+          % (time_per_call(forest.predict_proba, batch, 200) * 1e6,
+             time_per_call(model.predict_proba, batch) * 1e6))
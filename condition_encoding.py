@@ -0,0 +1,163 @@
+"""
+Canonical integer encoding of association rule conditions.
+
+An item `(feature_id, leq)` (feature low, resp. high if `leq` is false) is
+encoded as the small integer `2*feature_id + leq`. A condition set is the
+sorted array of its distinct item codes, identified by a 64 bit fingerprint:
+the wrapping sum of the splitmix64-scrambled codes, which does not depend on
+the order of the items and can be computed for all rules at once.
+
+`RuleCodes` holds the encoded conditions of a rule list, produced once after
+the extraction, in CSR form: rule `i` consists of the codes
+`items[offsets[i]:offsets[i+1]]`. With a `max_depth`, the codes of the first
+`max_depth` conditions of each rule (as `intrees.association_rule_cond`) are
+kept as query codes as well.
+Analyses compare the code sets (or the bitsets derived from them),
+reports and the gather script identify condition sets by their fingerprints.
+
+Usage:
+
+    codes = RuleCodes.from_rules(sorted_rules, max_depth=10)
+    codes.fingerprints      # int64 per rule
+    codes.sets()            # frozensets of item codes, for subset tests
+    codes.bitsets(query=True)
+    cond_fingerprint({(18, False), (3, True)})
+"""
+import numpy as np
+
+
+def item_code(fid, leq):
+    "Code of the association rule item `(fid, leq)`."
+    return 2*int(fid) + (1 if leq else 0)
+
+
+def decode_item(code):
+    "Item `(feature_id, leq)` of a code."
+    return (int(code) >> 1, bool(code & 1))
+
+
+def cond_codes(cond, max_depth=None):
+    """
+    Sorted tuple of the distinct item codes of a condition, given as rule
+    condition (tuples `(node_id, feature_id, threshold, leq)`, of which the
+    first `max_depth` are used) or as set of `(feature_id, leq)` items.
+    """
+    if max_depth is not None:
+        cond = cond[:max(max_depth, 1)] # As `association_rule_cond`.
+    return tuple(sorted(set(item_code(c[-3], c[-1]) if len(c) == 4 else item_code(*c)
+                            for c in cond)))
+
+
+def decode_cond(codes):
+    "Condition set of `(feature_id, leq)` items of a code sequence."
+    return {decode_item(c) for c in codes}
+
+
+def splitmix64(x):
+    "Scrambles 64 bit integers (array of `uint64`)."
+    x = x + np.uint64(0x9E3779B97F4A7C15)
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+def itemset_fingerprints(offsets, items):
+    """
+    Order independent 64 bit fingerprints of the item sets
+    `items[offsets[i]:offsets[i+1]]` (sum of the scrambled item codes).
+    """
+    hashed = splitmix64(np.asarray(items, dtype=np.uint64))
+    cumulative = np.zeros(len(hashed) + 1, dtype=np.uint64)
+    np.cumsum(hashed, out=cumulative[1:])
+    offsets = np.asarray(offsets)
+    return (cumulative[offsets[1:]] - cumulative[offsets[:-1]]).view(np.int64)
+
+
+def cond_fingerprint(cond):
+    "Fingerprint (Python int) of a single condition, see `cond_codes`."
+    codes = cond_codes(cond)
+    return int(itemset_fingerprints([0, len(codes)], codes)[0])
+
+
+def encode_conds(conds, max_depth=None):
+    """
+    CSR encoding of a sequence of conditions (see `cond_codes`).
+    Returns `(offsets, items)` with the codes of each condition sorted.
+    """
+    encoded = [cond_codes(cond, max_depth) for cond in conds]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(codes) for codes in encoded], out=offsets[1:])
+    items = np.fromiter((c for codes in encoded for c in codes), dtype=np.int32,
+                        count=int(offsets[-1]))
+    return offsets, items
+
+
+class RuleCodes:
+    """
+    Encoded conditions and targets of a rule list, see the module
+    documentation. Without a `max_depth`, the query codes are the full codes.
+    """
+
+    def __init__(self, offsets, items, targets, query_offsets=None, query_items=None):
+        self.offsets = offsets
+        self.items = items
+        self.targets = np.asarray(targets, dtype=np.int64)
+        self.query_offsets = offsets if query_offsets is None else query_offsets
+        self.query_items = items if query_items is None else query_items
+        self._fingerprints = None
+
+    @classmethod
+    def from_rules(cls, rule_list, max_depth=None):
+        "Encodes extracted rules `(cond, target)`."
+        offsets, items = encode_conds([cond for (cond, _) in rule_list])
+        query_offsets = query_items = None
+        if max_depth is not None:
+            query_offsets, query_items = encode_conds([cond for (cond, _) in rule_list], max_depth)
+        return cls(offsets, items, [target for (_, target) in rule_list], query_offsets, query_items)
+
+    @classmethod
+    def from_annotated(cls, annotated_rules):
+        "Encodes annotated rules `[cond, target, ...]` with `(feature_id, leq)` conditions."
+        offsets, items = encode_conds([r[0] for r in annotated_rules])
+        return cls(offsets, items, [r[1] for r in annotated_rules])
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def fingerprints(self):
+        "Fingerprints of the full condition sets."
+        if self._fingerprints is None:
+            self._fingerprints = itemset_fingerprints(self.offsets, self.items)
+        return self._fingerprints
+
+    def codes(self, i, query=False):
+        "Sorted codes of rule `i` (of its query condition if `query` is set)."
+        if query:
+            return self.query_items[self.query_offsets[i]:self.query_offsets[i + 1]]
+        return self.items[self.offsets[i]:self.offsets[i + 1]]
+
+    def cond(self, i, query=False):
+        "Condition set of rule `i` as `(feature_id, leq)` items."
+        return decode_cond(self.codes(i, query).tolist())
+
+    def sets(self, query=False):
+        "Frozensets of the codes of all rules."
+        offsets, items = (self.query_offsets, self.query_items) if query else (self.offsets, self.items)
+        items = items.tolist()
+        return [frozenset(items[offsets[i]:offsets[i + 1]]) for i in range(len(self))]
+
+    @property
+    def n_words(self):
+        "Number of 64 bit words needed for the bitsets."
+        return int(self.items.max()) // 64 + 1 if len(self.items) else 1
+
+    def bitsets(self, query=False, n_words=None):
+        "Codes of all rules as rows of 64 bit words (bit `c` set for code `c`)."
+        offsets, items = (self.query_offsets, self.query_items) if query else (self.offsets, self.items)
+        n_words = n_words or self.n_words
+        bits = np.zeros((len(self), n_words), dtype=np.uint64)
+        rows = np.repeat(np.arange(len(self)), np.diff(offsets))
+        words = (items >> 6).astype(np.int64)
+        np.bitwise_or.at(bits, (rows, words), np.left_shift(np.uint64(1), (items & 63).astype(np.uint64)))
+        return bits
@@ -0,0 +1,146 @@
+"""
+Stratified k-fold evaluation of the analysis forest.
+
+The folds are trained in parallel processes, which all memory-map the same
+cached feature matrix (see `datasets.cache_dataset`).
+Each fold computes its metrics from a single prediction pass over its test
+split and, optionally, extracts the association rule conditions of its
+forest. Comparing these between folds shows how stable the extracted rules
+are with respect to the training data.
+
+Usage:
+
+    python cross_validation.py data/2020-01-23/prob-f109-lto_unique.csv cv-out \
+        --folds 5 --rules --max-depth 10 --cpus 20 --job-cpus 4
+"""
+import argparse
+import itertools
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from cluster_analysis import FOREST_PARAMS
+from datasets import cache_dataset, load_cached_dataset
+from printing import classifier_metrics
+from condition_encoding import cond_fingerprint
+from reporting import condition_string
+
+
+def run_fold(fold, x_path, y_path, train_idx, test_idx, n_jobs=1, forest_params=FOREST_PARAMS,
+             extract=False, max_depth=None):
+    """
+    Trains and evaluates a single fold.
+    Returns a tuple `(metrics, rules)` where `rules` maps
+    `(fingerprint, target)` of each distinct association rule of the fold's
+    forest to its condition set (or is `None` unless `extract` is set).
+    """
+    from sklearn.ensemble import RandomForestClassifier
+    from intrees import extract_rules, rule_to_assoc_rule
+
+    X, Y = load_cached_dataset(x_path, y_path)
+    forest = RandomForestClassifier(n_jobs=n_jobs, **forest_params)
+    forest.fit(X[train_idx], Y[train_idx])
+    pred = forest.predict(X[test_idx])
+
+    metrics = {'fold': fold, 'train_samples': len(train_idx), 'test_samples': len(test_idx)}
+    metrics.update(classifier_metrics(Y[test_idx], pred))
+
+    rules = None
+    if extract:
+        rules = {}
+        extracted = extract_rules(forest)
+        for tree in extracted:
+            for rule in extracted[tree]:
+                cond, target = rule_to_assoc_rule(rule, max_depth)
+                rules.setdefault((cond_fingerprint(cond), target), cond)
+        metrics['rules'] = len(rules)
+    return metrics, rules
+
+
+def rule_stability(fold_rules):
+    """
+    Compares the rule sets of the folds.
+    Returns the matrix of pairwise Jaccard similarities and a DataFrame listing
+    each rule with the number of folds in which it occurs.
+    """
+    keys = [set(rules) for rules in fold_rules]
+    k = len(keys)
+    jaccard = np.eye(k)
+    for i, j in itertools.combinations(range(k), 2):
+        union = len(keys[i] | keys[j])
+        jaccard[i, j] = jaccard[j, i] = len(keys[i] & keys[j]) / union if union else 1.0
+
+    counts = {}
+    conds = {}
+    for rules in fold_rules:
+        for key, cond in rules.items():
+            counts[key] = counts.get(key, 0) + 1
+            conds.setdefault(key, cond)
+    frame = pd.DataFrame({
+        'conditions': [condition_string(conds[key]) for key in counts],
+        'length': [len(conds[key]) for key in counts],
+        'target': [key[1] for key in counts],
+        'folds': list(counts.values()),
+    })
+    return jaccard, frame.sort_values(['folds', 'length'], ascending=[False, True], kind='stable')
+
+
+def cross_validate(csv_file_path, n_features=109, folds=5, cpus=None, job_cpus=1,
+                   extract=False, max_depth=None, random_state=1234, cache_dir=None):
+    """
+    Runs a stratified k-fold evaluation.
+    Returns the DataFrame of per-fold metrics and, if `extract` is set,
+    the result of `rule_stability` (otherwise `None`).
+    """
+    from sklearn.model_selection import StratifiedKFold
+
+    cpus = cpus or os.cpu_count()
+    cache_dir = cache_dir or tempfile.mkdtemp(prefix='cross-validation-')
+    x_path, y_path = cache_dataset(csv_file_path, n_features, cache_dir)
+    X, Y = load_cached_dataset(x_path, y_path)
+
+    splitter = StratifiedKFold(n_splits=folds, shuffle=True, random_state=random_state)
+    splits = list(splitter.split(np.zeros(len(Y)), Y))
+    workers = max(1, min(folds, cpus // job_cpus))
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(run_fold, fold, x_path, y_path, train_idx, test_idx, job_cpus,
+                               FOREST_PARAMS, extract, max_depth)
+                   for fold, (train_idx, test_idx) in enumerate(splits)]
+        results = [future.result() for future in futures]
+
+    metrics = pd.DataFrame([m for (m, _) in results])
+    stability = rule_stability([r for (_, r) in results]) if extract else None
+    return metrics, stability
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Parallel k-fold evaluation with fold-wise rule extraction.")
+    parser.add_argument('csv_file')
+    parser.add_argument('target_dir')
+    parser.add_argument('--n-features', type=int, default=109)
+    parser.add_argument('--folds', type=int, default=5)
+    parser.add_argument('--cpus', type=int, default=None, help="Total CPU budget (default: all)")
+    parser.add_argument('--job-cpus', type=int, default=1, help="CPUs per fold")
+    parser.add_argument('--rules', action='store_true', help="Extract rules per fold")
+    parser.add_argument('--max-depth', type=int, default=None)
+    args = parser.parse_args()
+
+    target_dir = Path(args.target_dir)
+    target_dir.mkdir(parents=True, exist_ok=True)
+    metrics, stability = cross_validate(args.csv_file, args.n_features, args.folds, args.cpus,
+                                        args.job_cpus, args.rules, args.max_depth,
+                                        cache_dir=target_dir / 'cache')
+    metrics.to_csv(target_dir / 'fold_metrics.csv', index=False)
+    print(metrics.to_string(index=False))
+    print(metrics.drop(columns='fold').agg(['mean', 'std']).to_string())
+    if stability is not None:
+        jaccard, rules = stability
+        np.savetxt(target_dir / 'rule_jaccard.csv', jaccard, delimiter=',', fmt='%.4f')
+        rules.to_csv(target_dir / 'rule_stability.csv', index=False)
+        upper = jaccard[np.triu_indices(len(jaccard), 1)]
+        print("Mean pairwise Jaccard similarity of fold rule sets: %.3f" % upper.mean())
+        print("Rules found in all folds: %d of %d" % ((rules['folds'] == args.folds).sum(), len(rules)))
@@ -0,0 +1,183 @@
+"""
+Locating and loading the data sets shipped in the `data` directory.
+
+Each data directory contains CSV files named
+`<backend>-<feature set>[-lto]_<suffix>.csv`,
+e.g. `data/2020-01-23/prob-f109-lto_unique.csv`.
+The first columns hold the features, the label is stored in `Label0`
+(1 if the backend found an answer, 0 if it returned unknown).
+"""
+from collections import namedtuple
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import f109_info
+import f275_info
+
+BACKENDS = ['prob', 'kodkod', 'z3']
+
+FeatureSet = namedtuple('FeatureSet', ['name', 'n_features', 'feature_name', 'category'])
+
+
+def generic_feature_name(index):
+    "Returns a placeholder name for feature sets without descriptions."
+    return "Feature%d" % index
+
+
+def generic_category(index):
+    return "Unknown"
+
+
+FEATURE_SETS = {
+    'f17': FeatureSet('f17', 17, generic_feature_name, generic_category),
+    'f109': FeatureSet('f109', 109, f109_info.f109_name, f109_info.f109_category),
+    'f185': FeatureSet('f185', 185, generic_feature_name, generic_category),
+    'f275': FeatureSet('f275', 275, f275_info.f275_name, f275_info.f275_category),
+}
+
+# Data collections whose file names carry an additional tag.
+DATE_TAGS = {
+    '2020-01-23': '-lto', # Higher timeout (25 sec)
+}
+
+
+def dataset_path(backend, feature_set, date, data_dir='data', suffix='unique'):
+    """
+    Returns the path of the CSV file for the given backend,
+    feature set (e.g. `f109`) and data collection date.
+    """
+    tag = DATE_TAGS.get(date, '')
+    return Path(data_dir) / date / ("%s-%s%s_%s.csv" % (backend, feature_set, tag, suffix))
+
+
+def load_dataset(path, n_features, label="Label0"):
+    """
+    Loads a CSV data set.
+    Returns the feature DataFrame `X` and the label Series `Y`.
+    """
+    data = pd.read_csv(path)
+    X = data[data.columns[0:n_features]]
+    Y = data[label]
+    return X, Y
+
+
+def cache_dataset(path, n_features, cache_dir, label="Label0"):
+    """
+    Stores the features and labels of a CSV data set as `.npy` files in
+    `cache_dir`, unless they already exist and are newer than the CSV file.
+    Returns the paths of the feature and label arrays.
+    """
+    path = Path(path)
+    cache_dir = Path(cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    x_path = cache_dir / (path.stem + "-X.npy")
+    y_path = cache_dir / (path.stem + "-Y.npy")
+    mtime = path.stat().st_mtime
+    if not (x_path.exists() and y_path.exists() and x_path.stat().st_mtime >= mtime):
+        X, Y = load_dataset(path, n_features, label)
+        np.save(y_path, Y.to_numpy())
+        np.save(x_path, np.ascontiguousarray(X.to_numpy(dtype=np.float64)))
+    return x_path, y_path
+
+
+def load_cached_dataset(x_path, y_path):
+    """
+    Memory-maps a data set stored by `cache_dataset`.
+    The pages are shared between all processes reading the same files.
+    """
+    return np.load(x_path, mmap_mode='r'), np.load(y_path)
+
+
+def collapse_duplicates(X, Y):
+    """
+    Collapses duplicate samples into unique rows with per-label counts.
+    Rows are identified by a 64 bit hash of their feature values;
+    hash collisions are detected and resolved by an exact comparison.
+    A feature vector occurring with both labels yields one row per label.
+
+    Returns `(X_unique, Y_unique, counts)` in order of first occurrence,
+    where `counts` is meant to be passed as `sample_weight`
+    (see `balanced_sample_weight` to emulate `class_weight="balanced"`).
+    """
+    X = pd.DataFrame(X)
+    labels = np.asarray(Y)
+    row_hash = pd.util.hash_pandas_object(X, index=False).to_numpy()
+    keys = np.empty(len(X), dtype=[('row', np.uint64), ('label', labels.dtype)])
+    keys['row'] = row_hash
+    keys['label'] = labels
+    _, first, inverse, counts = np.unique(keys, return_index=True, return_inverse=True,
+                                          return_counts=True)
+
+    values = X.to_numpy()
+    if not (values == values[first[inverse]]).all():
+        # Hash collision: fall back to comparing the raw rows.
+        raw = np.ascontiguousarray(np.column_stack([values, labels]))
+        raw = raw.view(np.dtype((np.void, raw.dtype.itemsize * raw.shape[1]))).ravel()
+        _, first, counts = np.unique(raw, return_index=True, return_counts=True)
+
+    order = np.argsort(first, kind='stable') # Keep the order of the data file.
+    first = first[order]
+    Y_unique = Y.iloc[first] if isinstance(Y, pd.Series) else labels[first]
+    return X.iloc[first], Y_unique, counts[order].astype(np.float64)
+
+
+def balanced_sample_weight(Y, counts):
+    """
+    Returns sample weights for collapsed data which correspond to
+    `class_weight="balanced"` on the original (non-collapsed) data:
+    each row's count times `n_samples / (n_classes * n_samples_of_its_class)`.
+    Use with `class_weight=None`.
+    """
+    labels = np.asarray(Y)
+    classes = np.unique(labels)
+    total = counts.sum()
+    class_totals = np.array([counts[labels == c].sum() for c in classes])
+    class_weight = total / (len(classes) * class_totals)
+    return counts * class_weight[np.searchsorted(classes, labels)]
+
+
+def load_collapsed_dataset(path, n_features, label="Label0"):
+    """
+    Loads a CSV data set (typically an `_all` file) and collapses its duplicate
+    rows, see `collapse_duplicates`.
+    Returns `(X, Y, counts)`.
+    """
+    X, Y = load_dataset(path, n_features, label)
+    return collapse_duplicates(X, Y)
+
+
+def training_matrix(X, layout='auto', density_threshold=0.05):
+    """
+    Converts the features into the matrix fed to the forest.
+    Trees split on float32 values internally, so float32 loses nothing.
+
+    * `layout='sparse'`: float32 CSR matrix,
+    * `layout='dense'`: C-contiguous float32 array,
+    * `layout='auto'`: CSR if at most `density_threshold` of the values are
+      non-zero, dense otherwise (Scikit-Learn's sparse splitter only pays off
+      for very sparse data, see `bench_sparse.py`),
+    * `layout='frame'`: the input unchanged.
+    """
+    if layout == 'frame':
+        return X
+    values = np.asarray(X, dtype=np.float32)
+    if layout == 'auto':
+        density = np.count_nonzero(values) / max(values.size, 1)
+        layout = 'sparse' if density <= density_threshold else 'dense'
+    if layout == 'sparse':
+        from scipy import sparse
+        return sparse.csr_matrix(values)
+    if layout == 'dense':
+        return np.ascontiguousarray(values)
+    raise ValueError("Unknown matrix layout: %s" % layout)
+
+
+def matrix_nbytes(X):
+    "Memory held by a DataFrame, array or sparse matrix in bytes."
+    if isinstance(X, pd.DataFrame):
+        return int(X.memory_usage(index=False).sum())
+    if hasattr(X, 'indptr'):
+        return X.data.nbytes + X.indices.nbytes + X.indptr.nbytes
+    return np.asarray(X).nbytes
@@ -0,0 +1,268 @@
+"""
+Redundancy pre-filter for the feature sets.
+
+Many features of F185 and F275 are constant or (nearly) duplicates of other
+features (see the README: the unique filter removes about two thirds of the
+samples). Each of these columns is evaluated at every split of every tree and
+adds items to the rule analysis without adding information.
+
+`redundancy_filter` computes, in a single chunked pass over the samples,
+
+* the Pearson correlation of all feature pairs (from the accumulated
+  Gram matrix of the shifted chunks), and
+* the mutual information of each feature with the label (from quantile bins,
+  counted with one `bincount` per chunk),
+
+drops the constant features and, among features whose absolute correlation
+reaches `threshold`, keeps the one with the highest mutual information.
+The returned `FeatureFilter` selects the kept columns and maps the ids of the
+filtered data back to the original feature ids, so rules and importances
+can be reported with `f275_name` as before:
+
+    feature_filter = redundancy_filter(X, Y, threshold=0.98)
+    forest.fit(feature_filter.select(X), Y)
+    rules = feature_filter.restore_rules(extract_stage(forest))     # original ids
+    feature_filter.feature_name(f275_name)(0)                       # name of kept column 0
+
+`python feature_filter.py data.csv --n-features 275` compares the fit and
+rule analysis times with and without the filter.
+"""
+import argparse
+import time
+
+import numpy as np
+
+CHUNK_ROWS = 65536
+FILTER_THRESHOLD = 0.98
+
+
+def row_chunks(X, chunk_size=CHUNK_ROWS):
+    "Yields the rows of `X` (DataFrame, array or sparse matrix) as float64 arrays."
+    for start in range(0, X.shape[0], chunk_size):
+        if hasattr(X, 'iloc'):
+            chunk = X.iloc[start:start+chunk_size].to_numpy(dtype=np.float64)
+        else:
+            chunk = X[start:start+chunk_size]
+            chunk = chunk.toarray() if hasattr(chunk, 'toarray') else chunk
+        yield start, np.asarray(chunk, dtype=np.float64)
+
+
+def correlation_matrix(X, sample_weight=None, chunk_size=CHUNK_ROWS):
+    """
+    Pearson correlations of the columns of `X` and their standard deviations,
+    accumulated over row chunks. The chunks are shifted by the means of the
+    first chunk to avoid cancellation. Constant columns have correlation 0.
+    """
+    n_features = X.shape[1]
+    total = 0.0
+    sums = np.zeros(n_features)
+    gram = np.zeros((n_features, n_features))
+    shift = None
+    for start, chunk in row_chunks(X, chunk_size):
+        w = np.ones(len(chunk)) if sample_weight is None else \
+            np.asarray(sample_weight[start:start+len(chunk)], dtype=np.float64)
+        if shift is None:
+            shift = chunk.mean(axis=0)
+        chunk = chunk - shift
+        total += w.sum()
+        sums += w @ chunk
+        gram += (chunk * w[:, None]).T @ chunk
+    mean = sums / total
+    cov = gram / total - np.outer(mean, mean)
+    std = np.sqrt(np.clip(np.diag(cov), 0, None))
+    scale = np.where(std > 0, std, 1.0)
+    corr = cov / np.outer(scale, scale)
+    corr[std == 0] = 0
+    corr[:, std == 0] = 0
+    return np.clip(corr, -1, 1), std
+
+
+def quantile_edges(X, bins=16, sample_rows=CHUNK_ROWS):
+    "Inner bin edges per column (bins x features), from a strided row sample."
+    step = max(1, X.shape[0] // sample_rows)
+    if hasattr(X, 'iloc'):
+        sample = X.iloc[::step].to_numpy(dtype=np.float64)
+    else:
+        sample = X[::step]
+        sample = sample.toarray() if hasattr(sample, 'toarray') else np.asarray(sample, dtype=np.float64)
+    return np.quantile(sample, np.linspace(0, 1, bins + 1)[1:-1], axis=0)
+
+
+def mutual_information(X, Y, bins=16, sample_weight=None, chunk_size=CHUNK_ROWS):
+    """
+    Mutual information (in nats) between each column of `X`, discretised into
+    `bins` quantile bins, and the labels `Y`.
+    """
+    labels, y = np.unique(np.asarray(Y), return_inverse=True)
+    n_labels = len(labels)
+    n_features = X.shape[1]
+    edges = quantile_edges(X, bins)
+    counts = np.zeros(n_features * bins * n_labels)
+    offsets = np.arange(n_features) * bins * n_labels
+    for start, chunk in row_chunks(X, chunk_size):
+        chunk_y = y[start:start+len(chunk)]
+        binned = (chunk[:, :, None] > edges.T[None, :, :]).sum(axis=2)
+        codes = offsets[None, :] + binned * n_labels + chunk_y[:, None]
+        w = None if sample_weight is None else np.repeat(
+            np.asarray(sample_weight[start:start+len(chunk)], dtype=np.float64), n_features)
+        counts += np.bincount(codes.ravel(), weights=w, minlength=len(counts))
+    joint = counts.reshape(n_features, bins, n_labels)
+    joint = joint / joint.sum(axis=(1, 2), keepdims=True)
+    p_bin = joint.sum(axis=2, keepdims=True)
+    p_label = joint.sum(axis=1, keepdims=True)
+    ratio = np.divide(joint, p_bin * p_label, out=np.ones_like(joint), where=joint > 0)
+    return (joint * np.log(ratio)).sum(axis=(1, 2))
+
+
+class FeatureFilter:
+    """
+    Result of `redundancy_filter`: the kept original feature ids (`kept`,
+    ascending, so column `i` of the filtered data is feature `kept[i]`),
+    the constant features, and for each dropped duplicate the kept feature
+    it correlates with.
+    """
+
+    def __init__(self, n_features, kept, constant, duplicates, mutual_info, threshold):
+        self.n_features = n_features
+        self.kept = np.asarray(kept, dtype=np.int64)
+        self.constant = list(constant)
+        self.duplicates = dict(duplicates) # dropped id -> (kept id, correlation)
+        self.mutual_info = mutual_info
+        self.threshold = threshold
+
+    def __len__(self):
+        return len(self.kept)
+
+    def select(self, X):
+        "The kept columns of `X` (DataFrame, array or sparse matrix)."
+        if hasattr(X, 'iloc'):
+            return X.iloc[:, self.kept]
+        return X[:, self.kept]
+
+    def original_id(self, index):
+        "Original feature id of column `index` of the filtered data."
+        return int(self.kept[index])
+
+    def feature_name(self, name):
+        "Wraps a naming function of the original ids (e.g. `f275_name`) for the filtered ids."
+        return lambda index: name(self.original_id(index))
+
+    def restore_rules(self, rule_list):
+        "Maps the feature ids of extracted rules `(cond, target)` back to the original ids."
+        kept = self.kept.tolist()
+        return [(tuple((node, kept[fid], thresh, leq) for (node, fid, thresh, leq) in cond), target)
+                for (cond, target) in rule_list]
+
+    def restore_importances(self, importances):
+        "Importances per original feature, zero for the dropped features."
+        restored = np.zeros(self.n_features)
+        restored[self.kept] = importances
+        return restored
+
+    def summary(self, feature_name=None):
+        "One row per original feature with its status and mutual information."
+        import pandas as pd
+
+        status = np.array(['kept'] * self.n_features, dtype=object)
+        status[self.constant] = 'constant'
+        partner = np.full(self.n_features, -1)
+        corr = np.full(self.n_features, np.nan)
+        for fid, (other, r) in self.duplicates.items():
+            status[fid] = 'duplicate'
+            partner[fid] = other
+            corr[fid] = r
+        frame = pd.DataFrame({'feature': np.arange(self.n_features), 'status': status,
+                              'duplicate_of': partner, 'correlation': corr,
+                              'mutual_info': self.mutual_info})
+        if feature_name is not None:
+            frame.insert(1, 'name', [feature_name(i) for i in range(self.n_features)])
+        return frame
+
+
+def redundancy_filter(X, Y, threshold=FILTER_THRESHOLD, bins=16, sample_weight=None,
+                      chunk_size=CHUNK_ROWS):
+    """
+    Finds the constant features and the features whose absolute correlation
+    with a more informative (higher mutual information with `Y`) kept feature
+    is at least `threshold`. Returns a `FeatureFilter`.
+    """
+    corr, std = correlation_matrix(X, sample_weight, chunk_size)
+    mutual_info = mutual_information(X, Y, bins, sample_weight, chunk_size)
+    n_features = X.shape[1]
+    constant = np.flatnonzero(std == 0).tolist()
+    order = np.lexsort((np.arange(n_features), -mutual_info)) # Most informative first.
+    kept, duplicates = [], {}
+    for fid in order:
+        if std[fid] == 0:
+            continue
+        if kept:
+            similar = np.abs(corr[fid, kept])
+            best = int(np.argmax(similar))
+            if similar[best] >= threshold:
+                duplicates[int(fid)] = (kept[best], float(corr[fid, kept[best]]))
+                continue
+        kept.append(int(fid))
+    return FeatureFilter(n_features, sorted(kept), constant, duplicates, mutual_info, threshold)
+
+
+def filter_speedup(X, Y, thresholds=(FILTER_THRESHOLD,), max_depth=None, forest_params=None,
+                   n_jobs=6):
+    """
+    Fits the forest and analyses its rules (as `cluster_analysis.analyse_stage`)
+    on all features and on the features kept at each threshold.
+    Returns a DataFrame with the times and the speedups over the unfiltered run.
+    """
+    import pandas as pd
+    from sklearn.ensemble import RandomForestClassifier
+    from cluster_analysis import FOREST_PARAMS, analyse_stage
+    from intrees import extract_rules
+
+    params = dict(FOREST_PARAMS if forest_params is None else forest_params, n_jobs=n_jobs)
+    rows = []
+    for threshold in (None,) + tuple(thresholds):
+        start = time.perf_counter()
+        feature_filter = None if threshold is None else redundancy_filter(X, Y, threshold)
+        filter_seconds = time.perf_counter() - start
+        data = X if feature_filter is None else feature_filter.select(X)
+
+        start = time.perf_counter()
+        forest = RandomForestClassifier(**params).fit(data, Y)
+        fit_seconds = time.perf_counter() - start
+        extracted = extract_rules(forest)
+        rules = [rule for tree in extracted for rule in extracted[tree]]
+        if feature_filter is not None:
+            rules = feature_filter.restore_rules(rules)
+
+        analyse_stage(rules[:10], max_depth) # Compiles the kernels outside the timing.
+        start = time.perf_counter()
+        analyse_stage(rules, max_depth)
+        analyse_seconds = time.perf_counter() - start
+        rows.append({'threshold': threshold, 'features': data.shape[1], 'filter_s': filter_seconds,
+                     'fit_s': fit_seconds, 'rules': len(rules), 'analyse_s': analyse_seconds})
+    frame = pd.DataFrame(rows)
+    frame['fit_speedup'] = frame['fit_s'][0] / frame['fit_s']
+    frame['analyse_speedup'] = frame['analyse_s'][0] / frame['analyse_s']
+    total = frame['filter_s'] + frame['fit_s'] + frame['analyse_s']
+    frame['total_speedup'] = total[0] / total
+    return frame
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Redundancy pre-filter of the features.")
+    parser.add_argument('csv_file')
+    parser.add_argument('--n-features', type=int, default=275)
+    parser.add_argument('--threshold', type=float, action='append', default=None,
+                        help="Correlation threshold (repeatable, default %.2f)" % FILTER_THRESHOLD)
+    parser.add_argument('--max-depth', type=int, default=None)
+    parser.add_argument('--summary', default=None, help="CSV file for the per-feature summary")
+    args = parser.parse_args()
+
+    from datasets import load_dataset
+    X, Y = load_dataset(args.csv_file, args.n_features)
+    thresholds = args.threshold or [FILTER_THRESHOLD]
+    if args.summary:
+        from datasets import FEATURE_SETS
+        names = {fs.n_features: fs.feature_name for fs in FEATURE_SETS.values()}
+        redundancy_filter(X, Y, thresholds[0]).summary(names.get(args.n_features)).to_csv(
+            args.summary, index=False)
+    print(filter_speedup(X, Y, thresholds, args.max_depth).to_string(index=False))
@@ -0,0 +1,145 @@
+"""
+Single pass, constant memory profiling of the feature data sets.
+
+The notebooks compute feature usage (`data[data > 0].count()`), relative usage
+and the per-label means (`data.groupby("Label0").mean()`) on the fully loaded
+DataFrame. `FeatureProfile` computes the same statistics (plus variances,
+minima and maxima) from chunks of a CSV file or of a cached `.npy` matrix
+(see `datasets.cache_dataset`), so it also works on data sets larger than
+the main memory.
+
+Means and variances are accumulated per label with the pairwise update of
+Chan et al., which is numerically stable across chunks.
+
+Usage:
+
+    profile = profile_csv('data/2020-01-23/prob-f109-lto_all.csv', 109)
+    profile.usage()        # like data[data > 0].count()
+    profile.label_means()  # like data.groupby("Label0").mean()
+
+For the F275 data of 2020-01-10, unused relative features may have the value
+1e-7 instead of 0 (see its README); pass `zero_threshold=1e-7` to count these
+as unused.
+"""
+import numpy as np
+import pandas as pd
+
+CHUNK_ROWS = 65536
+
+
+class FeatureProfile:
+    "Accumulated per-feature statistics, split by label."
+
+    def __init__(self, n_features, feature_names=None, zero_threshold=0.0, label="Label0"):
+        self.n_features = n_features
+        self.label = label
+        self.feature_names = feature_names or ["Feature%d" % i for i in range(n_features)]
+        self.zero_threshold = zero_threshold
+        self.labels = {} # label -> accumulator dictionary
+
+    def accumulator(self, label):
+        acc = self.labels.get(label)
+        if acc is None:
+            acc = {
+                'n': 0,
+                'uses': np.zeros(self.n_features, dtype=np.int64),
+                'mean': np.zeros(self.n_features),
+                'm2': np.zeros(self.n_features),
+                'min': np.full(self.n_features, np.inf),
+                'max': np.full(self.n_features, -np.inf),
+            }
+            self.labels[label] = acc
+        return acc
+
+    def update(self, X, Y):
+        "Adds a chunk of samples `X` (2D array) with labels `Y`."
+        X = np.asarray(X, dtype=np.float64)
+        Y = np.asarray(Y)
+        for label in np.unique(Y):
+            part = X[Y == label]
+            acc = self.accumulator(label.item())
+            n_b = len(part)
+            mean_b = part.mean(axis=0)
+            m2_b = ((part - mean_b)**2).sum(axis=0)
+            n_a = acc['n']
+            n = n_a + n_b
+            delta = mean_b - acc['mean']
+            acc['mean'] += delta * n_b / n
+            acc['m2'] += m2_b + delta**2 * n_a * n_b / n
+            acc['n'] = n
+            acc['uses'] += (part > self.zero_threshold).sum(axis=0)
+            np.minimum(acc['min'], part.min(axis=0), out=acc['min'])
+            np.maximum(acc['max'], part.max(axis=0), out=acc['max'])
+        return self
+
+    def sample_count(self):
+        return sum(acc['n'] for acc in self.labels.values())
+
+    def label_counts(self):
+        "Number of samples per label."
+        return pd.Series({label: acc['n'] for label, acc in sorted(self.labels.items())})
+
+    def usage(self):
+        "Number of samples using each feature (value above the zero threshold)."
+        uses = sum(acc['uses'] for acc in self.labels.values())
+        return pd.Series(uses, index=self.feature_names)
+
+    def relative_usage(self):
+        return self.usage() / self.sample_count()
+
+    def label_means(self):
+        "Per-label feature means, as `data.groupby(label).mean()`."
+        labels = sorted(self.labels)
+        return pd.DataFrame([self.labels[l]['mean'] for l in labels],
+                            index=pd.Index(labels, name=self.label), columns=self.feature_names)
+
+    def label_variances(self):
+        "Per-label sample variances (`ddof=1`) of the features."
+        labels = sorted(self.labels)
+        return pd.DataFrame([self.labels[l]['m2'] / max(self.labels[l]['n'] - 1, 1) for l in labels],
+                            index=pd.Index(labels, name=self.label), columns=self.feature_names)
+
+    def summary(self):
+        """
+        Returns a DataFrame with one row per feature:
+        usage, relative usage, overall mean, variance, minimum and maximum,
+        as well as the mean per label.
+        """
+        accs = [self.labels[l] for l in sorted(self.labels)]
+        n = np.array([acc['n'] for acc in accs], dtype=np.float64)
+        means = np.array([acc['mean'] for acc in accs])
+        total = n.sum()
+        mean = (n[:, None] * means).sum(axis=0) / total
+        m2 = sum(acc['m2'] for acc in accs) + (n[:, None] * (means - mean)**2).sum(axis=0)
+        frame = pd.DataFrame({
+            'uses': self.usage().to_numpy(),
+            'rel_uses': self.relative_usage().to_numpy(),
+            'mean': mean,
+            'var': m2 / max(total - 1, 1),
+            'min': np.min([acc['min'] for acc in accs], axis=0),
+            'max': np.max([acc['max'] for acc in accs], axis=0),
+        }, index=self.feature_names)
+        for label, acc in sorted(self.labels.items()):
+            frame['mean_label%s' % label] = acc['mean']
+        return frame
+
+
+def profile_csv(path, n_features, label="Label0", chunk_rows=CHUNK_ROWS, zero_threshold=0.0):
+    "Profiles a CSV data set chunk by chunk."
+    profile = None
+    for chunk in pd.read_csv(path, chunksize=chunk_rows):
+        if profile is None:
+            names = list(chunk.columns[0:n_features])
+            profile = FeatureProfile(n_features, names, zero_threshold, label)
+        profile.update(chunk[chunk.columns[0:n_features]].to_numpy(), chunk[label].to_numpy())
+    return profile
+
+
+def profile_cached(x_path, y_path, chunk_rows=CHUNK_ROWS, zero_threshold=0.0, feature_names=None):
+    "Profiles a data set cached as `.npy` files by memory-mapping it in chunks."
+    X = np.load(x_path, mmap_mode='r')
+    Y = np.load(y_path, mmap_mode='r')
+    profile = FeatureProfile(X.shape[1], feature_names, zero_threshold)
+    for start in range(0, len(X), chunk_rows):
+        profile.update(X[start:start+chunk_rows], Y[start:start+chunk_rows])
+    return profile
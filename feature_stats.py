@@ -4,47 +4,40 @@ a random forest.
 """
 import numpy as np
 
+from kernels import subtree_neg_ratios
 
-def node_neg_class_ratio(tree_, node_id):
-    # Code adapted from https://scikit-learn.org/stable/auto_examples/tree/plot_unveil_tree_structure.html
-    leaf_ids = []
 
-    children_right = tree_.children_right
-    children_left = tree_.children_left
+def node_neg_class_ratio(tree_, node_id, ratios=None):
+    """
+    Fraction of the leaves below `node_id` which classify as unknown.
+    The ratios of all nodes are computed at once by
+    `kernels.subtree_neg_ratios`; pass them as `ratios` when querying several
+    nodes of the same tree.
+    """
+    if ratios is None:
+        ratios = subtree_neg_ratios(tree_)
+    return np.asarray(ratios[node_id]).item()
 
-    stack = [(node_id, -1)]  # seed is the root node id and its parent depth
-    while len(stack) > 0:
-        node_id, parent_depth = stack.pop()
-        # If we have a test node
-        if (children_left[node_id] != children_right[node_id]):
-            stack.append((children_left[node_id], parent_depth + 1))
-            stack.append((children_right[node_id], parent_depth + 1))
-        else:
-            leaf_ids.append(node_id)
-    neg_classifications = 0
-    for id in leaf_ids:
-        nprob, pprob = tree_.value[id][0][0]
-        if nprob > pprob:
-            neg_classifications += 1
-    return neg_classifications/len(leaf_ids)
 
-
-def gather_split_info(tree, feature):
+def gather_split_info(tree, feature, ratios=None):
     tree_ = tree.tree_
     argw = np.argwhere(tree_.feature == feature)
     if len(argw) < 1:
         return {} # Feature not used.
+    if ratios is None:
+        ratios = subtree_neg_ratios(tree_)
     fid = argw[0] # Find index of node for this feature.
     threshold = tree_.threshold[fid] # If value <= threshold then left child
-    neg_rate = node_neg_class_ratio(tree_, fid)
-    neg_left = node_neg_class_ratio(tree_, tree_.children_left[fid])
-    neg_right = node_neg_class_ratio(tree_, tree_.children_right[fid])
+    neg_rate = node_neg_class_ratio(tree_, fid, ratios)
+    neg_left = node_neg_class_ratio(tree_, tree_.children_left[fid], ratios)
+    neg_right = node_neg_class_ratio(tree_, tree_.children_right[fid], ratios)
     return {'threshold': threshold, 'unknown_rate': neg_rate, 'unknown_rate_left': neg_left, 'unknown_rate_right': neg_right}
 
 
 def gather_tree_info(tree):
     tree_ = tree.tree_
+    ratios = subtree_neg_ratios(tree_)
     info = {}
     info["max_depth"] = tree_.max_depth
-    info["splits"] = [gather_split_info(tree, f) for f in range(275)]
+    info["splits"] = [gather_split_info(tree, f, ratios) for f in range(275)]
     return info
@@ -0,0 +1,146 @@
+"""
+Hyperparameter sweep for the random forests used in the analysis.
+
+Instead of training each configuration from scratch, all tree counts of a
+configuration `(max_features, criterion, class_weight)` are covered by growing
+a single forest with `warm_start`: it is fitted with the smallest
+`n_estimators`, scored on a held-out split, extended to the next tree count,
+scored again, and so on.
+The configurations are trained in parallel, each with `job_cpus` CPUs,
+such that at most `cpus` CPUs are busy at once.
+
+Usage:
+
+    python forest_sweep.py data/2020-01-23/prob-f109-lto_unique.csv sweep.csv \
+        --n-estimators 25 50 100 200 --max-features 0.5 0.7 sqrt \
+        --criterion gini entropy --class-weight balanced none --cpus 24
+"""
+import argparse
+import itertools
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from datasets import cache_dataset, load_cached_dataset
+from printing import classifier_metrics
+
+DEFAULT_GRID = {
+    'n_estimators': [25, 50, 100],
+    'max_features': [0.7],
+    'criterion': ['gini'],
+    'class_weight': ['balanced'],
+}
+
+
+def parse_max_features(value):
+    "Command line values are either fractions or names such as `sqrt`."
+    try:
+        return float(value)
+    except ValueError:
+        return value
+
+
+def grow_configuration(x_path, y_path, max_features, criterion, class_weight, n_estimators,
+                       n_jobs=1, holdout=0.2, random_state=123):
+    """
+    Grows one forest through the ascending tree counts `n_estimators`
+    and scores it after each step.
+    Returns a list of result rows.
+    """
+    from sklearn.ensemble import RandomForestClassifier
+    from sklearn.model_selection import train_test_split
+    from sklearn.utils.class_weight import compute_class_weight
+
+    X, Y = load_cached_dataset(x_path, y_path)
+    train_x, test_x, train_y, test_y = train_test_split(
+        X, Y, test_size=holdout, random_state=random_state, stratify=Y)
+
+    weights = class_weight
+    if class_weight in ('balanced', 'balanced_subsample'):
+        # Equal for all warm start steps, as they see the same training data.
+        classes = np.unique(train_y)
+        weights = dict(zip(classes, compute_class_weight('balanced', classes=classes, y=train_y)))
+
+    forest = RandomForestClassifier(
+        n_estimators=n_estimators[0],
+        criterion=criterion,
+        n_jobs=n_jobs,
+        bootstrap=False,
+        max_features=max_features,
+        random_state=random_state,
+        class_weight=weights,
+        warm_start=True)
+
+    rows = []
+    fit_seconds = 0.0
+    for n in n_estimators:
+        forest.set_params(n_estimators=n)
+        start = time.perf_counter()
+        forest.fit(train_x, train_y) # Only fits the additional trees.
+        fit_seconds += time.perf_counter() - start
+        start = time.perf_counter()
+        pred = forest.predict(test_x)
+        predict_seconds = time.perf_counter() - start
+        row = {'max_features': max_features, 'criterion': criterion,
+               'class_weight': class_weight or 'none', 'n_estimators': n}
+        row.update(classifier_metrics(test_y, pred))
+        row['fit_seconds'] = fit_seconds # Cumulative, i.e. the cost of a fresh fit.
+        row['predict_seconds'] = predict_seconds
+        row['leaves'] = sum(tree.tree_.n_leaves for tree in forest.estimators_)
+        rows.append(row)
+    return rows
+
+
+def sweep(csv_file_path, n_features=109, grid=None, cpus=None, job_cpus=1, holdout=0.2,
+          random_state=123, cache_dir=None):
+    """
+    Runs the sweep over `grid` (see `DEFAULT_GRID`) on the given data set.
+    Returns a DataFrame with one row per configuration and tree count,
+    sorted by descending balanced accuracy.
+    """
+    grid = dict(DEFAULT_GRID, **(grid or {}))
+    cpus = cpus or os.cpu_count()
+    workers = max(1, cpus // job_cpus)
+    cache_dir = cache_dir or tempfile.mkdtemp(prefix='forest-sweep-')
+    x_path, y_path = cache_dataset(csv_file_path, n_features, cache_dir)
+
+    n_estimators = sorted(grid['n_estimators'])
+    configurations = list(itertools.product(grid['max_features'], grid['criterion'],
+                                            grid['class_weight']))
+    with ProcessPoolExecutor(max_workers=min(workers, len(configurations))) as pool:
+        futures = [pool.submit(grow_configuration, x_path, y_path, mf, crit, cw,
+                               n_estimators, job_cpus, holdout, random_state)
+                   for (mf, crit, cw) in configurations]
+        rows = [row for future in futures for row in future.result()]
+    result = pd.DataFrame(rows)
+    return result.sort_values('balanced_accuracy', ascending=False, kind='stable')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Random forest hyperparameter sweep.")
+    parser.add_argument('csv_file')
+    parser.add_argument('target_file', help="CSV file for the results")
+    parser.add_argument('--n-features', type=int, default=109)
+    parser.add_argument('--n-estimators', type=int, nargs='+', default=DEFAULT_GRID['n_estimators'])
+    parser.add_argument('--max-features', type=parse_max_features, nargs='+', default=DEFAULT_GRID['max_features'])
+    parser.add_argument('--criterion', nargs='+', default=DEFAULT_GRID['criterion'])
+    parser.add_argument('--class-weight', nargs='+', default=DEFAULT_GRID['class_weight'],
+                        help="'balanced', 'balanced_subsample' or 'none'")
+    parser.add_argument('--cpus', type=int, default=None, help="Total CPU budget (default: all)")
+    parser.add_argument('--job-cpus', type=int, default=1, help="CPUs per configuration")
+    parser.add_argument('--holdout', type=float, default=0.2)
+    args = parser.parse_args()
+
+    grid = {
+        'n_estimators': args.n_estimators,
+        'max_features': args.max_features,
+        'criterion': args.criterion,
+        'class_weight': [None if cw == 'none' else cw for cw in args.class_weight],
+    }
+    result = sweep(args.csv_file, args.n_features, grid, args.cpus, args.job_cpus, args.holdout)
+    result.to_csv(args.target_file, index=False)
+    print(result.to_string(index=False))
@@ -1,6 +1,10 @@
 """
 Script that gathers the results of the jobarray cluster scripts into a single
 file, sorted by descending support score.
+Rules with the same condition set are written once (the one with the highest
+support), identified by the `Fingerprint:` line of the rule files
+(see `condition_encoding`); files without it are compared by their condition
+lines. The fingerprint lines are not copied into the target file.
 
 Script takes two arguments:
 
@@ -25,24 +29,35 @@ def extract_support(file):
         print("DID NOT FIND SUPPORT VALUE FOR", str(file))
 
 
-def equal_rule(rule, other):
-    last_text = ""
-    for line in rule.split('\n'):
-        if line.startswith("=>"):
-            break
-        last_text += line
-    other_text = ""
-    for line in other.split('\n'):
+def rule_key(rule):
+    """
+    Returns the condition set fingerprint of a rule file's text and the text
+    without the fingerprint line. Without fingerprint, the condition lines
+    serve as key.
+    """
+    lines = rule.split('\n')
+    conditions = []
+    for line in lines:
         if line.startswith("=>"):
             break
-        other_text += line
-    return last_text == other_text
-
+        conditions.append(line)
+    key = "".join(conditions)
+    text = []
+    for line in lines:
+        if line.startswith("Fingerprint:"):
+            key = int(line.split()[1], 16)
+        else:
+            text.append(line)
+    return key, '\n'.join(text)
 
 
-if __name__ == "__main__":
-    jobarray_dir = Path(sys.argv[1])
-    target_file = sys.argv[2]
+def gather_jobarray(jobarray_dir, target_file):
+    """
+    Writes the rule files of all jobs below `jobarray_dir` into `target_file`,
+    sorted by descending support, skipping unsupported and repeated rules.
+    Returns the number of written rules.
+    """
+    jobarray_dir = Path(jobarray_dir)
 
     # Gather all job dirs
     job_dirs = [d for d in jobarray_dir.iterdir() if d.is_dir()]
@@ -58,13 +73,20 @@ if __name__ == "__main__":
     sorted_rules = sorted(supp_rules, key=lambda r: r[1], reverse=True) # Sort by support
 
     # Dump into target file
+    written = 0
+    seen = set()
     with open(target_file, 'w+') as dump:
-        last_read = ""
         for (rule, support) in sorted_rules:
             if support <= 0: continue # Skipping unsupported rules.
             with open(rule, 'r+') as f:
-                this_read = f.read()
-                if equal_rule(last_read, this_read):
+                key, text = rule_key(f.read())
+                if key in seen:
                     continue
-                dump.write(this_read)
-                last_read = this_read
+                seen.add(key)
+                dump.write(text)
+                written += 1
+    return written
+
+
+if __name__ == "__main__":
+    gather_jobarray(sys.argv[1], sys.argv[2])
@@ -0,0 +1,76 @@
+"""
+Feature importance measures which work on all matrix layouts produced by
+`datasets.training_matrix`, including sparse CSR matrices
+(which Scikit-Learn's `permutation_importance` rejects).
+"""
+import numpy as np
+
+from sklearn.inspection import permutation_importance
+from sklearn.metrics import get_scorer
+
+
+def permutation_importances(forest, X, Y, scoring='balanced_accuracy', n_repeats=5,
+                            random_state=1234, sample_weight=None):
+    """
+    Returns the mean permutation importance per feature.
+    Dense inputs are passed to Scikit-Learn's `permutation_importance`;
+    for sparse inputs, see `sparse_permutation_importances`.
+    """
+    if hasattr(X, 'tocsc'):
+        return sparse_permutation_importances(forest, X, Y, scoring, n_repeats,
+                                              random_state, sample_weight)
+    result = permutation_importance(forest, X, Y, scoring=scoring, n_repeats=n_repeats,
+                                    n_jobs=1, random_state=random_state,
+                                    sample_weight=sample_weight)
+    return result.importances_mean
+
+
+def sparse_permutation_importances(forest, X, Y, scoring='balanced_accuracy', n_repeats=5,
+                                   random_state=1234, sample_weight=None):
+    """
+    Permutation importance on a sparse matrix without densifying it.
+    Permuting the rows of feature `j` only relabels the row indices of that
+    column's stored values, which is done on a CSC copy in place.
+    """
+    scorer = get_scorer(scoring)
+    rng = np.random.RandomState(random_state)
+    csc = X.tocsc(copy=True)
+    csc.sort_indices()
+    n_samples, n_features = csc.shape
+
+    def score(matrix):
+        if sample_weight is None:
+            return scorer(forest, matrix, Y)
+        return scorer(forest, matrix, Y, sample_weight=sample_weight)
+
+    baseline = score(X.tocsr())
+    importances = np.zeros(n_features)
+    for j in range(n_features):
+        start, end = csc.indptr[j], csc.indptr[j+1]
+        if start == end:
+            continue # Column is all zero, permuting changes nothing.
+        rows = csc.indices[start:end].copy()
+        scores = []
+        for _ in range(n_repeats):
+            permutation = rng.permutation(n_samples)
+            # Value of row r moves to the row which draws r.
+            target = np.empty(n_samples, dtype=csc.indices.dtype)
+            target[permutation] = np.arange(n_samples, dtype=csc.indices.dtype)
+            csc.indices[start:end] = target[rows]
+            csc.has_sorted_indices = False
+            scores.append(score(csc.tocsr()))
+        csc.indices[start:end] = rows
+        csc.has_sorted_indices = True
+        importances[j] = baseline - np.mean(scores)
+    return importances
+
+
+def shap_importances(forest, X, class_index=1, n_jobs=None):
+    """
+    Returns the mean absolute TreeSHAP value per feature (see `treeshap`),
+    which needs a single pass over the samples instead of one prediction per
+    feature and repetition.
+    """
+    from treeshap import tree_shap
+    phi, _ = tree_shap(forest, X, class_index=class_index, n_jobs=n_jobs)
+    return np.abs(phi).mean(axis=0)
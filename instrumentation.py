@@ -0,0 +1,209 @@
+"""
+Lightweight instrumentation for the long running analysis scripts.
+
+Instead of printing a line for every analysed rule, the analysis is split
+into named stages (e.g. load, fit, importances, extract, analyse, report).
+For each stage, the wall clock time, CPU time, peak resident set size and,
+if items were counted, the processing rate are recorded.
+Progress inside hot loops is only reported through a `Progress` object,
+which rate-limits its output and estimates the remaining time.
+
+At the end of a run, `Instrumentation.write_summary` dumps all collected
+measurements as JSON.
+"""
+import json
+import resource
+import sys
+import time
+from contextlib import contextmanager
+
+
+def peak_rss_mb():
+    """
+    Returns the peak resident set size of this process (and its terminated
+    children, such as pool workers) in MiB.
+    """
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    peak = max(own, children)
+    # Linux reports KiB, macOS reports bytes.
+    return peak / (1024*1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def cpu_seconds():
+    """
+    Returns the CPU time (user + system) consumed so far by this process and
+    its terminated children.
+    """
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+def format_duration(seconds):
+    "Formats a duration in seconds as `H:MM:SS`."
+    seconds = int(round(seconds))
+    return "%d:%02d:%02d" % (seconds // 3600, (seconds // 60) % 60, seconds % 60)
+
+
+class Progress:
+    """
+    Rate-limited progress reporting for hot loops.
+
+    `update` is cheap to call for every processed item; a status line
+    with rate and ETA is only written if at least `interval` seconds passed
+    since the last one. Passing `stream=None` silences the output entirely.
+    """
+
+    def __init__(self, total, label="progress", unit="items", stream=sys.stderr, interval=30.0):
+        self.total = total
+        self.label = label
+        self.unit = unit
+        self.stream = stream
+        self.interval = interval
+        self.done = 0
+        self.start = time.perf_counter()
+        self.last_report = self.start
+
+    def update(self, n=1):
+        self.done += n
+        if self.stream is None:
+            return
+        now = time.perf_counter()
+        if now - self.last_report >= self.interval:
+            self.last_report = now
+            self.report(now)
+
+    def rate(self, now=None):
+        "Returns the processed items per second so far."
+        elapsed = (now or time.perf_counter()) - self.start
+        return self.done / elapsed if elapsed > 0 else 0.0
+
+    def report(self, now=None):
+        now = now or time.perf_counter()
+        rate = self.rate(now)
+        if self.total:
+            remaining = (self.total - self.done) / rate if rate > 0 else float('inf')
+            eta = format_duration(remaining) if remaining != float('inf') else "?"
+            self.stream.write("%s: %.2f%% (%d/%d), %.1f %s/s, ETA %s\n"
+                              % (self.label, 100*self.done/self.total, self.done,
+                                 self.total, rate, self.unit, eta))
+        else:
+            self.stream.write("%s: %d %s, %.1f %s/s\n"
+                              % (self.label, self.done, self.unit, rate, self.unit))
+        self.stream.flush()
+
+    def close(self):
+        "Writes a final status line (unless silenced)."
+        if self.stream is not None:
+            self.report()
+
+
+class Instrumentation:
+    """
+    Collects per-stage measurements of an analysis run.
+
+    Usage:
+
+        instr = Instrumentation("prob-f109")
+        with instr.stage("fit"):
+            forest.fit(X, Y)
+        with instr.stage("analyse") as stage:
+            progress = instr.progress(len(rules), "analyse", unit="rules")
+            ...
+            stage.count(len(rules), unit="rules")
+        instr.write_summary("instrumentation.json")
+    """
+
+    def __init__(self, name, stream=sys.stderr, progress_interval=30.0):
+        self.name = name
+        self.stream = stream
+        self.progress_interval = progress_interval
+        self.stages = []
+        self.start = time.perf_counter()
+        self.start_cpu = cpu_seconds()
+
+    def log(self, message):
+        if self.stream is not None:
+            self.stream.write("[%s] %s\n" % (self.name, message))
+            self.stream.flush()
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Context manager measuring the enclosed block as stage `name`.
+        Yields the stage record, on which `count` can be called to
+        register the number of processed items.
+        """
+        record = StageRecord(name)
+        self.log("Stage '%s' started" % name)
+        wall = time.perf_counter()
+        cpu = cpu_seconds()
+        try:
+            yield record
+        finally:
+            record.wall_seconds = time.perf_counter() - wall
+            record.cpu_seconds = cpu_seconds() - cpu
+            record.peak_rss_mb = peak_rss_mb()
+            self.stages.append(record)
+            self.log("Stage '%s' done: %s" % (name, record.describe()))
+
+    def progress(self, total, label, unit="items"):
+        "Returns a `Progress` reporting to this run's stream."
+        return Progress(total, label="[%s] %s" % (self.name, label), unit=unit,
+                        stream=self.stream, interval=self.progress_interval)
+
+    def summary(self):
+        return {
+            'name': self.name,
+            'wall_seconds': time.perf_counter() - self.start,
+            'cpu_seconds': cpu_seconds() - self.start_cpu,
+            'peak_rss_mb': peak_rss_mb(),
+            'stages': [s.as_dict() for s in self.stages],
+        }
+
+    def write_summary(self, path):
+        "Writes the JSON summary of all stages to `path`."
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+            f.write("\n")
+
+
+class StageRecord:
+    "Measurements of a single stage."
+
+    def __init__(self, name):
+        self.name = name
+        self.wall_seconds = 0.0
+        self.cpu_seconds = 0.0
+        self.peak_rss_mb = 0.0
+        self.items = None
+        self.unit = None
+
+    def count(self, items, unit="items"):
+        "Registers the number of items processed in this stage."
+        self.items = items
+        self.unit = unit
+
+    def rate(self):
+        if self.items is None or self.wall_seconds <= 0:
+            return None
+        return self.items / self.wall_seconds
+
+    def describe(self):
+        text = "wall %.2fs, cpu %.2fs, peak rss %.1f MiB" % (
+            self.wall_seconds, self.cpu_seconds, self.peak_rss_mb)
+        if self.items is not None:
+            text += ", %d %s (%.1f %s/s)" % (self.items, self.unit, self.rate() or 0.0, self.unit)
+        return text
+
+    def as_dict(self):
+        return {
+            'name': self.name,
+            'wall_seconds': self.wall_seconds,
+            'cpu_seconds': self.cpu_seconds,
+            'peak_rss_mb': self.peak_rss_mb,
+            'items': self.items,
+            'unit': self.unit,
+            'rate': self.rate(),
+        }
@@ -9,6 +9,9 @@ The code is meant to be used on tree ensembles produced by Scikit-Learn.
 """
 
 from f109_info import *
+from condition_encoding import RuleCodes, cond_codes, cond_fingerprint
+
+import numpy as np
 
 def extract_rules(forest, max_depth=None):
     """
@@ -123,33 +126,53 @@ def rule_length(tree, rule):
     (rule_cond, _) = rule
     return len(rule_cond)
 
-def analyse_rule_set(rule_set, max_depth=None):
+def analyse_rule_set(rule_set, max_depth=None, progress=None):
     """
     Calculates the support and confidence for each rule in the rule set.
 
+    Nothing is printed per rule. To monitor the analysis, pass an
+    `instrumentation.Progress` object as `progress`,
+    which is updated after each rule.
+
     Returns a list of tuples `(cond, target, support, confidence)`
     in no guaranteed order.
     """
     analysis = []
 
     sorted_rules = sorted(rule_set, key=lambda r: 1/len(r[0]))
-    supp_div = len(sorted_rules)
+    encoded = encode_rule_set(sorted_rules)
 
     for i in range(len(sorted_rules)):
         rule = sorted_rules[i]
-        analysis += [analyse_rule_in_ruleset(rule, sorted_rules[i+1:], max_depth)]
-        print("%.02f%%" % (100*(i+1)/supp_div))
+        analysis += [analyse_rule_in_ruleset(rule, None, max_depth, encoded_set=encoded[i+1:])]
+        if progress is not None:
+            progress.update()
     return analysis
 
-def analyse_rule_in_ruleset(rule, rule_set, max_depth=None, file=None, importances=None):
-    print("Analysing rule", rule)
-    (support_score, confidence) = association_rule_analysis(rule, rule_set, max_depth=max_depth)
+def encode_rule_set(rule_set):
+    """
+    Encodes the rules once for `association_rule_analysis`:
+    returns a list of pairs `(item codes, target)`, the codes of the full
+    condition as frozenset (see `condition_encoding`).
+    """
+    codes = RuleCodes.from_rules(rule_set)
+    return list(zip(codes.sets(), codes.targets.tolist()))
+
+
+def analyse_rule_in_ruleset(rule, rule_set, max_depth=None, file=None, importances=None, verbose=False,
+                            encoded_set=None):
+    if verbose:
+        print("Analysing rule", rule)
+    (support_score, confidence) = association_rule_analysis(rule, rule_set, max_depth=max_depth,
+                                                            encoded_set=encoded_set)
     (cond, out) = rule_to_assoc_rule(rule, max_depth=max_depth)
-    print("Done with rule", rule, "- Support, confidence:", (support_score, confidence))
+    if verbose:
+        print("Done with rule", rule, "- Support, confidence:", (support_score, confidence))
 
     if not (file is None or importances is None):
         w = open(file, "w+")
         pretty_print_assoc_rule((cond, out), importances, w)
+        w.write('Fingerprint: %016x\n' % (cond_fingerprint(cond) & 0xFFFFFFFFFFFFFFFF))
         w.write('Support: %d, Confidence: %.2f\n\n' % (support_score, confidence))
         w.close()
 
@@ -166,19 +189,22 @@ def pretty_print_assoc_rule(rule, importances, target_file):
     target_file.write("=> %d\n" % target)
 
 
-def association_rule_analysis(rule, rule_set, max_depth=None):
+def association_rule_analysis(rule, rule_set, max_depth=None, encoded_set=None):
     """
     Returns a tuple: amount of supporting rules and the confidence.
+    The rule set can be given already encoded (see `encode_rule_set`)
+    as `encoded_set`, in which case `rule_set` is ignored.
     """
     support = 0
     confidence = 0
 
-    rule_list = list(rule_set)
+    (this_cond, this_target) = rule
+    this_codes = frozenset(cond_codes(this_cond, max_depth))
+    if encoded_set is None:
+        encoded_set = encode_rule_set(rule_set)
 
-    (this_cond, this_target) = rule_to_assoc_rule(rule, max_depth)
-
-    for (other_cond, t) in rule_set:
-        if this_cond.issubset(association_rule_cond(other_cond)):
+    for (other_codes, t) in encoded_set:
+        if this_codes <= other_codes:
             support += 1
             if t == this_target:
                 confidence += 1
@@ -218,17 +244,108 @@ def association_rule_cond(cond, max_depth=None):
     return set(transformed_cond_list)
 
 
-# def prune_rule(tree, rule, threshold=0.05, s=1e-6):
-#     (rule_cond, rule_pred) = rule
-#     E0 = ??
-#     pruned_cond = []
-#     for cond in rule_cond[::-1]: # Start with last condition.
-#         cond_no_i = ??
-#         E_no_i = ??
-#         decay = (E_no_i - E0)/max([E0, s])
-#
-#         if decay < threshold:
-#             E0 = E_no_i
-#         else:
-#             pruned_cond.add(cond)
-#     return pruned_cond
+def rule_error_on_data(covered, matches, weights=None):
+    """
+    Error of rules given a boolean coverage matrix `covered` (rules x samples)
+    and the matrix `matches` indicating which samples carry the rule's target.
+    Rules covering no sample have an error of 1.
+    """
+    if weights is None:
+        total = covered.sum(axis=1)
+        correct = (covered & matches).sum(axis=1)
+    else:
+        total = covered @ weights
+        correct = (covered & matches) @ weights
+    return np.where(total > 0, 1 - correct / np.maximum(total, 1e-300), 1.0)
+
+
+def prune_rules(rules, X, Y, threshold=0.05, s=1e-6, sample_weight=None,
+                memory_limit=64*2**20):
+    """
+    Prunes the rules as done by inTrees [1]:
+    starting with the last condition, each condition is dropped from the rule
+    if the relative error increase (decay) caused by dropping it,
+    `(E_without - E0) / max(E0, s)`, is below `threshold`.
+    Errors are measured on the data `X` with labels `Y`.
+
+    The conditions are evaluated as boolean columns which are computed once per
+    distinct split. Rules are processed in batches (bounded by
+    `memory_limit` bytes of boolean matrices), in which all conditions at the
+    same position are tested at once.
+
+    Returns the list of pruned rules `(cond, target)`, keeping the order of
+    `rules` and of the remaining conditions.
+    """
+    # Scikit-Learn compares float32 feature values against the thresholds.
+    X = np.asarray(X, dtype=np.float32).astype(np.float64)
+    Y = np.asarray(Y)
+    weights = None if sample_weight is None else np.asarray(sample_weight, dtype=np.float64)
+    rules = list(rules)
+    n_samples = len(X)
+    pruned = [None] * len(rules)
+
+    # Batch rules of similar length together to reduce padding.
+    order = sorted(range(len(rules)), key=lambda i: len(rules[i][0]))
+    start = 0
+    while start < len(order):
+        length = max(len(rules[order[start]][0]), 1)
+        batch_size = max(1, memory_limit // (2 * length * max(n_samples, 1)))
+        batch = order[start:start+batch_size]
+        length = max(max(len(rules[i][0]) for i in batch), 1)
+        prune_batch_(rules, batch, length, X, Y, weights, threshold, s, pruned)
+        start += len(batch)
+    return pruned
+
+
+def prune_batch_(rules, batch, length, X, Y, weights, threshold, s, pruned):
+    """
+    Prunes the rules with indices `batch` (in-place into `pruned`).
+    Rules are padded to `length` with always satisfied conditions.
+    """
+    n_rules = len(batch)
+    n_samples = len(X)
+
+    # Distinct splits of this batch, evaluated once each.
+    split_ids = {}
+    for i in batch:
+        for (_, fid, thresh, _) in rules[i][0]:
+            split_ids.setdefault((fid, thresh), len(split_ids))
+    splits = list(split_ids)
+    columns = np.ones((len(splits) + 1, n_samples), dtype=bool) # Last row: padding.
+    if splits:
+        fids = np.array([f for (f, _) in splits])
+        thresholds = np.array([t for (_, t) in splits])
+        columns[:-1] = (X[:, fids] <= thresholds).T
+
+    index = np.full((n_rules, length), len(splits))
+    leq = np.ones((n_rules, length), dtype=bool)
+    lengths = np.zeros(n_rules, dtype=int)
+    for row, i in enumerate(batch):
+        cond = rules[i][0]
+        lengths[row] = len(cond)
+        for pos, (_, fid, thresh, leq_bool) in enumerate(cond):
+            index[row, pos] = split_ids[(fid, thresh)]
+            leq[row, pos] = leq_bool
+
+    satisfied = columns[index] # rules x positions x samples
+    satisfied[~leq] = ~satisfied[~leq]
+    prefix = np.logical_and.accumulate(satisfied, axis=1) # Inclusive prefixes.
+    targets = np.array([rules[i][1] for i in batch])
+    matches = Y[None, :] == targets[:, None]
+
+    error = rule_error_on_data(prefix[:, -1], matches, weights)
+    suffix = np.ones((n_rules, n_samples), dtype=bool) # Kept later conditions.
+    keep = np.zeros((n_rules, length), dtype=bool)
+    for pos in range(length - 1, -1, -1):
+        active = pos < lengths
+        before = prefix[:, pos-1] if pos > 0 else np.ones((n_rules, n_samples), dtype=bool)
+        error_without = rule_error_on_data(before & suffix, matches, weights)
+        decay = (error_without - error) / np.maximum(error, s)
+        drop = active & (decay < threshold)
+        error = np.where(drop, error_without, error)
+        keep[:, pos] = active & ~drop
+        suffix[keep[:, pos]] &= satisfied[keep[:, pos], pos]
+
+    for row, i in enumerate(batch):
+        cond, target = rules[i]
+        pruned[i] = (tuple(c for (c, k) in zip(cond, keep[row]) if k), target)
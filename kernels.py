@@ -0,0 +1,506 @@
+"""
+Accelerated kernels for the hot loops of the rule analysis, operating on
+integer encoded arrays instead of Python tuples:
+
+* `subset_counts`: for each rule, the number of later rules whose item set
+  contains its (truncated) item set, and how many of those share its target
+  (the loop of `intrees.association_rule_analysis`),
+* `subset_target_counts`: the same counts split by the target of the later
+  rules (see `target_support`),
+* `tree_paths`: the root-to-leaf paths of a tree (`intrees.rule_extract_`),
+* `subtree_neg_ratios`: for every node, the fraction of leaves below it which
+  classify as unknown (`feature_stats.node_neg_class_ratio`),
+* `path_shap`: the path-dependent TreeSHAP values of a tree (`treeshap`).
+
+If Numba is installed, the kernels are JIT compiled with parallel loops,
+otherwise vectorised NumPy implementations are used. Set
+`kernels.BACKEND = 'numpy'` to force the latter.
+Compare both with `python bench_kernels.py`.
+
+On top of the kernels, `analyse_rules` and `extract_rules_fast` return the
+same results as `analyse_rule_set` and `extract_rules`.
+"""
+import numpy as np
+
+from condition_encoding import RuleCodes
+from intrees import association_rule_cond
+
+try:
+    import numba
+    BACKEND = 'numba'
+except ImportError:
+    numba = None
+    BACKEND = 'numpy'
+
+BLOCK_BYTES = 32 * 2**20 # Size of the intermediate arrays of the NumPy kernels.
+
+
+def subset_counts_numpy(query, full, targets):
+    n, words = full.shape
+    support = np.zeros(n, dtype=np.int64)
+    same = np.zeros(n, dtype=np.int64)
+    missing = ~full
+    block = max(1, BLOCK_BYTES // max(n * words * 8, 1))
+    for start in range(0, n, block):
+        end = min(n, start + block)
+        # contained[i, j]: query i is a subset of full j.
+        contained = np.ones((end - start, n), dtype=bool)
+        for w in range(words):
+            contained &= (query[start:end, w, None] & missing[None, :, w]) == 0
+        contained &= np.arange(n)[None, :] > np.arange(start, end)[:, None]
+        support[start:end] = contained.sum(axis=1)
+        same[start:end] = (contained & (targets[None, :] == targets[start:end, None])).sum(axis=1)
+    return support, same
+
+
+def subset_target_counts_numpy(query, full, targets, n_targets):
+    n, words = full.shape
+    counts = np.zeros((n, n_targets), dtype=np.int64)
+    missing = ~full
+    block = max(1, BLOCK_BYTES // max(n * words * 8, 1))
+    for start in range(0, n, block):
+        end = min(n, start + block)
+        contained = np.ones((end - start, n), dtype=bool)
+        for w in range(words):
+            contained &= (query[start:end, w, None] & missing[None, :, w]) == 0
+        contained &= np.arange(n)[None, :] > np.arange(start, end)[:, None]
+        for k in range(n_targets):
+            counts[start:end, k] = contained[:, targets == k].sum(axis=1)
+    return counts
+
+
+def tree_paths_numpy(children_left, children_right):
+    n = len(children_left)
+    is_leaf = children_left == children_right
+    parent = np.full(n, -1, dtype=np.int64)
+    went_left = np.zeros(n, dtype=bool)
+    inner = np.flatnonzero(~is_leaf)
+    parent[children_left[inner]] = inner
+    parent[children_right[inner]] = inner
+    went_left[children_left[inner]] = True
+
+    # Node ids are in pre-order, so parents precede their children.
+    depth = np.zeros(n, dtype=np.int64)
+    for node in range(1, n):
+        depth[node] = depth[parent[node]] + 1
+
+    leaves = np.flatnonzero(is_leaf)
+    offsets = np.zeros(len(leaves) + 1, dtype=np.int64)
+    np.cumsum(depth[leaves], out=offsets[1:])
+    nodes = np.empty(offsets[-1], dtype=np.int64)
+    leq = np.empty(offsets[-1], dtype=bool)
+    current = leaves.copy()
+    position = offsets[1:] - 1
+    active = depth[leaves] > 0
+    while active.any():
+        c = current[active]
+        nodes[position[active]] = parent[c]
+        leq[position[active]] = went_left[c]
+        current[active] = parent[c]
+        position[active] -= 1
+        active &= depth[current] > 0
+    return leaves, offsets, nodes, leq
+
+
+def subtree_neg_ratios_numpy(children_left, children_right, value):
+    n = len(children_left)
+    is_leaf = children_left == children_right
+    leaves = is_leaf.astype(np.int64)
+    neg = (is_leaf & (value[:, 0] > value[:, 1])).astype(np.int64)
+    # Children have larger ids than their parents: aggregate level by level.
+    inner = np.flatnonzero(~is_leaf)
+    depth = np.zeros(n, dtype=np.int64)
+    for node in inner:
+        depth[children_left[node]] = depth[children_right[node]] = depth[node] + 1
+    for level in range(int(depth.max()), -1, -1):
+        at_level = inner[depth[inner] == level]
+        left, right = children_left[at_level], children_right[at_level]
+        leaves[at_level] = leaves[left] + leaves[right]
+        neg[at_level] = neg[left] + neg[right]
+    return neg / leaves
+
+
+def unwind_path_numpy(path_feature, zero, one, weight, d, k):
+    o, z = one[k].copy(), zero[k]
+    has_one = o != 0
+    safe_one = np.where(has_one, o, 1.0)
+    next_one = weight[d].copy()
+    for i in range(d - 1, -1, -1):
+        unwound = np.where(has_one, next_one * (d + 1) / ((i + 1) * safe_one),
+                           weight[i] * (d + 1) / (z * (d - i)))
+        next_one = weight[i] - unwound * z * (d - i) / (d + 1)
+        weight[i] = unwound
+    path_feature[k:d] = path_feature[k + 1:d + 1]
+    zero[k:d] = zero[k + 1:d + 1]
+    one[k:d] = one[k + 1:d + 1]
+
+
+def leaf_shap_numpy(zero, one, weight, l):
+    d = l - 1
+    o = one[1:l]
+    z = zero[1:l, None]
+    has_one = o != 0
+    safe_one = np.where(has_one, o, 1.0)
+    next_one = np.repeat(weight[d][None, :], d, axis=0)
+    total = np.zeros_like(o)
+    for i in range(d - 1, -1, -1):
+        tmp = next_one * (d + 1) / ((i + 1) * safe_one)
+        total += np.where(has_one, tmp, weight[i] / z * (d + 1) / (d - i))
+        next_one = weight[i] - tmp * z * (d - i) / (d + 1)
+    return total * (o - z)
+
+
+def path_shap_numpy(left, right, feature, threshold, cover, value, X, max_depth):
+    n_features, n = X.shape
+    levels = max_depth + 1
+    # The path of each depth level (feature, zero fraction, one fractions and
+    # weights of its elements), copied from the level above and extended.
+    path_feature = np.zeros((levels, levels), dtype=np.int64)
+    zero = np.zeros((levels, levels))
+    one = np.zeros((levels, levels, n))
+    weight = np.zeros((levels, levels, n))
+    length = np.zeros(levels, dtype=np.int64)
+    incoming_zero = np.ones(levels)
+    incoming_one = np.ones((levels, n))
+    phi = np.zeros((n_features, n))
+    stack = [(0, 0, -1)]
+    while stack:
+        node, level, parent = stack.pop()
+        w = weight[level]
+        if parent < 0:
+            l = 0
+            path_feature[0, 0], zero[0, 0] = -1, 1.0
+            one[0, 0] = 1.0
+            w[0] = 1.0
+        else:
+            l = length[level - 1]
+            path_feature[level, :l] = path_feature[level - 1, :l]
+            zero[level, :l] = zero[level - 1, :l]
+            one[level, :l] = one[level - 1, :l]
+            w[:l] = weight[level - 1, :l]
+            z = incoming_zero[level - 1] * cover[node] / cover[parent]
+            follows = X[feature[parent]] <= threshold[parent]
+            o = incoming_one[level - 1] * (follows if left[parent] == node else ~follows)
+            path_feature[level, l], zero[level, l], one[level, l] = feature[parent], z, o
+            j = np.arange(l)[:, None]
+            previous = w[:l].copy()
+            w[:l] = z * previous * (l - j) / (l + 1)
+            w[l] = 0.0
+            w[1:l + 1] += o * previous * (j + 1) / (l + 1)
+        l += 1
+        if left[node] == right[node]:
+            if l > 1:
+                phi[path_feature[level, 1:l]] += leaf_shap_numpy(zero[level], one[level], w, l) * value[node]
+            continue
+        found = np.flatnonzero(path_feature[level, 1:l] == feature[node])
+        if len(found):
+            k = found[0] + 1
+            incoming_zero[level] = zero[level, k]
+            incoming_one[level] = one[level, k]
+            unwind_path_numpy(path_feature[level], zero[level], one[level], w, l - 1, k)
+            l -= 1
+        else:
+            incoming_zero[level] = 1.0
+            incoming_one[level] = 1.0
+        length[level] = l
+        stack.append((right[node], level + 1, node))
+        stack.append((left[node], level + 1, node))
+    return phi
+
+
+if numba is not None:
+    @numba.njit(parallel=True, cache=True)
+    def subset_counts_numba(query, full, targets):
+        n, words = full.shape
+        support = np.zeros(n, dtype=np.int64)
+        same = np.zeros(n, dtype=np.int64)
+        for i in numba.prange(n):
+            s = 0
+            t = 0
+            for j in range(i + 1, n):
+                contained = True
+                for w in range(words):
+                    if query[i, w] & ~full[j, w]:
+                        contained = False
+                        break
+                if contained:
+                    s += 1
+                    if targets[j] == targets[i]:
+                        t += 1
+            support[i] = s
+            same[i] = t
+        return support, same
+
+    @numba.njit(parallel=True, cache=True)
+    def subset_target_counts_numba(query, full, targets, n_targets):
+        n, words = full.shape
+        counts = np.zeros((n, n_targets), dtype=np.int64)
+        for i in numba.prange(n):
+            for j in range(i + 1, n):
+                contained = True
+                for w in range(words):
+                    if query[i, w] & ~full[j, w]:
+                        contained = False
+                        break
+                if contained:
+                    counts[i, targets[j]] += 1
+        return counts
+
+    @numba.njit(cache=True)
+    def tree_depths_numba(children_left, children_right):
+        n = len(children_left)
+        parent = np.full(n, -1, dtype=np.int64)
+        went_left = np.zeros(n, dtype=np.bool_)
+        depth = np.zeros(n, dtype=np.int64)
+        for node in range(n):
+            if children_left[node] != children_right[node]:
+                parent[children_left[node]] = node
+                parent[children_right[node]] = node
+                went_left[children_left[node]] = True
+                depth[children_left[node]] = depth[node] + 1
+                depth[children_right[node]] = depth[node] + 1
+        return parent, went_left, depth
+
+    @numba.njit(parallel=True, cache=True)
+    def fill_paths_numba(leaves, offsets, parent, went_left, nodes, leq):
+        for k in numba.prange(len(leaves)):
+            current = leaves[k]
+            for position in range(offsets[k + 1] - 1, offsets[k] - 1, -1):
+                nodes[position] = parent[current]
+                leq[position] = went_left[current]
+                current = parent[current]
+
+    def tree_paths_numba(children_left, children_right):
+        children_left = np.ascontiguousarray(children_left, dtype=np.int64)
+        children_right = np.ascontiguousarray(children_right, dtype=np.int64)
+        parent, went_left, depth = tree_depths_numba(children_left, children_right)
+        leaves = np.flatnonzero(children_left == children_right)
+        offsets = np.zeros(len(leaves) + 1, dtype=np.int64)
+        np.cumsum(depth[leaves], out=offsets[1:])
+        nodes = np.empty(offsets[-1], dtype=np.int64)
+        leq = np.empty(offsets[-1], dtype=np.bool_)
+        fill_paths_numba(leaves, offsets, parent, went_left, nodes, leq)
+        return leaves, offsets, nodes, leq
+
+    @numba.njit(cache=True)
+    def subtree_neg_ratios_numba(children_left, children_right, value):
+        n = len(children_left)
+        leaves = np.zeros(n, dtype=np.int64)
+        neg = np.zeros(n, dtype=np.int64)
+        for node in range(n - 1, -1, -1):
+            if children_left[node] == children_right[node]:
+                leaves[node] = 1
+                neg[node] = 1 if value[node, 0] > value[node, 1] else 0
+            else:
+                leaves[node] = leaves[children_left[node]] + leaves[children_right[node]]
+                neg[node] = neg[children_left[node]] + neg[children_right[node]]
+        return neg / leaves
+
+    @numba.njit(cache=True)
+    def path_shap_numba(left, right, feature, threshold, cover, value, X, max_depth):
+        n_features, n = X.shape
+        levels = max_depth + 1
+        path_feature = np.zeros((levels, levels), dtype=np.int64)
+        zero = np.zeros((levels, levels))
+        one = np.zeros((levels, levels, n))
+        weight = np.zeros((levels, levels, n))
+        length = np.zeros(levels, dtype=np.int64)
+        incoming_zero = np.ones(levels)
+        incoming_one = np.ones((levels, n))
+        phi = np.zeros((n_features, n))
+        next_one = np.zeros(n)
+        total = np.zeros(n)
+        stack = np.zeros((len(left) + 1, 2), dtype=np.int64) # node, parent
+        stack_level = np.zeros(len(left) + 1, dtype=np.int64)
+        stack[0, 0], stack[0, 1] = 0, -1
+        top = 1
+        while top > 0:
+            top -= 1
+            node, parent, level = stack[top, 0], stack[top, 1], stack_level[top]
+            if parent < 0:
+                l = 0
+                path_feature[0, 0], zero[0, 0] = -1, 1.0
+                one[0, 0, :] = 1.0
+                weight[0, 0, :] = 1.0
+            else:
+                l = length[level - 1]
+                for e in range(l):
+                    path_feature[level, e] = path_feature[level - 1, e]
+                    zero[level, e] = zero[level - 1, e]
+                    for s in range(n):
+                        one[level, e, s] = one[level - 1, e, s]
+                        weight[level, e, s] = weight[level - 1, e, s]
+                z = incoming_zero[level - 1] * cover[node] / cover[parent]
+                f = feature[parent]
+                is_left = left[parent] == node
+                path_feature[level, l], zero[level, l] = f, z
+                for s in range(n):
+                    follows = X[f, s] <= threshold[parent]
+                    one[level, l, s] = incoming_one[level - 1, s] if follows == is_left else 0.0
+                    weight[level, l, s] = 0.0
+                for i in range(l - 1, -1, -1):
+                    for s in range(n):
+                        weight[level, i + 1, s] += one[level, l, s] * weight[level, i, s] * (i + 1) / (l + 1)
+                        weight[level, i, s] = z * weight[level, i, s] * (l - i) / (l + 1)
+            l += 1
+            d = l - 1
+            if left[node] == right[node]:
+                for k in range(1, l):
+                    z = zero[level, k]
+                    for s in range(n):
+                        next_one[s] = weight[level, d, s]
+                        total[s] = 0.0
+                    for i in range(d - 1, -1, -1):
+                        for s in range(n):
+                            o = one[level, k, s]
+                            if o != 0:
+                                tmp = next_one[s] * (d + 1) / ((i + 1) * o)
+                                total[s] += tmp
+                                next_one[s] = weight[level, i, s] - tmp * z * (d - i) / (d + 1)
+                            elif z != 0:
+                                total[s] += weight[level, i, s] / z * (d + 1) / (d - i)
+                    f = path_feature[level, k]
+                    for s in range(n):
+                        phi[f, s] += total[s] * (one[level, k, s] - z) * value[node]
+                continue
+            k = -1
+            for e in range(1, l):
+                if path_feature[level, e] == feature[node]:
+                    k = e
+                    break
+            if k > 0:
+                z = zero[level, k]
+                incoming_zero[level] = z
+                for s in range(n):
+                    incoming_one[level, s] = one[level, k, s]
+                    next_one[s] = weight[level, d, s]
+                for i in range(d - 1, -1, -1):
+                    for s in range(n):
+                        o = incoming_one[level, s]
+                        if o != 0:
+                            unwound = next_one[s] * (d + 1) / ((i + 1) * o)
+                            next_one[s] = weight[level, i, s] - unwound * z * (d - i) / (d + 1)
+                            weight[level, i, s] = unwound
+                        else:
+                            weight[level, i, s] = weight[level, i, s] * (d + 1) / (z * (d - i))
+                for e in range(k, d):
+                    path_feature[level, e] = path_feature[level, e + 1]
+                    zero[level, e] = zero[level, e + 1]
+                    for s in range(n):
+                        one[level, e, s] = one[level, e + 1, s]
+                l -= 1
+            else:
+                incoming_zero[level] = 1.0
+                incoming_one[level, :] = 1.0
+            length[level] = l
+            stack[top, 0], stack[top, 1], stack_level[top] = right[node], node, level + 1
+            stack[top + 1, 0], stack[top + 1, 1], stack_level[top + 1] = left[node], node, level + 1
+            top += 2
+        return phi
+
+
+def subset_counts(query, full, targets):
+    """
+    `query` and `full` are item bitsets (rules x words, see
+    `condition_encoding.RuleCodes.bitsets`) in analysis order.
+    Returns the arrays `(support, same)`: for each rule `i`, the number of
+    rules `j > i` with `query[i]` contained in `full[j]`, and how many of
+    them have the same target.
+    """
+    query = np.ascontiguousarray(query, dtype=np.uint64)
+    full = np.ascontiguousarray(full, dtype=np.uint64)
+    targets = np.ascontiguousarray(targets, dtype=np.int64)
+    if BACKEND == 'numba':
+        return subset_counts_numba(query, full, targets)
+    return subset_counts_numpy(query, full, targets)
+
+
+def subset_target_counts(query, full, targets, n_targets):
+    """
+    As `subset_counts`, with `targets` given as indices `0..n_targets-1`.
+    Returns the matrix (rules x targets) of the number of rules `j > i` with
+    `query[i]` contained in `full[j]`, by the target of rule `j`.
+    """
+    query = np.ascontiguousarray(query, dtype=np.uint64)
+    full = np.ascontiguousarray(full, dtype=np.uint64)
+    targets = np.ascontiguousarray(targets, dtype=np.int64)
+    if BACKEND == 'numba':
+        return subset_target_counts_numba(query, full, targets, n_targets)
+    return subset_target_counts_numpy(query, full, targets, n_targets)
+
+
+def tree_paths(children_left, children_right):
+    """
+    Enumerates the root-to-leaf paths of a tree.
+    Returns `(leaves, offsets, nodes, leq)`: the path to `leaves[k]` passes
+    the inner nodes `nodes[offsets[k]:offsets[k+1]]` (from the root), going
+    to the left child where `leq` is set.
+    """
+    if BACKEND == 'numba':
+        return tree_paths_numba(children_left, children_right)
+    return tree_paths_numpy(np.asarray(children_left), np.asarray(children_right))
+
+
+def subtree_neg_ratios(tree_):
+    """
+    Returns, for every node of the tree, the fraction of leaves in its
+    subtree which classify as unknown (label 0).
+    """
+    value = np.ascontiguousarray(tree_.value[:, 0, :], dtype=np.float64)
+    children_left = np.ascontiguousarray(tree_.children_left, dtype=np.int64)
+    children_right = np.ascontiguousarray(tree_.children_right, dtype=np.int64)
+    if BACKEND == 'numba':
+        return subtree_neg_ratios_numba(children_left, children_right, value)
+    return subtree_neg_ratios_numpy(children_left, children_right, value)
+
+
+def path_shap(left, right, feature, threshold, cover, value, X, max_depth):
+    """
+    Path-dependent TreeSHAP values (Algorithm 2 of Lundberg et al., see
+    `treeshap`) of one tree with `max_depth` for the samples `X`
+    (features x samples), where `value` holds the node values of the
+    explained class. The tree is traversed once per block of samples: each
+    node extends (and at repeated features unwinds) the path of its parent for
+    all samples of the block at once, in a preallocated slot per depth level.
+    Returns the SHAP values as (features x samples) array.
+    """
+    left = np.ascontiguousarray(left, dtype=np.int64)
+    right = np.ascontiguousarray(right, dtype=np.int64)
+    feature = np.ascontiguousarray(feature, dtype=np.int64)
+    threshold = np.ascontiguousarray(threshold, dtype=np.float64)
+    cover = np.ascontiguousarray(cover, dtype=np.float64)
+    value = np.ascontiguousarray(value, dtype=np.float64)
+    kernel = path_shap_numba if BACKEND == 'numba' else path_shap_numpy
+    n_features, n = X.shape
+    phi = np.zeros((n_features, n))
+    block = max(1, BLOCK_BYTES // ((max_depth + 1)**2 * 16))
+    for start in range(0, n, block):
+        end = min(n, start + block)
+        phi[:, start:end] = kernel(left, right, feature, threshold, cover, value,
+                                   np.ascontiguousarray(X[:, start:end]), max_depth)
+    return phi
+
+
+def extract_rules_fast(forest):
+    "Same result as `intrees.extract_rules`, using `tree_paths`."
+    all_rules = {}
+    for tree in forest.estimators_:
+        tree_ = tree.tree_
+        leaves, offsets, nodes, leq = tree_paths(tree_.children_left, tree_.children_right)
+        steps = list(zip(nodes.tolist(), tree_.feature[nodes], tree_.threshold[nodes], leq.tolist()))
+        values = tree_.value[leaves, 0, :]
+        predictions = (values[:, 1] > values[:, 0]).astype(int).tolist()
+        all_rules[tree] = {(tuple(steps[offsets[k]:offsets[k + 1]]), predictions[k])
+                           for k in range(len(leaves))}
+    return all_rules
+
+
+def analyse_rules(rule_set, max_depth=None):
+    "Same result as `intrees.analyse_rule_set`, using `subset_counts`."
+    sorted_rules = sorted(rule_set, key=lambda r: 1/len(r[0]))
+    query_conds = [association_rule_cond(cond, max_depth) for (cond, _) in sorted_rules]
+    codes = RuleCodes.from_rules(sorted_rules, max_depth)
+    support, same = subset_counts(codes.bitsets(query=True), codes.bitsets(), codes.targets)
+    return [[query_conds[i], sorted_rules[i][1], int(support[i]),
+             same[i] / support[i] if same[i] > 0 else 0]
+            for i in range(len(sorted_rules))]
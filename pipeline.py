@@ -0,0 +1,228 @@
+"""
+A small stage graph with on-disk memoization for the analysis scripts.
+
+A pipeline consists of named stages. Each stage is a function which is called
+with the outputs of its declared input stages (in order) as positional
+arguments and its parameters as keyword arguments.
+The output of a stage is pickled into the cache directory under a key derived
+from the stage's name, the source code of its function and of the project
+modules it uses (see `dependency_files`), its parameters, an optional
+`version`, and the keys of its inputs.
+Rerunning the pipeline hence only recomputes the stages whose code,
+parameters or inputs changed; stages whose outputs are cached and not needed
+by any recomputed stage are not even loaded.
+Bump a stage's `version` if its result changes for reasons the key does not
+see (e.g. a helper function in the stage's own module).
+
+With an `Instrumentation`, a stage's `count` function maps its output to the
+number of processed items, which is recorded with the stage's `unit`.
+
+Example:
+
+    pipe = Pipeline('cache')
+    pipe.add('load', load_stage, params={'csv_file_path': path, 'source': file_fingerprint(path)})
+    pipe.add('fit', fit_stage, inputs=['load'], params={'n_estimators': 50}, version=2)
+    pipe.add('extract', extract_stage, inputs=['fit'], count=len, unit='rules')
+    forest = pipe.get('fit')
+"""
+import ast
+import hashlib
+import inspect
+import os
+import pickle
+from pathlib import Path
+
+
+def file_fingerprint(path):
+    """
+    Identifies the contents of a file by its path, size and modification time.
+    Used as stage parameter, so stages reading the file rerun if it changes.
+    """
+    stat = os.stat(path)
+    return (str(Path(path).resolve()), stat.st_size, stat.st_mtime_ns)
+
+
+def code_names(code):
+    "Names used by a code object, including its nested functions and comprehensions."
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if inspect.iscode(const):
+            names |= code_names(const)
+    return names
+
+
+def imported_modules(path):
+    "Top-level names of the modules imported anywhere (also in functions) in the file `path`."
+    names = set()
+    for node in ast.walk(ast.parse(Path(path).read_text())):
+        if isinstance(node, ast.Import):
+            names.update(alias.name.split('.')[0] for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+            names.add(node.module.split('.')[0])
+    return names
+
+
+def dependency_files(func):
+    """
+    Returns the source files of the project modules (the modules next to the
+    one defining `func`) which `func` depends on: the modules of the global
+    objects it uses, the modules it imports (also lazily inside the function),
+    and, transitively, the project modules imported by these.
+    The module defining `func` is not included, only `func` itself is hashed.
+    """
+    try:
+        own = Path(inspect.getfile(func)).resolve()
+    except TypeError:
+        return []
+    code = getattr(func, '__code__', None)
+    if code is None:
+        return []
+
+    def local(name):
+        path = own.parent / (name.split('.')[0] + '.py')
+        return path if path != own and path.exists() else None
+
+    names = code_names(code)
+    module_globals = getattr(func, '__globals__', {})
+    for name in list(names):
+        obj = module_globals.get(name)
+        names.add(obj.__name__ if inspect.ismodule(obj) else getattr(obj, '__module__', None) or name)
+    pending = [path for path in map(local, names) if path is not None]
+    files = set()
+    while pending:
+        path = pending.pop()
+        if path not in files:
+            files.add(path)
+            pending += [p for p in map(local, imported_modules(path)) if p is not None]
+    return sorted(files)
+
+
+def function_fingerprint(func):
+    """
+    Returns a hash of the source code of `func` (or its name if unavailable)
+    and of the project modules it depends on (see `dependency_files`).
+    """
+    try:
+        source = inspect.getsource(func)
+    except (OSError, TypeError):
+        source = getattr(func, '__qualname__', repr(func))
+    h = hashlib.sha256(source.encode())
+    for path in dependency_files(func):
+        h.update(path.name.encode())
+        h.update(path.read_bytes())
+    return h.hexdigest()
+
+
+class Stage:
+    "A node of the pipeline."
+
+    def __init__(self, name, func, inputs=(), params=None, memoize=True, context=None,
+                 version=None, count=None, unit="items"):
+        self.name = name
+        self.func = func
+        self.inputs = list(inputs)
+        self.params = dict(params or {})
+        self.memoize = memoize
+        self.context = dict(context or {})
+        self.version = version
+        self.count = count
+        self.unit = unit
+
+
+class Pipeline:
+    """
+    Stage graph evaluated on demand.
+    If an `Instrumentation` is given, each executed stage is measured as one of
+    its stages.
+    """
+
+    def __init__(self, cache_dir, instr=None):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.instr = instr
+        self.stages = {}
+        self.keys = {}
+        self.outputs = {}
+        self.cached = set() # Names of stages loaded from the cache.
+
+    def add(self, name, func, inputs=(), params=None, memoize=True, context=None,
+            version=None, count=None, unit="items"):
+        """
+        Adds a stage. All `inputs` must name previously added stages.
+        Set `memoize=False` for stages with side effects only,
+        such as writing reports.
+        `context` holds further keyword arguments which do not influence the
+        result and hence are not part of the cache key (e.g. progress output).
+        `version` is part of the cache key. `count`, if given, is called with
+        the stage's output and returns the number of processed items (in `unit`)
+        for the instrumentation.
+        """
+        for i in inputs:
+            if i not in self.stages:
+                raise ValueError("Stage %s depends on unknown stage %s" % (name, i))
+        self.stages[name] = Stage(name, func, inputs, params, memoize, context,
+                                  version, count, unit)
+        return self
+
+    def key(self, name):
+        "Returns the cache key of stage `name`."
+        if name not in self.keys:
+            stage = self.stages[name]
+            h = hashlib.sha256()
+            h.update(name.encode())
+            h.update(function_fingerprint(stage.func).encode())
+            h.update(repr(sorted(stage.params.items())).encode())
+            h.update(repr(stage.version).encode())
+            for i in stage.inputs:
+                h.update(self.key(i).encode())
+            self.keys[name] = h.hexdigest()
+        return self.keys[name]
+
+    def cache_path(self, name):
+        return self.cache_dir / ("%s-%s.pkl" % (name, self.key(name)[:16]))
+
+    def get(self, name):
+        """
+        Returns the output of stage `name`,
+        loading it from the cache or computing it (and its inputs) if needed.
+        """
+        if name in self.outputs:
+            return self.outputs[name]
+        stage = self.stages[name]
+        path = self.cache_path(name)
+        if stage.memoize and path.exists():
+            with open(path, 'rb') as f:
+                output = pickle.load(f)
+            self.cached.add(name)
+            if self.instr is not None:
+                self.instr.log("Stage '%s' loaded from %s" % (name, path))
+        else:
+            args = [self.get(i) for i in stage.inputs]
+            kwargs = dict(stage.params, **stage.context)
+            if self.instr is not None:
+                with self.instr.stage(name) as record:
+                    output = stage.func(*args, **kwargs)
+                    if stage.count is not None:
+                        record.count(stage.count(output), unit=stage.unit)
+            else:
+                output = stage.func(*args, **kwargs)
+            if stage.memoize:
+                tmp = path.with_suffix('.tmp')
+                with open(tmp, 'wb') as f:
+                    pickle.dump(output, f, protocol=pickle.HIGHEST_PROTOCOL)
+                tmp.replace(path) # Atomic, so aborted runs leave no broken entries.
+        self.outputs[name] = output
+        return output
+
+    def run(self, targets=None):
+        """
+        Evaluates the given target stages
+        (default: all stages no other stage depends on).
+        Returns a dictionary of the evaluated outputs.
+        """
+        if targets is None:
+            used = set(i for stage in self.stages.values() for i in stage.inputs)
+            targets = [name for name in self.stages if name not in used]
+        for name in targets:
+            self.get(name)
+        return dict(self.outputs)
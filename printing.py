@@ -5,17 +5,25 @@ from sklearn import metrics
 
 
 def print_classifier_stats(classifier, test_x, test_y):
-    test_acc = metrics.accuracy_score(classifier.predict(test_x), test_y)
-    print("Test accuracy: %0.3f" % (test_acc))
+    pred = classifier.predict(test_x) # Predict only once for all metrics.
+    scores = classifier_metrics(test_y, pred)
 
-    test_bacc = metrics.balanced_accuracy_score(classifier.predict(test_x), test_y)
-    print("Test balanced accuracy: %0.3f" % (test_bacc))
+    print("Test accuracy: %0.3f" % (scores['accuracy']))
+    print("Test balanced accuracy: %0.3f" % (scores['balanced_accuracy']))
+    print("Test precision: %0.3f" % (scores['precision']))
+    print("Test recall: %0.3f" % (scores['recall']))
+    print("Test F1: %0.3f" % (scores['f1']))
 
-    test_prec = metrics.precision_score(classifier.predict(test_x), test_y)
-    print("Test precision: %0.3f" % (test_prec))
 
-    test_rec = metrics.recall_score(classifier.predict(test_x), test_y)
-    print("Test recall: %0.3f" % (test_rec))
-
-    test_f1 = metrics.f1_score(classifier.predict(test_x), test_y)
-    print("Test F1: %0.3f" % (test_f1))
+def classifier_metrics(test_y, pred):
+    """
+    Returns the metrics printed by `print_classifier_stats` as dictionary,
+    computed from a single array of predictions `pred`.
+    """
+    return {
+        'accuracy': metrics.accuracy_score(test_y, pred),
+        'balanced_accuracy': metrics.balanced_accuracy_score(test_y, pred),
+        'precision': metrics.precision_score(test_y, pred, zero_division=0),
+        'recall': metrics.recall_score(test_y, pred, zero_division=0),
+        'f1': metrics.f1_score(test_y, pred, zero_division=0),
+    }
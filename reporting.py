@@ -0,0 +1,150 @@
+"""
+Writes the annotated association rules produced by `analyse_rule_set`
+(lists `[cond, target, support, confidence]`) as ranked reports.
+
+The rules are ranked by descending support and confidence using an integer
+sort key, duplicates (rules with the same condition set) are removed via
+64 bit fingerprints (see `condition_encoding`) instead of sets of frozensets,
+and the output is rendered in large buffered chunks.
+Supported formats are Markdown (as previously written by the cluster
+scripts), CSV and Parquet (the latter requires `pyarrow`).
+"""
+import numpy as np
+import pandas as pd
+
+from condition_encoding import RuleCodes
+from f109_info import f109_name
+
+CHUNK_SIZE = 10000 # Rules rendered per write.
+CONFIDENCE_SCALE = 1 << 20 # Resolution of the integer confidence key.
+
+
+def rank_rules(annotated_rules):
+    """
+    Returns the indices of `annotated_rules` sorted by descending support,
+    then descending confidence, keeping only the first occurrence of each
+    condition set.
+    Ties keep the original order.
+    """
+    n = len(annotated_rules)
+    support = np.fromiter((r[2] for r in annotated_rules), dtype=np.float64, count=n)
+    confidence = np.fromiter((r[3] for r in annotated_rules), dtype=np.float64, count=n)
+    support_key = np.rint(support * CONFIDENCE_SCALE).astype(np.int64)
+    confidence_key = np.rint(confidence * CONFIDENCE_SCALE).astype(np.int64)
+    order = np.lexsort((-confidence_key, -support_key)) # Last key is primary.
+
+    fingerprints = RuleCodes.from_annotated(annotated_rules).fingerprints[order]
+    _, first = np.unique(fingerprints, return_index=True)
+    keep = np.zeros(n, dtype=bool)
+    keep[first] = True
+    return order[keep]
+
+
+def iter_ranked_rules(annotated_rules):
+    "Yields the ranked, deduplicated annotated rules."
+    for i in rank_rules(annotated_rules):
+        yield annotated_rules[i]
+
+
+class ConditionRenderer:
+    """
+    Renders the conditions of association rules as Markdown lines,
+    ordered by descending feature importance.
+    The text per `(feature_id, leq)` item is only formatted once.
+    """
+
+    def __init__(self, importances, feature_name=f109_name):
+        self.importances = np.asarray(importances)
+        # rank[fid] is the position of the feature by descending importance.
+        self.rank = np.empty(len(self.importances), dtype=np.int64)
+        self.rank[np.argsort(-self.importances, kind='stable')] = np.arange(len(self.importances))
+        self.feature_name = feature_name
+        self.lines = {}
+
+    def line(self, fid, leq):
+        key = (fid, leq)
+        text = self.lines.get(key)
+        if text is None:
+            text = "%s%s, importance: %.2f\n" % (self.feature_name(fid),
+                                                 " (low)" if leq else " (**high**)",
+                                                 self.importances[fid])
+            self.lines[key] = text
+        return text
+
+    def render(self, cond, target):
+        rank = self.rank
+        items = sorted(cond, key=lambda c: rank[c[0]])
+        return "".join([self.line(fid, leq) for (fid, leq) in items]) + "=> %d\n" % target
+
+
+def condition_string(cond):
+    """
+    Compact textual form of a condition set for tabular output,
+    e.g. `3<=;18>` for "feature 3 low and feature 18 high".
+    """
+    return ";".join("%d%s" % (fid, "<=" if leq else ">") for (fid, leq) in sorted(cond))
+
+
+def write_markdown_report(annotated_rules, path, importances, feature_name=f109_name,
+                          support_total=1):
+    """
+    Writes the ranked rules as Markdown listing.
+    Support values are printed as `support*100/support_total` percent.
+    Returns the number of written rules.
+    """
+    renderer = ConditionRenderer(importances, feature_name)
+    written = 0
+    with open(path, 'w', buffering=1 << 20) as md:
+        md.write("# Listing of rules found by association rule analysis\n")
+        md.write("\n")
+        md.write("This list is sorted by descending support and confidence values.\n")
+        md.write("\n")
+        chunk = []
+        for rule in iter_ranked_rules(annotated_rules):
+            (cond, out, supp, conf) = rule[:4] # Approximations carry bounds as well.
+            chunk.append(renderer.render(cond, out))
+            chunk.append('Support: %.2f%%, Confidence: %.2f\n\n' % (supp*100/support_total, conf))
+            written += 1
+            if written % CHUNK_SIZE == 0:
+                md.write("".join(chunk))
+                chunk = []
+        md.write("".join(chunk))
+    return written
+
+
+def ranked_rule_frame(annotated_rules):
+    """
+    Returns the ranked, deduplicated rules as DataFrame with the columns
+    `conditions`, `length`, `target`, `support`, and `confidence`.
+    """
+    ranked = [annotated_rules[i] for i in rank_rules(annotated_rules)]
+    return pd.DataFrame({
+        'conditions': [condition_string(r[0]) for r in ranked],
+        'length': np.array([len(r[0]) for r in ranked], dtype=np.int32),
+        'target': np.array([r[1] for r in ranked], dtype=np.int8),
+        'support': np.asarray([r[2] for r in ranked]), # Counts, or estimates if approximated.
+        'confidence': np.array([r[3] for r in ranked], dtype=np.float64),
+    })
+
+
+def write_report(annotated_rules, path, importances=None, fmt='md',
+                 feature_name=f109_name, support_total=1):
+    """
+    Writes the ranked, deduplicated rules to `path` in the format `fmt`,
+    which is one of `md`, `csv`, or `parquet`.
+    The Markdown format needs the feature `importances` to order the
+    conditions.
+
+    Returns the number of written rules.
+    """
+    if fmt == 'md':
+        return write_markdown_report(annotated_rules, path, importances,
+                                     feature_name, support_total)
+    frame = ranked_rule_frame(annotated_rules)
+    if fmt == 'csv':
+        frame.to_csv(path, index=False)
+    elif fmt == 'parquet':
+        frame.to_parquet(path, index=False)
+    else:
+        raise ValueError("Unknown report format: %s" % fmt)
+    return len(frame)
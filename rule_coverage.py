@@ -0,0 +1,197 @@
+"""
+Data-grounded support and confidence of the extracted rules.
+
+`analyse_rule_set` counts support among the other rules of the forest.
+This module instead evaluates the rules on the actual samples:
+for each distinct split `(feature_id, threshold)` of the forest,
+the samples with `x[feature_id] <= threshold` are stored as a bit-packed mask
+(one bit per sample, 64 samples per word).
+The coverage of a rule is then the AND-reduction of the masks of its
+conditions (complemented for `>` conditions), and its per-label counts are
+population counts of that coverage ANDed with the label masks.
+Thousands of rules are reduced at once as a single NumPy operation.
+
+Usage:
+
+    engine = CoverageEngine.from_forest(forest, X, Y)
+    result = engine.evaluate(rules)  # rules as returned by extract_rules
+    annotated = engine.annotate(rules)  # [cond, target, support, confidence]
+"""
+import numpy as np
+
+from intrees import rule_to_assoc_rule
+
+if hasattr(np, 'bitwise_count'):
+    def popcount(words, axis=-1):
+        "Number of set bits along `axis`."
+        return np.bitwise_count(words).sum(axis=axis, dtype=np.int64)
+else:
+    POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+    def popcount(words, axis=-1):
+        "Number of set bits along `axis`."
+        as_bytes = words.view(np.uint8).reshape(words.shape[:-1] + (-1,))
+        return POPCOUNT_TABLE[as_bytes].sum(axis=axis, dtype=np.int64)
+
+
+def pack_columns(columns):
+    """
+    Packs a boolean matrix (masks x samples) into rows of 64 bit words.
+    Bits beyond the last sample are zero.
+    """
+    packed = np.packbits(columns, axis=1, bitorder='little')
+    pad = (-packed.shape[1]) % 8
+    if pad:
+        packed = np.pad(packed, ((0, 0), (0, pad)))
+    return np.ascontiguousarray(packed).view(np.uint64)
+
+
+class CoverageEngine:
+    """
+    Bit-packed split masks over the samples `X` with labels `Y`.
+    """
+
+    def __init__(self, X, Y, splits, chunk=256):
+        X = X.toarray() if hasattr(X, 'toarray') else X
+        # Scikit-Learn compares float32 feature values against the thresholds.
+        X = np.asarray(X, dtype=np.float32).astype(np.float64)
+        self.n_samples = len(X)
+        self.split_ids = {}
+        for split in splits:
+            self.split_ids.setdefault((int(split[0]), float(split[1])), len(self.split_ids))
+        fids = np.array([f for (f, _) in self.split_ids], dtype=np.int64)
+        thresholds = np.array([t for (_, t) in self.split_ids])
+
+        valid = pack_columns(np.ones((1, self.n_samples), dtype=bool))
+        self.n_words = valid.shape[1]
+        # Row per split plus a final all-ones row used to pad short rules.
+        self.masks = np.empty((len(fids) + 1, self.n_words), dtype=np.uint64)
+        for start in range(0, len(fids), chunk):
+            f = fids[start:start+chunk]
+            t = thresholds[start:start+chunk]
+            self.masks[start:start+len(f)] = pack_columns((X[:, f] <= t).T)
+        self.masks[-1] = valid[0]
+        self.valid = valid[0]
+
+        self.labels = np.unique(np.asarray(Y))
+        self.label_masks = pack_columns(np.asarray(Y)[None, :] == self.labels[:, None])
+
+    @staticmethod
+    def from_forest(forest, X, Y):
+        "Builds the masks for all splits used in the forest."
+        splits = []
+        for tree in forest.estimators_:
+            tree_ = tree.tree_
+            internal = tree_.children_left != tree_.children_right
+            splits += zip(tree_.feature[internal], tree_.threshold[internal])
+        return CoverageEngine(X, Y, splits)
+
+    @staticmethod
+    def from_rules(rules, X, Y):
+        "Builds the masks for all splits occurring in the rules."
+        splits = [(fid, thresh) for (cond, _) in rules for (_, fid, thresh, _) in cond]
+        return CoverageEngine(X, Y, splits)
+
+    def encode(self, rules):
+        """
+        Returns the padded split indices and negation flags of the rules
+        as matrices (rules x max length).
+        """
+        length = max([len(cond) for (cond, _) in rules] + [1])
+        index = np.full((len(rules), length), len(self.masks) - 1, dtype=np.int64)
+        negate = np.zeros((len(rules), length), dtype=bool)
+        for row, (cond, _) in enumerate(rules):
+            for pos, (_, fid, thresh, leq) in enumerate(cond):
+                index[row, pos] = self.split_ids[(int(fid), float(thresh))]
+                negate[row, pos] = not leq
+        return index, negate
+
+    def coverage_masks(self, rules):
+        "Returns the packed coverage of each rule (rules x words)."
+        index, negate = self.encode(rules)
+        selected = self.masks[index] # rules x positions x words
+        selected ^= np.where(negate[:, :, None], self.valid, np.uint64(0))
+        return np.bitwise_and.reduce(selected, axis=1)
+
+    def coverage_batches(self, rules, memory_limit=256*2**20):
+        """
+        Yields the rule indices and packed coverage masks of batches of at
+        most `memory_limit` bytes of gathered masks (rules of similar length
+        are batched together).
+        """
+        order = sorted(range(len(rules)), key=lambda i: len(rules[i][0]))
+        start = 0
+        while start < len(order):
+            length = max(len(rules[order[start]][0]), 1)
+            batch_size = max(1, memory_limit // (length * self.n_words * 8))
+            batch = order[start:start+batch_size]
+            yield batch, self.coverage_masks([rules[i] for i in batch])
+            start += len(batch)
+
+    def evaluate(self, rules, memory_limit=256*2**20):
+        """
+        Evaluates the rules on the samples in batches of at most
+        `memory_limit` bytes of gathered masks.
+
+        Returns a dictionary with the arrays
+        `coverage` (number of covered samples per rule),
+        `label_counts` (covered samples per rule and label, columns in the
+        order of `labels`), `labels`, and `accuracy` (fraction of covered
+        samples carrying the rule's target).
+        """
+        rules = list(rules)
+        coverage = np.zeros(len(rules), dtype=np.int64)
+        label_counts = np.zeros((len(rules), len(self.labels)), dtype=np.int64)
+        for batch, covered in self.coverage_batches(rules, memory_limit):
+            coverage[batch] = popcount(covered)
+            for j, label_mask in enumerate(self.label_masks):
+                label_counts[batch, j] = popcount(covered & label_mask)
+
+        targets = np.array([target for (_, target) in rules])
+        target_column = np.searchsorted(self.labels, targets)
+        target_column = np.minimum(target_column, len(self.labels) - 1)
+        hits = label_counts[np.arange(len(rules)), target_column]
+        hits = np.where(self.labels[target_column] == targets, hits, 0)
+        accuracy = np.where(coverage > 0, hits / np.maximum(coverage, 1), 0.0)
+        return {'coverage': coverage, 'label_counts': label_counts,
+                'labels': self.labels, 'accuracy': accuracy}
+
+    def column_counts(self, rules, label_columns, memory_limit=256*2**20):
+        """
+        Covered samples per rule and value of each label column
+        (dictionary `name -> labels of the samples`, e.g. the `Label0` of
+        several backends for the same predicates), computing each rule's
+        coverage only once.
+        Returns a dictionary `name -> (values, counts)` with `counts` of shape
+        (rules x values).
+        """
+        rules = list(rules)
+        columns = {}
+        for name, labels in label_columns.items():
+            labels = np.asarray(labels)
+            values = np.unique(labels)
+            columns[name] = (values, pack_columns(labels[None, :] == values[:, None]),
+                             np.zeros((len(rules), len(values)), dtype=np.int64))
+        for batch, covered in self.coverage_batches(rules, memory_limit):
+            for values, masks, counts in columns.values():
+                for j, mask in enumerate(masks):
+                    counts[batch, j] = popcount(covered & mask)
+        return {name: (values, counts) for name, (values, _, counts) in columns.items()}
+
+    def annotate(self, rules, max_depth=None):
+        """
+        Returns the rules in the format of `analyse_rule_set`,
+        `[cond, target, support, confidence]`, where support is the number of
+        covered samples and confidence the fraction of them with the rule's
+        target.
+        With `max_depth`, only the first `max_depth` conditions are evaluated.
+        """
+        rules = list(rules)
+        if max_depth is not None:
+            rules = [(cond[:max_depth], target) for (cond, target) in rules]
+        result = self.evaluate(rules)
+        annotated = []
+        for i, rule in enumerate(rules):
+            cond, target = rule_to_assoc_rule(rule, max_depth)
+            annotated.append([cond, target, int(result['coverage'][i]), float(result['accuracy'][i])])
+        return annotated
@@ -0,0 +1,188 @@
+"""
+Compares the association rules found for several backends.
+
+The rule sets (lists of annotated rules, pickled `assoc_rules.dat` files,
+rule stores, or Markdown listings) are reduced to one row per canonical item
+set, identified by the 64 bit fingerprint of its `(feature_id, leq)` items
+(see `condition_encoding`), and joined on these fingerprints with hash joins (`pandas.merge`).
+For each pair of backends, the item sets are classified as
+
+* `shared`: found for both backends with the same target,
+* `contradicting`: found for both, but with different targets
+  (e.g. ProB unknown, Z3 solved),
+* `only_<backend>`: found for one of the backends only,
+
+with the support and confidence deltas of the shared and contradicting ones.
+If a backend lists an item set with several targets, the entry with the
+highest support (then confidence) is used.
+
+Usage:
+
+    diff = diff_rule_sets({'prob': prob_rules, 'kodkod': kodkod_rules, 'z3': z3_rules})
+    diff['summary']              # counts per backend pair and class
+    diff['pairs'][('prob', 'z3')] # joined rows of a pair
+
+    python rule_diff.py prob=results/prob/assoc_rules.dat z3=results/z3-rules --out diff
+"""
+import argparse
+import itertools
+import pickle
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from condition_encoding import decode_cond, itemset_fingerprints
+from reporting import condition_string
+
+
+def load_rule_columns(source):
+    """
+    Returns the rule columns (see `rule_store.rule_columns`) of a list of
+    annotated rules, a `RuleStore`, or a path to a pickle (`.dat`), a rule
+    store directory or a Markdown listing. Columns are returned unchanged.
+    """
+    from rule_store import RuleStore, markdown_columns, rule_columns
+
+    if isinstance(source, dict):
+        return source
+    if isinstance(source, (str, Path)):
+        path = Path(source)
+        if path.is_dir():
+            source = RuleStore(path)
+        elif path.suffix == '.dat':
+            with open(path, 'rb') as dat:
+                source = pickle.load(dat)
+        else:
+            return markdown_columns(path)[0]
+    if hasattr(source, 'item_rules'):
+        return {name: np.asarray(getattr(source, name))
+                for name in ['offsets', 'items', 'target', 'support', 'confidence']}
+    return rule_columns(source)
+
+
+def rule_frame(columns, relative_support=False):
+    """
+    One row per distinct item set: fingerprint `fp`, `length`, `target`,
+    `support` and `confidence`, and the position `rule` in the input.
+    With `relative_support`, supports are divided by the number of rules.
+    """
+    offsets = columns['offsets']
+    support = np.asarray(columns['support'], dtype=np.float64)
+    if relative_support and len(support):
+        support = support / len(support)
+    frame = pd.DataFrame({
+        'fp': itemset_fingerprints(offsets, columns['items']),
+        'length': np.diff(offsets),
+        'target': np.asarray(columns['target']),
+        'support': support,
+        'confidence': np.asarray(columns['confidence'], dtype=np.float64),
+        'rule': np.arange(len(support)),
+    })
+    frame = frame.sort_values(['support', 'confidence'], ascending=False, kind='stable')
+    return frame.drop_duplicates('fp').reset_index(drop=True)
+
+
+def join_pair(left, right, left_name, right_name):
+    """
+    Outer hash join of two rule frames on the fingerprints.
+    Adds the columns `status`, `support_delta` and `confidence_delta`
+    (right minus left).
+    """
+    joined = pd.merge(left, right, on='fp', how='outer', suffixes=('_' + left_name, '_' + right_name),
+                      indicator=True)
+    lt, rt = joined['target_' + left_name], joined['target_' + right_name]
+    status = np.where(joined['_merge'] == 'left_only', 'only_' + left_name,
+                      np.where(joined['_merge'] == 'right_only', 'only_' + right_name,
+                               np.where(lt == rt, 'shared', 'contradicting')))
+    joined['status'] = status
+    joined['support_delta'] = joined['support_' + right_name] - joined['support_' + left_name]
+    joined['confidence_delta'] = joined['confidence_' + right_name] - joined['confidence_' + left_name]
+    return joined.drop(columns='_merge')
+
+
+def diff_rule_sets(rule_sets, relative_support=False):
+    """
+    Compares the rule sets given as dictionary `backend -> rules`
+    (any source accepted by `load_rule_columns`).
+    Returns a dictionary with
+    `frames` (per backend rule frame), `pairs` (joined frame per backend pair),
+    `summary` (status counts per pair), and `presence` (one row per item set
+    with the target per backend, `NaN` where absent).
+    """
+    columns = {name: load_rule_columns(source) for name, source in rule_sets.items()}
+    frames = {name: rule_frame(cols, relative_support) for name, cols in columns.items()}
+
+    pairs = {}
+    summary = []
+    for a, b in itertools.combinations(frames, 2):
+        joined = join_pair(frames[a], frames[b], a, b)
+        pairs[(a, b)] = joined
+        counts = joined['status'].value_counts()
+        row = {'left': a, 'right': b}
+        for key, status in [('shared', 'shared'), ('contradicting', 'contradicting'),
+                            ('only_left', 'only_' + a), ('only_right', 'only_' + b)]:
+            row[key] = int(counts.get(status, 0))
+        shared = joined['status'] == 'shared'
+        row['mean_support_delta'] = joined.loc[shared, 'support_delta'].mean()
+        row['mean_confidence_delta'] = joined.loc[shared, 'confidence_delta'].mean()
+        summary.append(row)
+
+    presence = None
+    for name, frame in frames.items():
+        part = frame[['fp', 'target']].rename(columns={'target': name})
+        presence = part if presence is None else pd.merge(presence, part, on='fp', how='outer')
+    if presence is not None:
+        targets = presence[list(frames)]
+        presence['backends'] = targets.notna().sum(axis=1)
+        presence['targets'] = targets.nunique(axis=1)
+    return {'frames': frames, 'pairs': pairs, 'summary': pd.DataFrame(summary),
+            'presence': presence, 'columns': columns}
+
+
+def describe_rows(joined, columns, name):
+    "Adds the `conditions` text to joined rows, taken from backend `name`."
+    rules = joined['rule_' + name] if 'rule_' + name in joined else joined['rule']
+    offsets, items = columns['offsets'], columns['items']
+    texts = []
+    for rule in rules:
+        if pd.isna(rule):
+            texts.append(None)
+            continue
+        codes = items[offsets[int(rule)]:offsets[int(rule) + 1]]
+        texts.append(condition_string(decode_cond(codes.tolist())))
+    return texts
+
+
+def write_diff(diff, target_dir):
+    """
+    Writes the summary and, per backend pair, the joined rows with their
+    conditions as CSV files.
+    """
+    target_dir = Path(target_dir)
+    target_dir.mkdir(parents=True, exist_ok=True)
+    diff['summary'].to_csv(target_dir / 'summary.csv', index=False)
+    for (a, b), joined in diff['pairs'].items():
+        joined = joined.copy()
+        from_a = describe_rows(joined, diff['columns'][a], a)
+        from_b = describe_rows(joined, diff['columns'][b], b)
+        joined.insert(1, 'conditions', [x if x is not None else y for x, y in zip(from_a, from_b)])
+        joined['abs_delta'] = joined['support_delta'].abs()
+        joined = joined.sort_values(['status', 'abs_delta'], ascending=[True, False], kind='stable')
+        joined.drop(columns=['fp', 'abs_delta']).to_csv(target_dir / ('%s-%s.csv' % (a, b)), index=False)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the rule sets of several backends.")
+    parser.add_argument('rule_sets', nargs='+', metavar='NAME=PATH',
+                        help="Rule pickle (.dat), rule store directory or Markdown listing per backend")
+    parser.add_argument('--out', default=None, help="Directory for the CSV output")
+    parser.add_argument('--relative-support', action='store_true',
+                        help="Divide supports by the number of rules of each backend")
+    args = parser.parse_args()
+
+    sources = dict(arg.split('=', 1) for arg in args.rule_sets)
+    diff = diff_rule_sets(sources, args.relative_support)
+    print(diff['summary'].to_string(index=False))
+    if args.out:
+        write_diff(diff, args.out)
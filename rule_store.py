@@ -0,0 +1,285 @@
+"""
+Columnar on-disk store for association rule results.
+
+Instead of unpickling `assoc_rules.dat` or re-parsing the Markdown listings,
+the rules are written once into a directory of `.npy` columns which are
+memory-mapped when the store is opened:
+
+* `offsets.npy`, `items.npy`: the conditions, rule `i` consisting of the items
+  `items[offsets[i]:offsets[i+1]]`, each item encoded as `2*feature_id + leq`
+  (see `condition_encoding`),
+* `target.npy`, `support.npy`, `confidence.npy`: one value per rule,
+* `support_order.npy`: rule ids by ascending support (support range index),
+* `item_offsets.npy`, `item_rules.npy`: posting lists, the ids of the rules
+  containing item `c` being `item_rules[item_offsets[c]:item_offsets[c+1]]`,
+* `meta.json`: number of rules, source and unit of the support values.
+
+A query only touches the posting lists of the requested items and the
+columns of the candidate rules:
+
+    store = RuleStore('results/z3-f109-rules')
+    # Unknown-target rules with feature 18 high and support >= 1000
+    ids = store.query(items=[(18, False)], target=0, min_support=1000)
+    store.frame(ids)
+
+Importers exist for the pickled results of the cluster scripts
+(`import_pickle`) and for their Markdown listings (`import_markdown`),
+e.g. `python rule_store.py import results/z3-rules results/z3-rules.store`.
+"""
+import argparse
+import json
+import pickle
+import re
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from condition_encoding import decode_cond, encode_conds, item_code
+from f109_info import f109_name
+from reporting import condition_string
+
+COLUMNS = ['offsets', 'items', 'target', 'support', 'confidence', 'support_order',
+           'item_offsets', 'item_rules']
+
+FEATURE_LINE = re.compile(r'^(.*) \((low|\*\*high\*\*)\), importance: ')
+SUPPORT_LINE = re.compile(r'^Support: ([-+.0-9eE]+)(%?), Confidence: ([-+.0-9eE]+)')
+
+
+def rule_columns(annotated_rules):
+    """
+    Converts annotated rules (`[cond, target, support, confidence, ...]`)
+    into the columns `offsets`, `items`, `target`, `support` and `confidence`.
+    """
+    n = len(annotated_rules)
+    offsets, items = encode_conds([r[0] for r in annotated_rules])
+    columns = {
+        'offsets': offsets,
+        'items': items,
+        'target': np.fromiter((r[1] for r in annotated_rules), dtype=np.int64, count=n),
+        'support': np.fromiter((r[2] for r in annotated_rules), dtype=np.float64, count=n),
+        'confidence': np.fromiter((r[3] for r in annotated_rules), dtype=np.float64, count=n),
+    }
+    return columns
+
+
+def write_rule_store(annotated_rules, path, n_features=109, support_unit='count', source=None):
+    """
+    Writes annotated rules (`[cond, target, support, confidence, ...]`) to the
+    store directory `path`. `support_unit` documents whether support values are
+    counts or fractions.
+    Returns the opened `RuleStore`.
+    """
+    write_columns(rule_columns(annotated_rules), path, n_features, support_unit, source)
+    return RuleStore(path)
+
+
+def write_columns(columns, path, n_features, support_unit, source):
+    "Adds the indexes to the rule columns and writes all files."
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    offsets = columns['offsets']
+    n = len(offsets) - 1
+    n_items = max(2 * n_features, int(columns['items'].max()) + 1 if len(columns['items']) else 0)
+
+    columns['support_order'] = np.argsort(columns['support'], kind='stable')
+    rule_of_item = np.repeat(np.arange(n, dtype=np.int64), np.diff(offsets))
+    order = np.argsort(columns['items'], kind='stable') # Keeps rule ids sorted per item.
+    columns['item_rules'] = rule_of_item[order]
+    columns['item_offsets'] = np.zeros(n_items + 1, dtype=np.int64)
+    np.cumsum(np.bincount(columns['items'], minlength=n_items), out=columns['item_offsets'][1:])
+
+    for name in COLUMNS:
+        np.save(path / (name + ".npy"), columns[name])
+    with open(path / "meta.json", 'w') as meta:
+        json.dump({'rules': n, 'n_features': n_features, 'support_unit': support_unit,
+                   'source': source}, meta, indent=2)
+
+
+class RuleStore:
+    "Memory-mapped rule store directory, see the module documentation."
+
+    def __init__(self, path):
+        self.path = Path(path)
+        with open(self.path / "meta.json") as meta:
+            self.meta = json.load(meta)
+        for name in COLUMNS:
+            setattr(self, name, np.load(self.path / (name + ".npy"), mmap_mode='r'))
+
+    def __len__(self):
+        return self.meta['rules']
+
+    def rules_with_item(self, fid, leq):
+        "Sorted ids of the rules containing the item `(fid, leq)`."
+        code = item_code(fid, leq)
+        if code + 1 >= len(self.item_offsets):
+            return np.zeros(0, dtype=np.int64)
+        return self.item_rules[self.item_offsets[code]:self.item_offsets[code + 1]]
+
+    def support_range(self, min_support=None, max_support=None):
+        "Ids of the rules with `min_support <= support <= max_support`."
+        sorted_support = self.support[self.support_order]
+        start = 0 if min_support is None else np.searchsorted(sorted_support, min_support, 'left')
+        end = len(self) if max_support is None else np.searchsorted(sorted_support, max_support, 'right')
+        return np.sort(self.support_order[start:end])
+
+    def query(self, items=(), target=None, min_support=None, max_support=None,
+              min_confidence=None):
+        """
+        Returns the ids of the rules which contain all `items`
+        (`(feature_id, leq)` tuples, `leq=False` meaning high values),
+        have the given `target` and a support (confidence) within the bounds,
+        ordered by descending support.
+        """
+        ids = None
+        for (fid, leq) in items:
+            posting = self.rules_with_item(fid, leq)
+            ids = np.asarray(posting) if ids is None else np.intersect1d(ids, posting, assume_unique=True)
+        if ids is None:
+            if min_support is None and max_support is None:
+                ids = np.arange(len(self))
+            else:
+                ids = self.support_range(min_support, max_support)
+        support = self.support[ids]
+        keep = np.ones(len(ids), dtype=bool)
+        if target is not None:
+            keep &= self.target[ids] == target
+        if min_support is not None:
+            keep &= support >= min_support
+        if max_support is not None:
+            keep &= support <= max_support
+        if min_confidence is not None:
+            keep &= self.confidence[ids] >= min_confidence
+        ids, support = ids[keep], support[keep]
+        return ids[np.argsort(-support, kind='stable')]
+
+    def cond(self, i):
+        "Condition set of rule `i` as set of `(feature_id, leq)` tuples."
+        return decode_cond(self.items[self.offsets[i]:self.offsets[i + 1]].tolist())
+
+    def rules(self, ids):
+        "Rules `ids` in the format `[cond, target, support, confidence]`."
+        return [[self.cond(i), int(self.target[i]), float(self.support[i]),
+                 float(self.confidence[i])] for i in ids]
+
+    def frame(self, ids, feature_name=None):
+        """
+        Rules `ids` as DataFrame. With `feature_name` (e.g. `f109_name`),
+        a readable description of the conditions is added.
+        """
+        conds = [self.cond(i) for i in ids]
+        frame = pd.DataFrame({
+            'rule': np.asarray(ids),
+            'conditions': [condition_string(c) for c in conds],
+            'length': [len(c) for c in conds],
+            'target': self.target[ids],
+            'support': self.support[ids],
+            'confidence': self.confidence[ids],
+        })
+        if feature_name is not None:
+            frame['description'] = [
+                "; ".join("%s (%s)" % (feature_name(fid), "low" if leq else "high")
+                          for (fid, leq) in sorted(c)) for c in conds]
+        return frame
+
+
+def import_pickle(dat_path, path, n_features=109, support_unit='count'):
+    "Imports a pickled list of annotated rules (`assoc_rules.dat`)."
+    with open(dat_path, 'rb') as dat:
+        rules = pickle.load(dat)
+    return write_rule_store(rules, path, n_features, support_unit, source=str(dat_path))
+
+
+def markdown_columns(md_path, feature_name=f109_name, n_features=109):
+    """
+    Parses a Markdown rule listing as written by the cluster scripts into
+    rule columns (see `rule_columns`). Feature names are mapped back to ids
+    via `feature_name`. Percentages (`Support: 1.23%`) are converted to
+    fractions, plain support values are kept as counts.
+    Returns the columns and the support unit (`'fraction'` or `'count'`).
+    """
+    feature_ids = {feature_name(i): i for i in range(n_features)}
+    items, offsets, targets, supports, confidences = [], [0], [], [], []
+    units = set()
+    cond = []
+    with open(md_path) as md:
+        for line_no, line in enumerate(md, 1):
+            match = FEATURE_LINE.match(line)
+            if match:
+                name, level = match.groups()
+                if name not in feature_ids:
+                    raise ValueError("%s:%d: unknown feature %r" % (md_path, line_no, name))
+                cond.append(item_code(feature_ids[name], level == 'low'))
+            elif line.startswith('=> '):
+                targets.append(int(line[3:]))
+                items += sorted(cond)
+                offsets.append(len(items))
+                cond = []
+            else:
+                match = SUPPORT_LINE.match(line)
+                if match:
+                    support, percent, confidence = match.groups()
+                    units.add('fraction' if percent else 'count')
+                    supports.append(float(support) / (100 if percent else 1))
+                    confidences.append(float(confidence))
+    if len(units) > 1:
+        raise ValueError("%s mixes percentage and absolute support values" % md_path)
+    if not (len(targets) == len(supports) == len(offsets) - 1):
+        raise ValueError("%s: incomplete rule listing" % md_path)
+
+    columns = {
+        'offsets': np.array(offsets, dtype=np.int64),
+        'items': np.array(items, dtype=np.int32),
+        'target': np.array(targets, dtype=np.int64),
+        'support': np.array(supports, dtype=np.float64),
+        'confidence': np.array(confidences, dtype=np.float64),
+    }
+    return columns, units.pop() if units else 'count'
+
+
+def import_markdown(md_path, path, feature_name=f109_name, n_features=109):
+    "Imports a Markdown rule listing, see `markdown_columns`."
+    columns, unit = markdown_columns(md_path, feature_name, n_features)
+    write_columns(columns, path, n_features, unit, str(md_path))
+    return RuleStore(path)
+
+
+def parse_item(text):
+    "Parses `18:high` or `3:low` into `(feature_id, leq)`."
+    fid, level = text.split(':')
+    if level not in ('low', 'high'):
+        raise argparse.ArgumentTypeError("Expected <feature id>:low or <feature id>:high")
+    return (int(fid), level == 'low')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Columnar association rule store.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    importer = commands.add_parser('import', help="Import a pickled or Markdown rule file")
+    importer.add_argument('source')
+    importer.add_argument('store')
+    importer.add_argument('--n-features', type=int, default=109)
+    query = commands.add_parser('query', help="Query a store")
+    query.add_argument('store')
+    query.add_argument('--item', type=parse_item, action='append', default=[],
+                       help="Required item, e.g. 18:high (repeatable)")
+    query.add_argument('--target', type=int, default=None)
+    query.add_argument('--min-support', type=float, default=None)
+    query.add_argument('--max-support', type=float, default=None)
+    query.add_argument('--min-confidence', type=float, default=None)
+    query.add_argument('--limit', type=int, default=20)
+    args = parser.parse_args()
+
+    if args.command == 'import':
+        if args.source.endswith('.dat'):
+            store = import_pickle(args.source, args.store, args.n_features)
+        else:
+            store = import_markdown(args.source, args.store, n_features=args.n_features)
+        print("Imported %d rules into %s" % (len(store), args.store))
+    else:
+        store = RuleStore(args.store)
+        ids = store.query(args.item, args.target, args.min_support, args.max_support,
+                          args.min_confidence)
+        print("%d matching rules" % len(ids))
+        with pd.option_context('display.max_colwidth', 200, 'display.width', 250):
+            print(store.frame(ids[:args.limit], f109_name).to_string(index=False))
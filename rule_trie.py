@@ -0,0 +1,206 @@
+"""
+Prefix trie of the extracted rules for the association rule analysis at all
+depth cutoffs at once.
+
+A rule is a path from the root of a tree to a leaf, so all rules of a tree
+share their prefixes, and `association_rule_cond(cond, max_depth)` is just the
+item set of the path prefix of length `max_depth`.
+`RuleTrie` stores every distinct prefix (sequence of items `(fid, leq)`,
+thresholds are irrelevant for association rules) once, across all trees,
+and each rule as a reference to its last node.
+Its size is proportional to the number of inner tree nodes rather than to the
+summed rule lengths.
+
+`analyse_depths` computes the support and confidence of `analyse_rule_set`
+for several depth cutoffs in one pass over the rules:
+the rules are visited in reverse analysis order; the per-target counters of a
+rule's prefix nodes then count exactly the (full) rules after it which contain
+the prefix item set, before the rule itself is added by a traversal of the
+trie restricted to its items (which marks all prefixes contained in it).
+
+Usage:
+
+    trie = RuleTrie.from_rules(rule_list)   # or RuleTrie.from_forest(forest)
+    support, confidence = trie.analyse_depths([5, 10, None])
+    annotated = trie.annotate(max_depth=10)  # as analyse_rule_set(rule_list, 10)
+"""
+import numpy as np
+
+from condition_encoding import decode_item, item_code
+
+
+class RuleTrie:
+    "Prefix trie of rules, see the module documentation."
+
+    def __init__(self):
+        self.parent = [-1]
+        self.item = [-1]
+        self.depth = [0]
+        self.children = [{}]
+        self.rule_nodes = []
+        self.targets = []
+
+    def child(self, node, code):
+        "Returns the child of `node` along item `code`, creating it if needed."
+        child = self.children[node].get(code)
+        if child is None:
+            child = len(self.parent)
+            self.children[node][code] = child
+            self.parent.append(node)
+            self.item.append(code)
+            self.depth.append(self.depth[node] + 1)
+            self.children.append({})
+        return child
+
+    def add_rule(self, cond, target):
+        "Adds a rule given as `(node_id, feature_id, threshold, leq)` conditions."
+        node = 0
+        for (_, fid, _, leq) in cond:
+            node = self.child(node, item_code(fid, leq))
+        self.rule_nodes.append(node)
+        self.targets.append(target)
+
+    @staticmethod
+    def from_rules(rules):
+        "Builds the trie of `(cond, target)` rules as returned by `extract_rules`."
+        trie = RuleTrie()
+        for (cond, target) in rules:
+            trie.add_rule(cond, target)
+        return trie.freeze()
+
+    @staticmethod
+    def from_forest(forest):
+        """
+        Builds the trie directly from the tree structures, without
+        materialising the rules. Rules are added in depth-first order
+        (left subtree first), targets as in `extract_rules`.
+        """
+        trie = RuleTrie()
+        for estimator in forest.estimators_:
+            tree = estimator.tree_
+            stack = [(0, 0)] # (tree node, trie node)
+            while stack:
+                tree_node, node = stack.pop()
+                left = tree.children_left[tree_node]
+                right = tree.children_right[tree_node]
+                if left == right:
+                    nprob, pprob = tree.value[tree_node][0]
+                    trie.rule_nodes.append(node)
+                    trie.targets.append(1 if pprob > nprob else 0)
+                else:
+                    fid = tree.feature[tree_node]
+                    stack.append((right, trie.child(node, item_code(fid, False))))
+                    stack.append((left, trie.child(node, item_code(fid, True))))
+        return trie.freeze()
+
+    def freeze(self):
+        "Converts the trie into arrays with the children of each node in CSR form."
+        self.parent = np.asarray(self.parent, dtype=np.int64)
+        self.item = np.asarray(self.item, dtype=np.int64)
+        self.depth = np.asarray(self.depth, dtype=np.int64)
+        self.rule_nodes = np.asarray(self.rule_nodes, dtype=np.int64)
+        self.targets = np.asarray(self.targets, dtype=np.int64)
+        self.children = None
+        self.child_ids = np.argsort(self.parent[1:], kind='stable') + 1
+        counts = np.bincount(self.parent[1:], minlength=len(self.parent))
+        self.child_start = np.zeros(len(self.parent) + 1, dtype=np.int64)
+        np.cumsum(counts, out=self.child_start[1:])
+        return self
+
+    def __len__(self):
+        return len(self.rule_nodes)
+
+    def paths(self):
+        """
+        Returns the (rules x (max length + 1)) matrix of the prefix nodes of
+        each rule: column `d` holds the node of its first `d` items
+        (or its last node for shorter rules).
+        """
+        lengths = self.depth[self.rule_nodes]
+        max_len = int(lengths.max()) if len(lengths) else 0
+        paths = np.repeat(self.rule_nodes[:, None], max_len + 1, axis=1)
+        paths[:, 0] = 0
+        current = self.rule_nodes.copy()
+        for level in range(max_len, 0, -1):
+            at_level = self.depth[current] == level
+            paths[at_level, level] = current[at_level]
+            current = np.where(at_level, self.parent[current], current)
+        return paths
+
+    def contained_nodes(self, member):
+        """
+        Returns the nodes whose prefix item set is contained in the item set
+        given by the boolean array `member` (indexed by item code).
+        """
+        found = [np.zeros(1, dtype=np.int64)]
+        frontier = found[0]
+        while len(frontier):
+            starts = self.child_start[frontier]
+            counts = self.child_start[frontier + 1] - starts
+            total = int(counts.sum())
+            if total == 0:
+                break
+            shift = np.repeat(starts - np.cumsum(counts) + counts, counts)
+            kids = self.child_ids[shift + np.arange(total)]
+            frontier = kids[member[self.item[kids]]]
+            found.append(frontier)
+        return np.concatenate(found)
+
+    def analysis_order(self):
+        "Rule order of `analyse_rule_set`: longest first, stable."
+        return np.argsort(-self.depth[self.rule_nodes], kind='stable')
+
+    def analyse_depths(self, depths=(None,), progress=None):
+        """
+        Support and confidence of each rule (in analysis order, see
+        `analysis_order`) for each depth cutoff in `depths` (`None` meaning
+        the full rule), as two (rules x depths) arrays.
+        The values equal those of `analyse_rule_set(rules, max_depth=d)`.
+        """
+        paths = self.paths()
+        lengths = self.depth[self.rule_nodes]
+        max_len = paths.shape[1] - 1
+        columns = np.array([max_len if d is None else min(d, max_len) for d in depths])
+        labels, target_index = np.unique(self.targets, return_inverse=True)
+        counters = np.zeros((len(self.parent), len(labels)), dtype=np.int64)
+        member = np.zeros(max(int(self.item.max()) + 1, 1), dtype=bool)
+
+        order = self.analysis_order()
+        support = np.zeros((len(order), len(columns)), dtype=np.int64)
+        same = np.zeros((len(order), len(columns)), dtype=np.int64)
+        for position in range(len(order) - 1, -1, -1):
+            rule = order[position]
+            t = target_index[rule]
+            queries = paths[rule, columns]
+            support[position] = counters[queries].sum(axis=1)
+            same[position] = counters[queries, t]
+
+            items = self.item[paths[rule, 1:lengths[rule] + 1]]
+            member[items] = True
+            counters[self.contained_nodes(member), t] += 1
+            member[items] = False
+            if progress is not None:
+                progress.update()
+        confidence = np.where(same > 0, same / np.maximum(support, 1), 0.0)
+        return support, confidence
+
+    def condition(self, rule, max_depth=None):
+        "Association rule condition (set of `(fid, leq)`) of a rule."
+        node = self.rule_nodes[rule]
+        while max_depth is not None and self.depth[node] > max_depth:
+            node = self.parent[node]
+        cond = set()
+        while node > 0:
+            cond.add(decode_item(self.item[node]))
+            node = self.parent[node]
+        return cond
+
+    def annotate(self, max_depth=None, progress=None):
+        """
+        Returns `[cond, target, support, confidence]` per rule in analysis
+        order, like `analyse_rule_set(rules, max_depth)`.
+        """
+        support, confidence = self.analyse_depths([max_depth], progress)
+        return [[self.condition(rule, max_depth), int(self.targets[rule]),
+                 int(support[i, 0]), float(confidence[i, 0])]
+                for i, rule in enumerate(self.analysis_order())]
@@ -0,0 +1,232 @@
+"""
+Local scoring service recommending a backend (ProB, Kodkod or Z3) for a
+predicate given its F109 feature vector.
+
+The per-backend forests are exported once with `compiled_forest.export_forest`
+into a model directory (`<backend>.npz`) and loaded when the service starts,
+so clients neither import Scikit-Learn nor load models per predicate.
+The service speaks line-delimited JSON over a Unix socket or a localhost TCP
+port. Each request line is an object with a `features` list, the response
+holds the probability that each backend solves the predicate and the
+recommended (most probable) backend:
+
+    {"features": [0.0, 1.0, ...]}
+    {"probabilities": {"prob": 0.93, "kodkod": 0.41, "z3": 0.77}, "backend": "prob"}
+
+Concurrent requests are gathered into micro-batches (at most `max_batch`
+requests, waiting at most `max_wait` seconds for more) which are scored with
+a single vectorised call per backend.
+
+Usage:
+
+    python scoring_service.py export models --data-dir data --date 2020-01-23
+    python scoring_service.py serve models --socket /tmp/backend-scoring.sock
+
+    with ScoringClient(socket_path='/tmp/backend-scoring.sock') as client:
+        client.score(features)
+"""
+import argparse
+import asyncio
+import json
+import socket
+from pathlib import Path
+
+import numpy as np
+
+from compiled_forest import CompiledForest
+
+BACKENDS = ['prob', 'kodkod', 'z3']
+SOLVED = 1 # Label of predicates solved by the backend.
+
+
+def load_models(model_dir, backends=BACKENDS):
+    "Loads the compiled forest `<backend>.npz` of each backend."
+    return {backend: CompiledForest.load(Path(model_dir) / (backend + ".npz"))
+            for backend in backends}
+
+
+def export_models(model_dir, data_dir='data', date='2020-01-23', feature_set='f109',
+                  backends=BACKENDS, n_jobs=6):
+    """
+    Trains the analysis forest of each backend on its `_unique` data set and
+    exports it to `model_dir`.
+    """
+    from cluster_analysis import FOREST_PARAMS, fit_stage, load_stage
+    from compiled_forest import export_forest
+    from datasets import FEATURE_SETS, dataset_path
+
+    model_dir = Path(model_dir)
+    model_dir.mkdir(parents=True, exist_ok=True)
+    n_features = FEATURE_SETS[feature_set].n_features
+    for backend in backends:
+        path = dataset_path(backend, feature_set, date, data_dir)
+        data = load_stage(path, n_features=n_features, layout='dense')
+        forest = fit_stage(data, FOREST_PARAMS, n_jobs=n_jobs)
+        export_forest(forest, model_dir / (backend + ".npz"))
+        print("Exported %s model from %s" % (backend, path))
+
+
+def solved_probabilities(models, X):
+    """
+    Returns the probability that each backend solves the predicates `X`
+    as (samples x backends) array, in the order of `models`.
+    """
+    columns = []
+    for model in models.values():
+        column = int(np.flatnonzero(model.classes == SOLVED)[0])
+        columns.append(model.predict_proba(X)[:, column])
+    return np.column_stack(columns)
+
+
+class ScoringService:
+    "Micro-batching scorer, see the module documentation."
+
+    def __init__(self, models, max_batch=64, max_wait=0.002):
+        self.models = models
+        self.backends = list(models)
+        self.n_features = next(iter(models.values())).n_features
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queue = None
+        self.batches = 0
+        self.requests = 0
+
+    async def score(self, features):
+        "Queues a feature vector and waits for its result."
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((features, future))
+        return await future
+
+    async def batcher(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            try:
+                self.score_batch(batch)
+            except Exception as exc:
+                # Fail the requests of this batch only; the batcher keeps serving.
+                for (_, future) in batch:
+                    if not future.done():
+                        future.set_exception(exc)
+
+    def score_batch(self, batch):
+        X = np.array([features for (features, _) in batch], dtype=np.float64)
+        probabilities = solved_probabilities(self.models, X)
+        best = np.argmax(probabilities, axis=1)
+        for i, (_, future) in enumerate(batch):
+            if not future.cancelled():
+                future.set_result({
+                    'probabilities': dict(zip(self.backends, probabilities[i].tolist())),
+                    'backend': self.backends[best[i]]})
+        self.batches += 1
+        self.requests += len(batch)
+
+    def parse(self, line):
+        request = json.loads(line)
+        features = request['features']
+        if len(features) != self.n_features:
+            raise ValueError("Expected %d features, got %d" % (self.n_features, len(features)))
+        return request, [float(f) for f in features]
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    request, features = self.parse(line)
+                    response = await self.score(features)
+                    if 'id' in request:
+                        response['id'] = request['id']
+                except Exception as e: # Invalid request or failed batch.
+                    response = {'error': str(e)}
+                writer.write((json.dumps(response) + "\n").encode())
+                await writer.drain()
+        finally:
+            writer.close()
+
+    async def serve(self, socket_path=None, host='127.0.0.1', port=None):
+        "Serves until cancelled, on `socket_path` or else on `host:port`."
+        self.queue = asyncio.Queue()
+        batcher = asyncio.create_task(self.batcher())
+        if socket_path is not None:
+            server = await asyncio.start_unix_server(self.handle, path=str(socket_path))
+        else:
+            server = await asyncio.start_server(self.handle, host, port)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher.cancel()
+
+
+class ScoringClient:
+    "Blocking client of the scoring service, keeping one connection open."
+
+    def __init__(self, socket_path=None, host='127.0.0.1', port=None):
+        if socket_path is not None:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.connect(str(socket_path))
+        else:
+            self.sock = socket.create_connection((host, port))
+        self.file = self.sock.makefile('rwb')
+
+    def score(self, features):
+        """
+        Returns the response for a feature vector:
+        `{'probabilities': {backend: p, ...}, 'backend': recommended}`.
+        """
+        line = json.dumps({'features': [float(f) for f in features]}) + "\n"
+        self.file.write(line.encode())
+        self.file.flush()
+        response = json.loads(self.file.readline())
+        if 'error' in response:
+            raise ValueError(response['error'])
+        return response
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Backend selection scoring service.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    export = commands.add_parser('export', help="Train and export the per-backend models")
+    export.add_argument('model_dir')
+    export.add_argument('--data-dir', default='data')
+    export.add_argument('--date', default='2020-01-23')
+    export.add_argument('--feature-set', default='f109')
+    serve = commands.add_parser('serve', help="Serve the exported models")
+    serve.add_argument('model_dir')
+    serve.add_argument('--socket', default=None, help="Unix socket path")
+    serve.add_argument('--host', default='127.0.0.1')
+    serve.add_argument('--port', type=int, default=8757)
+    serve.add_argument('--max-batch', type=int, default=64)
+    serve.add_argument('--max-wait', type=float, default=0.002, help="Seconds to wait for a batch to fill")
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        export_models(args.model_dir, args.data_dir, args.date, args.feature_set)
+    else:
+        service = ScoringService(load_models(args.model_dir), args.max_batch, args.max_wait)
+        try:
+            asyncio.run(service.serve(args.socket, args.host, args.port))
+        except KeyboardInterrupt:
+            pass
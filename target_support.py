@@ -0,0 +1,199 @@
+"""
+Per-target support counts of all rules from a single pass.
+
+`analyse_rule_set` only counts how many of the supporting rules share the
+rule's own target, so the notebooks rerun the quadratic analysis on subsets
+such as `neg_rules` to study the unknown class. Here, the supporting rules of
+each rule are counted per target in one pass (`kernels.subset_target_counts`),
+and everything else is derived from these counts:
+
+* support and confidence for the rule's own target (`analyse_rule_set`),
+* confidence and lift for either target,
+* the analysis of the rules of one target alone, e.g.
+  `analyse_rule_set(neg_rules)`, as `counts.annotated(target=0)`.
+
+The lift of rule `i` for target `k` relates its confidence for `k` to the
+share of `k` among the rules it is compared against (the rules after it).
+
+`label_target_counts` does the same over the samples (see
+`rule_coverage.CoverageEngine`), for one or several label columns at once,
+e.g. the labels of all three backends for the same predicates; there, the
+lift relates to the share of the label among all samples.
+
+Usage:
+
+    counts = rule_target_counts(rules, max_depth=10)
+    counts.annotated()           # == analyse_rule_set(rules, max_depth=10)
+    counts.annotated(target=0)   # == analyse_rule_set(neg_rules, max_depth=10)
+    counts.frame(f109_name)      # confidence and lift per target
+
+    by_backend = label_target_counts(rules, X, {'prob': Y_prob, 'z3': Y_z3})
+
+    python target_support.py data/2020-01-23/prob-f109-lto_unique.csv --max-depth 10 --out targets.csv
+"""
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from condition_encoding import RuleCodes
+from intrees import association_rule_cond
+from kernels import subset_target_counts
+
+
+class TargetCounts:
+    """
+    Support counts of rules (`conds`, `targets`) split by target value
+    (`labels`): `counts[i, k]` supporting items of rule `i` with label
+    `labels[k]`, and `population[i, k]` (or a single row for all rules)
+    items of label `labels[k]` that rule `i` was compared against.
+    """
+
+    def __init__(self, conds, targets, labels, counts, population):
+        self.conds = conds
+        self.targets = np.asarray(targets)
+        self.labels = np.asarray(labels)
+        self.counts = counts
+        self.population = population
+
+    def __len__(self):
+        return len(self.conds)
+
+    @property
+    def support(self):
+        return self.counts.sum(axis=1)
+
+    def label_index(self, target):
+        "Column of the target value `target` (`ValueError` if unknown)."
+        index = np.flatnonzero(self.labels == target)
+        if len(index) == 0:
+            raise ValueError("Unknown target %r, labels are %s" % (target, self.labels.tolist()))
+        return int(index[0])
+
+    def target_counts(self, target=None):
+        "Supporting items with the given target, or with each rule's own target."
+        if target is not None:
+            return self.counts[:, self.label_index(target)]
+        column = np.searchsorted(self.labels, self.targets)
+        column = np.minimum(column, len(self.labels) - 1)
+        own = self.counts[np.arange(len(self)), column]
+        return np.where(self.labels[column] == self.targets, own, 0)
+
+    def confidence(self, target=None):
+        """
+        Fraction of the supporting items with the given target
+        (by default each rule's own target); 0 without support.
+        """
+        hits = self.target_counts(target)
+        return np.where(hits > 0, hits / np.maximum(self.support, 1), 0.0)
+
+    def lift(self, target):
+        "Confidence for `target` relative to its share in the population (`NaN` if undefined)."
+        k = self.label_index(target)
+        population = np.broadcast_to(self.population, self.counts.shape)
+        share = population[:, k] / np.maximum(population.sum(axis=1), 1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            lift = self.confidence(target) / share
+        return np.where((self.support > 0) & (share > 0), lift, np.nan)
+
+    def annotated(self, target=None):
+        """
+        Rules in the format of `analyse_rule_set`, `[cond, target, support,
+        confidence]`. With `target`, only the rules with that target, counted
+        among the rules with that target only, i.e. as if the subset
+        (in the same order) had been analysed on its own.
+        """
+        if target is None:
+            support, confidence = self.support, self.confidence()
+            return [[self.conds[i], self.targets[i].item(), int(support[i]), confidence[i].item()]
+                    for i in range(len(self))]
+        hits = self.target_counts(target)
+        return [[self.conds[i], self.targets[i].item(), int(hits[i]), 1.0 if hits[i] > 0 else 0]
+                for i in np.flatnonzero(self.targets == target)]
+
+    def frame(self, feature_name=None):
+        "DataFrame with support, own confidence and confidence and lift per target."
+        from reporting import condition_string
+
+        frame = pd.DataFrame({
+            'conditions': [condition_string(c) for c in self.conds],
+            'target': self.targets,
+            'support': self.support,
+            'confidence': self.confidence(),
+        })
+        for label in self.labels:
+            frame['support_%s' % label] = self.target_counts(label)
+            frame['confidence_%s' % label] = self.confidence(label)
+            frame['lift_%s' % label] = self.lift(label)
+        if feature_name is not None:
+            frame['description'] = [
+                "; ".join("%s (%s)" % (feature_name(fid), "low" if leq else "high")
+                          for (fid, leq) in sorted(c)) for c in self.conds]
+        return frame
+
+
+def rule_target_counts(rule_set, max_depth=None):
+    """
+    Counts, in the order and with the semantics of `analyse_rule_set`,
+    the later rules containing each rule's condition, per target.
+    Returns a `TargetCounts` over the rules in analysis order.
+    """
+    sorted_rules = sorted(rule_set, key=lambda r: 1/len(r[0]))
+    codes = RuleCodes.from_rules(sorted_rules, max_depth)
+    labels, target_index = np.unique(codes.targets, return_inverse=True)
+    counts = subset_target_counts(codes.bitsets(query=True), codes.bitsets(),
+                                  target_index, len(labels))
+    own = target_index[:, None] == np.arange(len(labels))[None, :]
+    later = np.cumsum(own[::-1], axis=0)[::-1] - own # Rules after each rule, per target.
+    conds = [association_rule_cond(cond, max_depth) for (cond, _) in sorted_rules]
+    return TargetCounts(conds, codes.targets, labels, counts, later)
+
+
+def label_target_counts(rules, X, label_columns, max_depth=None):
+    """
+    Counts the samples covered by each rule per value of each label column
+    (a Series, DataFrame, or dictionary of aligned label arrays).
+    Returns a dictionary `column name -> TargetCounts` (in the order of `rules`).
+    """
+    from rule_coverage import CoverageEngine
+
+    if hasattr(label_columns, 'to_frame') and not hasattr(label_columns, 'columns'):
+        label_columns = label_columns.to_frame()
+    label_columns = {name: np.asarray(label_columns[name]) for name in label_columns}
+    rules = list(rules)
+    if max_depth is not None:
+        rules = [(cond[:max_depth], target) for (cond, target) in rules]
+    engine = CoverageEngine.from_rules(rules, X, next(iter(label_columns.values())))
+    conds = [association_rule_cond(cond) for (cond, _) in rules]
+    targets = [target for (_, target) in rules]
+    result = {}
+    for name, (values, counts) in engine.column_counts(rules, label_columns).items():
+        population = (label_columns[name][None, :] == values[:, None]).sum(axis=1)[None, :]
+        result[name] = TargetCounts(conds, targets, values, counts, population)
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Per-target support, confidence and lift of the rules.")
+    parser.add_argument('csv_file')
+    parser.add_argument('--n-features', type=int, default=109)
+    parser.add_argument('--max-depth', type=int, default=None)
+    parser.add_argument('--label', action='append', default=None,
+                        help="Label column for counts over the samples (repeatable)")
+    parser.add_argument('--out', default='rule_targets.csv',
+                        help="Output CSV (with --label: one file per label, suffixed by its name)")
+    args = parser.parse_args()
+
+    from cluster_analysis import FOREST_PARAMS, extract_stage, fit_stage, load_stage
+    from datasets import FEATURE_SETS
+    names = {fs.n_features: fs.feature_name for fs in FEATURE_SETS.values()}
+    feature_name = names.get(args.n_features)
+    data = load_stage(args.csv_file, n_features=args.n_features)
+    rules = extract_stage(fit_stage(data, FOREST_PARAMS))
+    if args.label:
+        labels = pd.read_csv(args.csv_file, usecols=args.label)
+        stem = args.out[:-4] if args.out.endswith('.csv') else args.out
+        for name, counts in label_target_counts(rules, data[0], labels, args.max_depth).items():
+            counts.frame(feature_name).to_csv("%s-%s.csv" % (stem, name), index=False)
+    else:
+        rule_target_counts(rules, args.max_depth).frame(feature_name).to_csv(args.out, index=False)
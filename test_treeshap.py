@@ -0,0 +1,54 @@
+"""
+Compares `treeshap.tree_shap` with `shap.TreeExplainer` on deep trees,
+for both kernel backends.
+
+    python -m pytest test_treeshap.py
+"""
+import numpy as np
+import pytest
+from sklearn.ensemble import RandomForestClassifier
+
+import kernels
+from treeshap import tree_shap
+
+shap = pytest.importorskip('shap')
+
+BACKENDS = ['numpy'] + (['numba'] if kernels.numba is not None else [])
+
+
+@pytest.fixture(scope='module')
+def deep_forest():
+    rng = np.random.default_rng(7)
+    X = rng.integers(0, 8, size=(6000, 20)).astype(np.float64)
+    X[:, 10:] = rng.normal(size=(6000, 10)).round(3)
+    Y = ((X[:, 0] * X[:, 1] - X[:, 2] + 2 * X[:, 10] + rng.normal(0, 12, len(X))) > 10).astype(int)
+    forest = RandomForestClassifier(n_estimators=3, bootstrap=False, max_features=0.7,
+                                    random_state=123).fit(X, Y)
+    return forest, X[:200]
+
+
+@pytest.fixture(params=BACKENDS)
+def backend(request, monkeypatch):
+    monkeypatch.setattr(kernels, 'BACKEND', request.param)
+    return request.param
+
+
+def test_deep_trees(deep_forest):
+    forest, _ = deep_forest
+    assert min(tree.tree_.max_depth for tree in forest.estimators_) >= 20
+
+
+def test_matches_shap(deep_forest, backend):
+    forest, X = deep_forest
+    phi, expected = tree_shap(forest, X, n_jobs=1)
+    reference = shap.TreeExplainer(forest, feature_perturbation='tree_path_dependent')
+    values = np.asarray(reference.shap_values(X))
+    values = values[..., 1] if values.shape[-1] == 2 else values[1]
+    np.testing.assert_allclose(phi, values, atol=1e-10)
+    np.testing.assert_allclose(expected, np.ravel(reference.expected_value)[-1], atol=1e-10)
+
+
+def test_additivity(deep_forest, backend):
+    forest, X = deep_forest
+    phi, expected = tree_shap(forest, X, n_jobs=1, chunk_size=64)
+    np.testing.assert_allclose(phi.sum(axis=1) + expected, forest.predict_proba(X)[:, 1], atol=1e-10)
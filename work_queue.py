@@ -0,0 +1,333 @@
+"""
+Dynamic work queue for the support and confidence calculation on several
+machines (e.g. a job array on an HPC cluster) or several local processes.
+
+As in `cluster_analysis_jobarray.py`, rule `i` of the length-sorted rule list
+is compared against all rules after it, so its cost is proportional to
+`n - i`. Instead of fixed 100 rule batches, the coordinator cuts the rule
+list into shards of equal estimated cost. Workers claim shards from a JSON
+state file guarded by an `fcntl` lock in a shared directory, and process
+them in blocks, reserving each block before computing it. A worker without
+pending shards steals the unreserved second half (by cost) of the running
+shard with the most remaining work.
+Shards whose worker stopped sending heartbeats are handed out again,
+starting after their last finished block.
+
+Each finished block is stored as `results/<start>-<end>.pkl`;
+`gather` assembles them into the usual reports.
+
+Usage:
+
+    python work_queue.py init data/2020-01-23/prob-f109-lto_unique.csv queue --shards 256
+    python work_queue.py work queue       # in each job array task
+    python work_queue.py gather queue results/prob-f109
+
+    # Everything on one machine with 8 worker processes:
+    python work_queue.py local data/2020-01-23/prob-f109-lto_unique.csv results/prob-f109 --workers 8
+"""
+import argparse
+import fcntl
+import json
+import multiprocessing as mp
+import os
+import pickle
+import socket
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+
+from approx_analysis import superset_mask
+from condition_encoding import RuleCodes, decode_cond
+
+PENDING, RUNNING, DONE = 'pending', 'running', 'done'
+
+
+def rule_costs(n, start=0, end=None):
+    """
+    Estimated cost of each rule `start..end-1` of `n` rules: the number of
+    rules it is compared against, plus one.
+    """
+    end = n if end is None else end
+    return np.arange(n - start, n - end, -1, dtype=np.float64)
+
+
+def cost_boundaries(costs, parts, start=0, end=None):
+    """
+    Splits the range `[start, end)` into `parts` consecutive ranges of about
+    equal summed cost. Returns the `parts + 1` boundaries.
+    """
+    end = len(costs) if end is None else end
+    cumulative = np.concatenate([[0.0], np.cumsum(costs[start:end])])
+    targets = cumulative[-1] * np.arange(1, parts) / parts
+    inner = start + np.searchsorted(cumulative, targets, side='left')
+    return [start] + sorted(set(int(b) for b in inner if start < b < end)) + [end]
+
+
+class WorkQueue:
+    "Shard state of a queue directory, see the module documentation."
+
+    def __init__(self, directory, stale_after=600.0):
+        self.directory = Path(directory)
+        self.state_path = self.directory / 'queue.json'
+        self.lock_path = self.directory / 'queue.lock'
+        self.results_dir = self.directory / 'results'
+        self.stale_after = stale_after
+
+    @contextmanager
+    def locked(self):
+        "Yields the state for modification and writes it back atomically."
+        with open(self.lock_path, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(self.state_path) as f:
+                    state = json.load(f)
+                yield state
+                tmp = self.state_path.with_suffix('.tmp')
+                with open(tmp, 'w') as f:
+                    json.dump(state, f)
+                os.replace(tmp, self.state_path)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def create(self, n_rules, n_shards, block_cost=None, min_steal=2):
+        """
+        Initialises the queue for `n_rules` rules in `n_shards` shards of
+        equal cost. Workers reserve blocks of about `block_cost`
+        (default: a hundredth of a shard) and never steal less than
+        `min_steal` rules.
+        """
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.results_dir.mkdir(exist_ok=True)
+        costs = rule_costs(n_rules)
+        bounds = cost_boundaries(costs, max(1, n_shards))
+        shards = [{'id': k, 'start': s, 'end': e, 'done': s, 'next': s, 'state': PENDING,
+                   'worker': None, 'heartbeat': None}
+                  for k, (s, e) in enumerate(zip(bounds[:-1], bounds[1:]))]
+        state = {'rules': n_rules, 'shards': shards, 'min_steal': min_steal,
+                 'block_cost': block_cost or max(1.0, costs.sum() / max(1, n_shards) / 100),
+                 'steals': 0, 'reclaims': 0}
+        with open(self.state_path, 'w') as f:
+            json.dump(state, f)
+        self.lock_path.touch()
+        return state
+
+    def claim(self, worker):
+        """
+        Returns a shard for `worker`: a pending one, a stale one, or a range
+        stolen from the running shard with the most remaining cost.
+        Returns `None` when all work is reserved or done.
+        """
+        now = time.time()
+        with self.locked() as state:
+            shards = state['shards']
+            costs = rule_costs(state['rules'])
+            for shard in shards:
+                if shard['state'] == RUNNING and now - shard['heartbeat'] > self.stale_after:
+                    shard.update(state=PENDING, next=shard['done'], worker=None)
+                    state['reclaims'] += 1
+            pending = [s for s in shards if s['state'] == PENDING]
+            if pending:
+                shard = pending[0]
+            else:
+                running = [s for s in shards if s['state'] == RUNNING
+                           and s['end'] - s['next'] >= state['min_steal']]
+                if not running:
+                    return None
+                victim = max(running, key=lambda s: costs[s['next']:s['end']].sum())
+                middle = cost_boundaries(costs, 2, victim['next'], victim['end'])[1]
+                shard = {'id': len(shards), 'start': middle, 'end': victim['end'], 'done': middle,
+                         'next': middle, 'state': PENDING, 'worker': None, 'heartbeat': None}
+                victim['end'] = middle
+                shards.append(shard)
+                state['steals'] += 1
+            shard.update(state=RUNNING, worker=worker, heartbeat=now)
+            return dict(shard)
+
+    def reserve(self, shard_id, done, worker):
+        """
+        Records that the shard's rules before `done` are finished and reserves
+        the next block. Returns the end of the reserved block
+        (equal to `done` if the shard is exhausted, or if it is no longer
+        running for `worker` because it was handed out again meanwhile).
+        """
+        with self.locked() as state:
+            shard = state['shards'][shard_id]
+            if shard['state'] != RUNNING or shard['worker'] != worker:
+                return done
+            shard['done'] = done
+            shard['heartbeat'] = time.time()
+            costs = rule_costs(state['rules'], done, shard['end'])
+            limit = np.searchsorted(np.cumsum(costs), state['block_cost'])
+            block_end = min(shard['end'], done + int(limit) + 1)
+            shard['next'] = block_end
+            if block_end <= done:
+                shard['state'] = DONE
+            return block_end
+
+    def status(self):
+        with self.locked() as state:
+            return state
+
+
+def analyse_range(sorted_rules, bits, targets, start, end, max_depth=None):
+    """
+    Support and confidence of the rules `start..end-1`, each compared against
+    the rules after it (as `analyse_rule_in_ruleset`), using the item bitsets
+    `bits` of the full rule conditions and the array of all `targets`
+    (see `rule_bitsets`).
+    """
+    codes = RuleCodes.from_rules(sorted_rules[start:end], max_depth)
+    queries = codes.bitsets(query=True, n_words=bits.shape[1])
+    result = []
+    for i in range(start, end):
+        contained = superset_mask(bits[i+1:], queries[i - start])
+        support = int(contained.sum())
+        same = int((targets[i+1:][contained] == targets[i]).sum())
+        result.append([decode_cond(codes.codes(i - start, query=True).tolist()), int(targets[i]),
+                       support, same/support if same > 0 else 0])
+    return result
+
+
+def rule_bitsets(sorted_rules):
+    """
+    Item bitsets of the full rule conditions (see `condition_encoding.RuleCodes`)
+    and the targets of the rules, computed once per worker.
+    """
+    codes = RuleCodes.from_rules(sorted_rules)
+    return codes.bitsets(), codes.targets
+
+
+def work(directory, worker=None, stale_after=600.0):
+    """
+    Worker loop: claims shards and processes them block by block until no
+    work is left. Returns the number of analysed rules.
+    """
+    worker = worker or "%s-%d" % (socket.gethostname(), os.getpid())
+    queue = WorkQueue(directory, stale_after)
+    with open(queue.directory / 'rules.pkl', 'rb') as f:
+        job = pickle.load(f)
+    sorted_rules, max_depth = job['rules'], job['max_depth']
+    bits, targets = rule_bitsets(sorted_rules)
+    analysed = 0
+    while True:
+        shard = queue.claim(worker)
+        if shard is None:
+            return analysed
+        done = shard['done']
+        while True:
+            block_end = queue.reserve(shard['id'], done, worker)
+            if block_end <= done:
+                break
+            result = analyse_range(sorted_rules, bits, targets, done, block_end, max_depth)
+            path = queue.results_dir / ("%d-%d.pkl" % (done, block_end))
+            tmp = path.with_suffix('.tmp-' + worker)
+            with open(tmp, 'wb') as f:
+                pickle.dump(result, f)
+            os.replace(tmp, path)
+            analysed += block_end - done
+            done = block_end
+
+
+def gather(directory):
+    """
+    Assembles the block results of a finished queue into one list of
+    annotated rules in rule order. Raises `ValueError` if rules are missing.
+    """
+    queue = WorkQueue(directory)
+    n = queue.status()['rules']
+    annotated = [None] * n
+    for path in queue.results_dir.glob('*.pkl'):
+        start, _ = (int(x) for x in path.stem.split('-'))
+        with open(path, 'rb') as f:
+            for offset, rule in enumerate(pickle.load(f)):
+                annotated[start + offset] = rule
+    missing = sum(1 for rule in annotated if rule is None)
+    if missing:
+        raise ValueError("%d of %d rules have not been analysed yet" % (missing, n))
+    return annotated
+
+
+def init_queue(csv_file_path, directory, n_shards, max_depth=None, n_features=109):
+    """
+    Trains the forest (as the cluster scripts), extracts the length-sorted
+    rules and creates the queue in `directory`.
+    """
+    from cluster_analysis import FOREST_PARAMS, extract_stage, fit_stage, load_stage
+
+    data = load_stage(csv_file_path, n_features=n_features)
+    forest = fit_stage(data, FOREST_PARAMS)
+    sorted_rules = extract_stage(forest)
+    queue = WorkQueue(directory)
+    queue.create(len(sorted_rules), n_shards)
+    with open(queue.directory / 'rules.pkl', 'wb') as f:
+        pickle.dump({'rules': sorted_rules, 'max_depth': max_depth,
+                     'importances': forest.feature_importances_}, f)
+    return queue
+
+
+def write_results(directory, target_dir):
+    "Gathers the queue results and writes the reports of the cluster scripts."
+    from reporting import write_report
+
+    annotated_rules = gather(directory)
+    with open(Path(directory) / 'rules.pkl', 'rb') as f:
+        importances = pickle.load(f)['importances']
+    target_dir = Path(target_dir)
+    target_dir.mkdir(parents=True, exist_ok=True)
+    with open(target_dir / 'assoc_rules.dat', 'wb') as dat:
+        pickle.dump(annotated_rules, dat)
+    write_report(annotated_rules, target_dir / 'assoc_rule_overview.md', importances,
+                 fmt='md', support_total=len(annotated_rules))
+    write_report(annotated_rules, target_dir / 'assoc_rules.csv', fmt='csv')
+    return annotated_rules
+
+
+def run_local(directory, workers):
+    "Runs `workers` worker processes on this machine until the queue is done."
+    processes = [mp.Process(target=work, args=(directory, "local-%d" % k)) for k in range(workers)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Cost-balanced work queue for the rule analysis.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    init = commands.add_parser('init', help="Train, extract rules and create the queue")
+    init.add_argument('csv_file')
+    init.add_argument('queue_dir')
+    init.add_argument('--shards', type=int, default=256)
+    init.add_argument('--max-depth', type=int, default=None)
+    worker = commands.add_parser('work', help="Process shards until the queue is empty")
+    worker.add_argument('queue_dir')
+    worker.add_argument('--worker', default=None, help="Worker name (default: host-pid)")
+    worker.add_argument('--stale-after', type=float, default=600.0,
+                        help="Seconds without heartbeat after which a shard is handed out again")
+    gathering = commands.add_parser('gather', help="Write the reports of a finished queue")
+    gathering.add_argument('queue_dir')
+    gathering.add_argument('target_dir')
+    local = commands.add_parser('local', help="init, work with local processes, and gather")
+    local.add_argument('csv_file')
+    local.add_argument('target_dir')
+    local.add_argument('--workers', type=int, default=os.cpu_count())
+    local.add_argument('--shards', type=int, default=None, help="Default: 4 per worker")
+    local.add_argument('--max-depth', type=int, default=None)
+    args = parser.parse_args()
+
+    if args.command == 'init':
+        init_queue(args.csv_file, args.queue_dir, args.shards, args.max_depth)
+    elif args.command == 'work':
+        print("Analysed %d rules" % work(args.queue_dir, args.worker, args.stale_after))
+    elif args.command == 'gather':
+        print("Gathered %d rules" % len(write_results(args.queue_dir, args.target_dir)))
+    else:
+        queue_dir = Path(args.target_dir) / 'queue'
+        init_queue(args.csv_file, queue_dir, args.shards or 4 * args.workers, args.max_depth)
+        run_local(queue_dir, args.workers)
+        state = WorkQueue(queue_dir).status()
+        print("Shards: %d (%d stolen), reclaimed: %d"
+              % (len(state['shards']), state['steals'], state['reclaims']))
+        print("Gathered %d rules" % len(write_results(queue_dir, args.target_dir)))